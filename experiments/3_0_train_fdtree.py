@@ -3,13 +3,12 @@ import os, sys
 import numpy as np
 
 # Local imports
-from utils import setup_data_trees, custom_train_test_split, get_background
-from utils import load_trees, save_FDTree, Data_Config, TreeEnsembleHP
+from utils import setup_data_trees, custom_train_test_split, get_background, get_weighted_background
+from utils import load_trees, save_FDTree, load_H, Data_Config, TreeEnsembleHP
 from data_utils import INTERACTIONS_MAPPING
 
 sys.path.append(os.path.abspath(".."))
 from src.anova_tree import Partition, PARTITION_CLASSES
-from src.anova import get_ANOVA_1_tree
 
 
 if __name__ == "__main__":
@@ -24,6 +23,12 @@ if __name__ == "__main__":
                        help="Type of tree ensemble either gbt or rf")
     parser.add_argument("--background_size", type=int, default=600,
                        help="Size of the background data")
+    parser.add_argument("--memory_budget", type=int, default=2**28,
+                       help="Bytes of RAM used when filling the memory-mapped H tensor")
+    parser.add_argument("--deduplicate", action='store_true', 
+                        help="Merge the background rows that the trees cannot tell apart when fitting the FD-Trees")
+    parser.add_argument("--float32", action='store_true', 
+                        help="Store the H tensor in single precision to halve its size")
     parser.add_argument("--save", action='store_true', help="Save model locally")
     args, unknown = parser.parse_known_args()
     print(args)
@@ -37,25 +42,28 @@ if __name__ == "__main__":
     # Make folder for dataset models
     path = os.path.join("models", args.data.name, args.model_name + "_" + str(args.ensemble.random_state))
 
-    # Background data
-    background = get_background(x_train, args.background_size, args.ensemble.random_state)
+    # Background data, identical rows for the ensemble are merged into weighted ones
+    if args.deduplicate:
+        background, weights = get_weighted_background(x_train, args.background_size, 
+                                                       args.ensemble.random_state, model)
+    else:
+        background = get_background(x_train, args.background_size, args.ensemble.random_state)
+        weights = None
 
     # Only use interacting features when fitting the FDTree
     interactions = INTERACTIONS_MAPPING[args.data.name]
     subset_features = features.select(interactions)
 
-    # Compute the A matrix only once
+    # Compute the additive terms used by the method only once, H is written tile by tile to disk.
+    # The rows of a deduplicated H are those of the weighted background and the file
+    # is only read by this script
     use_logit = args.model_name == "gbt"
-    if not os.path.exists(os.path.join(path, f"A_global_N_{args.background_size}.npy")):
-        H = get_ANOVA_1_tree(background, model, task=task, logit=use_logit)
-        np.save(os.path.join(path, f"A_global_N_{args.background_size}.npy"), H)
-    else:
-        H = np.load(os.path.join(path, f"A_global_N_{args.background_size}.npy"))
+    H = load_H(model, background, task, path, args.background_size, logit=use_logit,
+               partition_type=args.partition.type, interactions=interactions, deduplicate=args.deduplicate,
+               memory_budget=args.memory_budget, result_dtype=np.float32 if args.float32 else np.float64)
     
     # Modify A if needed for the method
-    if args.partition.type == "gadget-pdp":
-        H = H[..., [0]+[i+1 for i in interactions]]
-    elif args.partition.type in ["random", "l2coe"]:
+    if args.partition.type in ["random", "l2coe"]:
         H = H.sum(-1)
     elif args.partition.type == "cart":
         H = H[0, :, 0]
@@ -74,7 +82,7 @@ if __name__ == "__main__":
                     negligible_impurity=args.partition.negligible_impurity,
                     relative_decrease=args.partition.relative_decrease,
                     samples_leaf=args.partition.samples_leaf)
-        tree.fit(background[:, interactions], H)
+        tree.fit(background[:, interactions], H, sample_weight=weights)
         print(f"Final Loss : {tree.total_impurity}")
         tree.print(verbose=True)
         groups, rules = tree.predict(X)
@@ -8,7 +8,7 @@ from utils import load_trees, load_FDTree, Data_Config, TreeEnsembleHP
 from data_utils import INTERACTIONS_MAPPING
 
 sys.path.append(os.path.abspath(".."))
-from src.anova import get_ANOVA_1_tree, interventional_treeshap
+from src.anova import TreeANOVA, get_regional_shap
 from src.anova_tree import Partition
 
 if __name__ == "__main__":
@@ -23,6 +23,8 @@ if __name__ == "__main__":
                        help="Type of tree ensemble either gbt or rf")
     parser.add_argument("--background_size", type=int, default=600, 
                        help="Size of the background data")
+    parser.add_argument("--cache_pairs", action="store_true", 
+                       help="Store the SHAP values of each pair of instances once and reduce them in each region")
     args, unknown = parser.parse_known_args()
     print(args)
 
@@ -42,29 +44,43 @@ if __name__ == "__main__":
     # Background data
     background = get_background(x_train, args.background_size, args.ensemble.random_state)
 
+    # The trees are extracted once for all regions
+    explainer = TreeANOVA(model, background)
+
+    # The SHAP values of all pairs are shared by every partition type
+    if args.cache_pairs:
+        pairs_file = os.path.join(path, f"phis_pairs_N_{args.background_size}.npy")
+        if os.path.exists(pairs_file):
+            Phis = np.load(pairs_file, mmap_mode="r")
+        else:
+            Phis = explainer.shap_pairs(background, background, result_dtype=np.float32, filename=pairs_file)
+
     # Do not recompute the shapley values if they were computed
     if not os.path.exists(os.path.join(path, f"phis_global_N_{args.background_size}.npy")):
-        phis, _ = interventional_treeshap(model, background, background)
+        phis = get_regional_shap(Phis) if args.cache_pairs else explainer.shap(background, background)
         np.save(os.path.join(path, f"phis_global_N_{args.background_size}.npy"), phis)
 
-    # For FD-Trees fo increasing depths
-    for max_depth in [1, 2, 3]:
+    # Regions of the FD-Trees of increasing depths
+    depths = [1, 2, 3]
+    labels, n_groups = [], []
+    for max_depth in depths:
 
         # Load the FD-Tree
         tree = load_FDTree(max_depth, args.data.name, args.model_name, args.ensemble.random_state, 
                            args.partition.type, args.background_size)
         groups, rules = tree.predict(background[:, interactions])
+        labels.append(groups)
+        n_groups.append(tree.n_groups)
 
-        # Explain in each Region
-        backgrounds = [0] * tree.n_groups
-        for group_idx in range(tree.n_groups):
-            idx_select = (groups == group_idx)
-            regional_background = background[idx_select]
+    # SHAP in all regions of all depths with a single pass over the in-region pairs
+    if args.cache_pairs:
+        phis = get_regional_shap(Phis, np.stack(labels))
+    else:
+        phis = explainer.regional_shap(background, np.stack(labels))
 
-            # SHAP
-            phis, _ = interventional_treeshap(model,
-                                            regional_background, 
-                                            regional_background)
+    # Explain in each Region
+    for max_depth, groups, n_regions, regional_phis in zip(depths, labels, n_groups, phis, strict=True):
+        for group_idx in range(n_regions):
             filename = f"phis_{args.partition.type}_N_{args.background_size}_" +\
                        f"max_depth_{max_depth}_region_{group_idx}.npy"
-            np.save(os.path.join(path, filename), phis)
+            np.save(os.path.join(path, filename), regional_phis[groups == group_idx])
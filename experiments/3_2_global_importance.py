@@ -6,7 +6,7 @@ import matplotlib.pyplot as plt
 # Local imports
 from utils import COLORS
 from utils import setup_pyplot_font, setup_data_trees, custom_train_test_split
-from utils import load_FDTree, three_bars, get_background
+from utils import load_FDTree, load_trees, three_bars, get_background, load_H
 from utils import correlation, rank_correlation, l2_norm, l2_disagreement
 from utils import Data_Config, TreeEnsembleHP
 from data_utils import INTERACTIONS_MAPPING
@@ -57,14 +57,19 @@ if __name__ == "__main__":
     model_path = os.path.join("models", args.data.name, args.model_name + "_" + state)
 
     # Get the pre-computed feature attributions
-    H = np.load(os.path.join(model_path, f"A_global_N_{args.background_size}.npy"))
     phis = np.load(os.path.join(model_path, f"phis_global_N_{args.background_size}.npy"))
     # Background data
     background = get_background(x_train, args.background_size, args.ensemble.random_state)
 
+    # The global and regional summaries are all read from the same H, which is computed once
+    model, perfs = load_trees(args.data.name, args.model_name, args.ensemble.random_state)
+    H = load_H(model, background, task, model_path, args.background_size, 
+               logit=args.model_name == "gbt")
+
     # Measure of non-additivity
-    f = H.sum(-1)[np.arange(args.background_size), np.arange(args.background_size)]
-    impurity = np.mean((f - H.sum(-1).mean(1))**2)
+    F = H.sum(-1)
+    f = F[np.arange(args.background_size), np.arange(args.background_size)]
+    impurity = np.mean((f - F.mean(1))**2)
     print(f"Non-additivity : {impurity:.2f}")
 
     # Global Feature Importance
@@ -6,7 +6,7 @@ import matplotlib.pyplot as plt
 # Local imports
 from utils import plot_legend, attrib_scatter_plot
 from utils import setup_pyplot_font, setup_data_trees, custom_train_test_split
-from utils import load_FDTree, get_background
+from utils import load_FDTree, load_trees, get_background, load_H
 from utils import correlation, rank_correlation, l2_disagreement, l2_norm, Data_Config, TreeEnsembleHP
 from data_utils import INTERACTIONS_MAPPING, SCATTER_SHOW
 
@@ -57,10 +57,11 @@ if __name__ == "__main__":
     model_path = os.path.join("models", args.data.name, args.model_name + "_" + state)
 
     # Get the pre-computed feature attributions
-    H = np.load(os.path.join(model_path, f"A_global_N_{args.background_size}.npy"))
-    pdp = H[..., 1:].mean(axis=1)
     phis = np.load(os.path.join(model_path, f"phis_global_N_{args.background_size}.npy"))
     background = get_background(x_train, args.background_size, args.ensemble.random_state)
+    model, perfs = load_trees(args.data.name, args.model_name, args.ensemble.random_state)
+    H = load_H(model, background, task, model_path, args.background_size, logit=args.model_name == "gbt")
+    pdp = H[..., 1:].mean(axis=1)
 
     # Compare PDP and Shapley Values
     if args.plot:
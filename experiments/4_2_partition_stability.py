@@ -7,7 +7,7 @@ import itertools
 
 # Local imports
 from utils import setup_pyplot_font, setup_data_trees, custom_train_test_split
-from utils import get_background
+from utils import get_background, load_trees, load_H
 from data_utils import INTERACTIONS_MAPPING
 
 from src.anova_tree import Partition, PARTITION_CLASSES
@@ -42,9 +42,11 @@ if __name__ == "__main__":
             # Folder for dataset models
             model_path = os.path.join("models", data, model_name + "_0")
 
-            # Get the pre-computed A matrix
-            A = np.load(os.path.join(model_path, f"A_global_N_1000.npy"))
+            # Get the pre-computed A matrix, the L2CoE partitions only need the sum of H
             background = get_background(x_train, 1000, 0)
+            model, perfs = load_trees(data, model_name, 0)
+            A = load_H(model, background, task, model_path, 1000, logit=model_name == "gbt",
+                       partition_type="l2coe")
 
             # Iterate over all subsample random seeds
             for state in range(10):
@@ -515,6 +515,61 @@ def get_background(x, background_size, random_state):
     return background
 
 
+
+def get_weighted_background(x, background_size, random_state, model):
+    """ Background whose rows taking the same branches in all trees of model are merged """
+    from src.anova import TreeANOVA
+    background = get_background(x, background_size, random_state)
+    background, weights, _ = TreeANOVA(model).deduplicate(background)
+    return background, weights
+
+
+
+def get_H_layout(partition_type, interactions):
+    """ 
+    Additive terms of H used to fit a partition, as the `features` and `rest` arguments
+    of `get_ANOVA_1_tree` and the suffix of the file where they are stored. The other
+    partitions and the explanation scripts use the full tensor H.
+    """
+    if partition_type == "gadget-pdp":
+        return interactions, False, "_interactions"
+    if partition_type in ["random", "l2coe"]:
+        return [], True, "_sum"
+    if partition_type == "cart":
+        return [], False, "_f"
+    return None, False, ""
+
+
+
+def get_H_filename(model_path, background_size, suffix="", deduplicate=False, result_dtype=np.float64):
+    """ 
+    File of the tensor H of a model against a background, `suffix` is given by `get_H_layout`.
+    With `deduplicate`, the rows of H are those of `get_weighted_background` rather than
+    `get_background`, such files are only read when fitting the FD-Trees. Tensors stored
+    in single precision get their own files.
+    """
+    dedup = "_dedup" if deduplicate else ""
+    precision = "_float32" if np.dtype(result_dtype) == np.float32 else ""
+    return os.path.join(model_path, f"A_global_N_{background_size}{dedup}{suffix}{precision}.npy")
+
+
+
+def load_H(model, background, task, model_path, background_size, logit=False, partition_type=None,
+           interactions=None, deduplicate=False, memory_budget=2**28, result_dtype=np.float64):
+    """ 
+    Memory-map the tensor H with the layout used by `partition_type`, it is first
+    computed tile by tile on disk when its file does not exist
+    """
+    from src.anova import get_ANOVA_1_tree
+    features, rest, suffix = get_H_layout(partition_type, interactions)
+    filename = get_H_filename(model_path, background_size, suffix, deduplicate, result_dtype)
+    if not os.path.exists(filename):
+        get_ANOVA_1_tree(background, model, task=task, logit=logit, filename=filename, 
+                         memory_budget=memory_budget, result_dtype=result_dtype,
+                         features=features, rest=rest)
+    return np.load(filename, mmap_mode="r")
+
+
 ############################## Tree-based models ##############################
 TREES = {
          "rf" : {"regression": RandomForestRegressor(), 
@@ -5,7 +5,8 @@ ext_modules = [
     Extension(
         "treeshap",
         sources=["src/tree_shap/main.cpp"],
-        extra_compile_args=["-std=c++11"],
+        extra_compile_args=["-std=c++11", "-pthread"],
+        extra_link_args=["-pthread"],
     )
 ]
 
@@ -1,13 +1,15 @@
 
 import ctypes
 import glob
-import pandas as pd
+import hashlib
 import sklearn.ensemble as se
 import numpy as np
-from functools import partial
+from functools import partial, cache
 from tqdm import tqdm
 import os
-from shap.explainers import Tree
+from .tree_ensemble import TreeEnsemble, SUPPORTED_MODELS, extract_tree_ensemble
+from .tree_ensemble import NODE_DTYPE, pack_tree_ensemble, compact_packed_ensemble
+from .tree_ensemble import packed_tree_columns, closed_form_grids
 
 
 
@@ -30,25 +32,70 @@ def get_ANOVA_1(X, f):
     return H
 
 
-def get_ANOVA_1_tree(X, tree_ensemble, task, logit=False):
-    # The black-box to call
+def get_black_box(tree_ensemble, task, logit=False):
+    """ The function f whose ANOVA decomposition is computed """
+    # Loaded XGBoost and LightGBM ensembles output their raw score
+    if isinstance(tree_ensemble, TreeEnsemble):
+        return tree_ensemble.predict
     if task == "regression":
-        f = tree_ensemble.predict
-    else:
-        if logit:
-            f = tree_ensemble.decision_function
-        else:
-            f = lambda x : tree_ensemble.predict_proba(x)[:, 1]
-    
-    N, D = X.shape
-    H = np.zeros((N, N, D+1))
-    f_X = f(X)
-    H[..., 0] += f_X.reshape((1, -1))
-    H[..., 1:] = interventional_additive_treeshap(tree_ensemble, X)
-    
-    # Sanity Checks : Diagonal elements should be equal to f(x)
-    assert np.isclose(H.sum(-1)[np.arange(N), np.arange(N)], f_X).all()
-    return H
+        return tree_ensemble.predict
+    if logit:
+        return tree_ensemble.decision_function
+    return lambda x : tree_ensemble.predict_proba(x)[:, 1]
+
+
+def get_ANOVA_1_tree(X, tree_ensemble, task, logit=False, n_jobs=1, 
+                     filename=None, memory_budget=None, use_bitset=False, deduplicate=False,
+                     result_dtype=np.float64, background=None, features=None, rest=False, I_map=None):
+    """
+    Compute the tensor H of shape (N, N, D+1) with H[i, j, 0] = f(x_j) and
+    H[i, j, k+1] the additive term of feature k for foreground x_i and background x_j.
+
+    When `filename` is given, H is written to a memory-mapped .npy file so that it
+    never has to fit in RAM. It is then filled in square tiles whose working memory
+    stays under `memory_budget` bytes (256MB by default). Setting `use_bitset` pushes
+    all background instances through each tree at once, see `interventional_treeshap`.
+    Setting `deduplicate` only computes the pairs of rows that are distinct for the
+    ensemble, see `TreeANOVA.deduplicate`, and expands them back to the order of X.
+    Setting `result_dtype=np.float32` halves the size of H in memory and on disk.
+
+    When a `background` of Nz instances is given, X is only used as foreground and H has
+    shape (N, Nz, D+1) with H[i, j, 0] = f(z_j). This is how many rows are explained against
+    a small reference sample, the cost and memory being linear in N.
+
+    Only the additive terms of the `features` are stored when they are given, in this order,
+    followed by the sum of the other terms when `rest` is set. H then has shape 
+    (N, N, len(features)+rest+1) and `H.sum(-1)` is unchanged when `rest` is set.
+
+    When `I_map` groups the columns of X into features, see `interventional_treeshap`, 
+    the additive terms are those of the groups and `features` indexes the groups.
+    """
+    explainer = TreeANOVA(tree_ensemble, X)
+    return explainer.H(X, task, logit=logit, n_jobs=n_jobs, filename=filename, 
+                       memory_budget=memory_budget, use_bitset=use_bitset, 
+                       deduplicate=deduplicate, result_dtype=result_dtype, background=background,
+                       features=features, rest=rest, I_map=I_map)
+
+
+def get_ANOVA_1_tree_reduce(X, tree_ensemble, task, logit=False, n_jobs=1, I_map=None):
+    """
+    Global summaries of H = get_ANOVA_1_tree(X, tree_ensemble, task, logit) computed
+    without storing H, so that O(N d) memory is used instead of O(N^2 d).
+
+    Returns
+    -------
+    pdp : numpy.array
+        Array of shape (N, D) equal to H[..., 1:].mean(1).
+
+    I_PFI : numpy.array
+        Array of shape (D,) equal to get_PFI(H).
+
+    non_additivity : float
+        The mean squared error of the additive approximation, 
+        i.e. np.mean((f(X) - H.sum(-1).mean(1))**2).
+    """
+    explainer = TreeANOVA(tree_ensemble, X)
+    return explainer.H_reduce(X, task, logit=logit, n_jobs=n_jobs, I_map=I_map)
 
 
 def get_ANOVA_2(X, f, features):
@@ -86,7 +133,978 @@ def get_PFI(H):
 
 
 
-def interventional_treeshap(model, foreground, background, I_map=None):
+# Element types of the instances that the C++ kernels read in place, and of their results
+KERNEL_DTYPES = {np.dtype(np.float64) : 0, np.dtype(np.float32) : 1}
+# Instances encoded by `TreeANOVA.encode` as the rank of their values among the thresholds
+CODE_DTYPES = {np.dtype(np.uint8) : 2, np.dtype(np.uint16) : 3}
+# Bits of the quantities computed by `interventional_fused_treeshap`, in the order of their arguments
+FUSED_OUTPUTS = {"shap" : 1, "taylor" : 2, "additive" : 4, "A" : 8}
+
+
+def get_I_map(d, I_map=None):
+    """ Mapping from the d columns to the features seen as players, one per column when None """
+    if I_map is None:
+        return np.arange(d, dtype=np.int32)
+    I_map = np.ascontiguousarray(I_map, dtype=np.int32)
+    assert I_map.shape == (d,)
+    return I_map
+
+
+def get_feature_columns(d, features=None, rest=False):
+    """ 
+    Column of the additive terms where each of the d features is stored, see 
+    `interventional_additive_treeshap`. Features that are not stored are given -1.
+    """
+    if features is None:
+        return np.arange(d, dtype=np.int32)
+    columns = np.full(d, len(features) if rest else -1, dtype=np.int32)
+    columns[list(features)] = np.arange(len(features))
+    return columns
+
+
+def get_strides(array):
+    """ Strides of a numpy array counted in elements rather than bytes """
+    return np.array(array.strides, dtype=np.int64) // array.itemsize
+
+
+def is_same_dataset(X, Z):
+    """ Whether X and Z hold the same instances in the same memory, so that pairs can be symmetrized """
+    X, Z = np.asarray(X), np.asarray(Z)
+    return X.dtype == Z.dtype and X.shape == Z.shape and X.strides == Z.strides and \
+           X.__array_interface__['data'][0] == Z.__array_interface__['data'][0]
+
+
+def as_kernel_input(*datasets):
+    """ 
+    Prepare the datasets so that the C++ kernels can read them in place. DataFrames 
+    with a single dtype, Fortran-ordered arrays, slices and float32 arrays are not copied.
+    Other dtypes are cast to float64, and float32 is promoted only when mixed with float64.
+    The uint8 and uint16 arrays returned by `TreeANOVA.encode` are read as they are.
+
+    Returns
+    -------
+    datasets : List(numpy.array)
+    strides : List(numpy.array)
+    dtype : int
+        The code of the common element type in `KERNEL_DTYPES` or `CODE_DTYPES`.
+    """
+    datasets = [np.asarray(data) for data in datasets]
+    dtype = np.result_type(*datasets)
+    if any(data.dtype in CODE_DTYPES for data in datasets):
+        assert all(data.dtype == dtype for data in datasets), "Encoded and raw instances cannot be mixed"
+        strides = [get_strides(data) for data in datasets]
+        return datasets, strides, CODE_DTYPES[dtype]
+    if dtype not in KERNEL_DTYPES:
+        dtype = np.dtype(np.float64)
+    datasets = [data.astype(dtype, copy=False) for data in datasets]
+    strides = [get_strides(data) for data in datasets]
+    return datasets, strides, KERNEL_DTYPES[dtype]
+
+
+
+def add_closed_form_shap(results, terms, I_map):
+    """ 
+    Add the Shapley values of the trees on at most two columns to `results[..., n_features]`,
+    from the `terms` yielded by `TreeANOVA.closed_form_terms` or `TreeANOVA.closed_form_pair_terms`
+    """
+    for (a, b), f_x, f_xa_zb, f_za_xb, f_z in terms:
+        results[..., I_map[a]] += (f_xa_zb - f_z + f_x - f_za_xb) / 2
+        results[..., I_map[b]] += (f_za_xb - f_z + f_x - f_xa_zb) / 2
+
+
+def add_closed_form_taylor(results, terms, I_map):
+    """ Add the Shapley-Taylor interactions of the trees on at most two columns, see `add_closed_form_shap` """
+    for (a, b), f_x, f_xa_zb, f_za_xb, f_z in terms:
+        i, j = I_map[a], I_map[b]
+        results[..., i, i] += f_xa_zb - f_z
+        results[..., j, j] += f_za_xb - f_z
+        # The interaction is shared by the two mirrored entries
+        interaction = f_x - f_xa_zb - f_za_xb + f_z
+        if i == j:
+            results[..., i, i] += interaction
+        else:
+            results[..., i, j] += interaction / 2
+            results[..., j, i] += interaction / 2
+
+
+def add_closed_form_additive(results, terms, I_map, columns, pairs=None):
+    """ 
+    Add the additive terms of the trees on at most two columns to `results[..., n_columns]`, 
+    the terms of feature k go to the column `columns[k]` given by `get_feature_columns`. 
+    Only the entries where the boolean array `pairs` is set are updated when it is given.
+    """
+    for (a, b), f_x, f_xa_zb, f_za_xb, f_z in terms:
+        i, j = I_map[a], I_map[b]
+        # Both columns belong to the same feature, which then moves the whole tree
+        updates = [(i, f_x - f_z)] if i == j else [(i, f_xa_zb - f_z), (j, f_za_xb - f_z)]
+        for k, term in updates:
+            if columns[k] >= 0:
+                results[..., columns[k]] += term if pairs is None else np.where(pairs, term, 0)
+
+
+def add_closed_form_A(results, terms, I_map):
+    """ Add the sum of the additive terms and of f(z) of the trees on at most two columns, see `add_closed_form_shap` """
+    for (a, b), f_x, f_xa_zb, f_za_xb, f_z in terms:
+        results += f_x if I_map[a] == I_map[b] else f_xa_zb + f_za_xb - f_z
+
+
+
+# Signatures of the functions exported by build/*/treeshap*.so
+DATA_POINTER = np.ctypeslib.ndpointer()
+FLOAT_POINTER = np.ctypeslib.ndpointer(dtype=np.float64)
+INT_POINTER = np.ctypeslib.ndpointer(dtype=np.int32)
+STRIDES_POINTER = np.ctypeslib.ndpointer(dtype=np.int64)
+# optional float64 array, passed as `array.ctypes.data` or None
+OPTIONAL_POINTER = ctypes.c_void_p
+# number of (x, z, tree) triples and of recursions that were run
+STATS_POINTER = np.ctypeslib.ndpointer(dtype=np.int64, shape=(2,))
+# packed nodes and per-tree offsets
+TREE_ARGTYPES = [np.ctypeslib.ndpointer(dtype=NODE_DTYPE, flags='C_CONTIGUOUS'), STRIDES_POINTER]
+KERNEL_ARGTYPES = {
+    "main_int_treeshap" : [ctypes.c_int] * 5 + [DATA_POINTER, STRIDES_POINTER] * 2 +\
+                          [OPTIONAL_POINTER, ctypes.c_int, INT_POINTER] + TREE_ARGTYPES + [ctypes.c_bool] +\
+                          [DATA_POINTER, STRIDES_POINTER, ctypes.c_int, STATS_POINTER, ctypes.c_bool, ctypes.c_bool, ctypes.c_int],
+    "main_regional_treeshap" : [ctypes.c_int] * 4 + [DATA_POINTER, STRIDES_POINTER, OPTIONAL_POINTER, ctypes.c_int] +\
+                               [INT_POINTER, ctypes.c_int, INT_POINTER] + TREE_ARGTYPES +\
+                               [DATA_POINTER, STRIDES_POINTER, ctypes.c_int, STATS_POINTER, ctypes.c_int],
+    "main_pair_treeshap" : [ctypes.c_int] * 5 + [DATA_POINTER, STRIDES_POINTER] * 2 +\
+                           [ctypes.c_int, INT_POINTER] + TREE_ARGTYPES +\
+                           [DATA_POINTER, STRIDES_POINTER, ctypes.c_int, ctypes.c_int],
+    "main_taylor_treeshap" : [ctypes.c_int] * 5 + [DATA_POINTER, STRIDES_POINTER] * 2 +\
+                             [ctypes.c_int, INT_POINTER] + TREE_ARGTYPES + [ctypes.c_bool] +\
+                             [FLOAT_POINTER, STRIDES_POINTER, ctypes.c_int],
+    "main_fused_treeshap" : [ctypes.c_int] * 5 + [DATA_POINTER, STRIDES_POINTER] * 2 +\
+                            [ctypes.c_int, INT_POINTER] + TREE_ARGTYPES + [ctypes.c_int] +\
+                            [FLOAT_POINTER, STRIDES_POINTER] * 4 + [ctypes.c_int],
+    "main_taylor_treeshap_reduce" : [ctypes.c_int] * 5 + [DATA_POINTER, STRIDES_POINTER] * 2 +\
+                                    [ctypes.c_int, INT_POINTER] + TREE_ARGTYPES +\
+                                    [FLOAT_POINTER, STRIDES_POINTER, FLOAT_POINTER, ctypes.c_int],
+    "main_additive_treeshap" : [ctypes.c_int] * 5 + [DATA_POINTER, STRIDES_POINTER] * 2 +\
+                               [ctypes.c_int, INT_POINTER] + TREE_ARGTYPES + [ctypes.c_int] * 4 +\
+                               [ctypes.c_bool, INT_POINTER] +\
+                               [DATA_POINTER, STRIDES_POINTER] * 2 +\
+                               [ctypes.c_int, STATS_POINTER, ctypes.c_bool, ctypes.c_bool, ctypes.c_int],
+    "main_additive_treeshap_reduce" : [ctypes.c_int] * 4 + [DATA_POINTER, STRIDES_POINTER, ctypes.c_int] +\
+                                      [INT_POINTER] + TREE_ARGTYPES + [FLOAT_POINTER, STRIDES_POINTER] * 2 + [ctypes.c_int],
+    "main_A_treeshap" : [ctypes.c_int] * 5 + [DATA_POINTER, STRIDES_POINTER] * 2 +\
+                        [ctypes.c_int, INT_POINTER] + TREE_ARGTYPES + [ctypes.c_bool, DATA_POINTER, STRIDES_POINTER, ctypes.c_int, STATS_POINTER, 
+                                         ctypes.c_bool, ctypes.c_bool, ctypes.c_int],
+}
+
+
+@cache
+def load_treeshap_library():
+    """ Open the shared library once and declare the signatures of its functions """
+    # Find the shared library, the path depends on the platform and Python version    
+    project_root = os.path.dirname(__file__).split('src')[0]
+    libfile = glob.glob(os.path.join(project_root, 'build', '*', 'treeshap*.so'))[0]
+
+    # Open the shared library
+    mylib = ctypes.CDLL(libfile)
+
+    # Tell Python the argument and result types of each function
+    for name, argtypes in KERNEL_ARGTYPES.items():
+        getattr(mylib, name).restype = ctypes.c_int
+        getattr(mylib, name).argtypes = argtypes
+    return mylib
+
+
+
+# Compacted ensembles keyed by a digest of their packed nodes, so that the module-level
+# functions, which build a new explainer per call, only compact each ensemble once
+COMPACTED_ENSEMBLES = {}
+MAX_COMPACTED_ENSEMBLES = 16
+
+
+def compact_packed_ensemble_cached(nodes, offsets):
+    """ `compact_packed_ensemble` with the results of the last ensembles kept in memory """
+    key = hashlib.sha1(nodes.tobytes() + offsets.tobytes(), usedforsecurity=False).hexdigest()
+    if key not in COMPACTED_ENSEMBLES:
+        if len(COMPACTED_ENSEMBLES) >= MAX_COMPACTED_ENSEMBLES:
+            del COMPACTED_ENSEMBLES[next(iter(COMPACTED_ENSEMBLES))]
+        COMPACTED_ENSEMBLES[key] = compact_packed_ensemble(nodes, offsets)
+    return COMPACTED_ENSEMBLES[key]
+
+
+
+class TreeANOVA:
+    """ 
+    Explainer of a tree ensemble whose structure is extracted once.
+    Repeated calls to its methods (e.g. one per region of a FD-Tree) only pay for
+    the C++ kernels.
+
+    Parameters
+    ----------
+    model : model_object
+        The tree based machine learning model that we want to explain. XGBoost, LightGBM, CatBoost, Pyspark
+        and most tree-based scikit-learn models are supported. A `TreeEnsemble` returned by
+        `load_xgboost_json` or `load_lightgbm_text` can also be explained without those libraries.
+
+    data : numpy.array or pandas.DataFrame, default=None
+        Dataset passed to `shap.explainers.Tree` when extracting the trees.
+
+    compact : bool, default=True
+        Compact the ensemble before explaining it, see `compact_packed_ensemble`. Splits that
+        are redundant along their path and null subtrees are removed and trees with identical
+        structures are merged, which does not change the results up to rounding errors.
+        The compacted ensemble is kept in memory, so that explaining the same model again
+        does not compact it again.
+
+    memoize : bool, default=True
+        Let the kernels memoize the trees whose threshold cells are shared by many rows.
+        Setting it to False runs the recursion for every (x, z, tree) triple.
+
+    verbose : bool, default=False
+        Print the hit rate of the memo tables after each call that uses them.
+    """
+    def __init__(self, model, data=None, compact=True, memoize=True, verbose=False):
+        self.model = model
+        self.memoize = memoize
+        self.verbose = verbose
+        # Scikit-learn trees are read directly, other libraries go through the SHAP API
+        if isinstance(model, TreeEnsemble):
+            self.ensemble = model
+        elif isinstance(model, SUPPORTED_MODELS):
+            self.ensemble = extract_tree_ensemble(model)
+        else:
+            from shap.explainers import Tree
+            self.ensemble = Tree(model, data=data).model
+        
+        # All trees are concatenated into packed node records
+        self.nodes, self.offsets, self.depth = pack_tree_ensemble(self.ensemble)
+        if compact:
+            self.nodes, self.offsets, self.depth = compact_packed_ensemble_cached(self.nodes, self.offsets)
+        self.Nt = len(self.offsets) - 1
+
+        # Distinct thresholds of each feature, the nodes are also stored with their
+        # thresholds replaced by their ranks to be evaluated on the encoded instances
+        internal = self.nodes["child_left"] >= 0
+        self.thresholds = {}
+        self.encoded_nodes = self.nodes.copy()
+        for k in np.unique(self.nodes["feature"][internal]):
+            at_k = internal & (self.nodes["feature"] == k)
+            self.thresholds[k] = np.unique(self.nodes["threshold"][at_k])
+            self.encoded_nodes["threshold"][at_k] = np.searchsorted(self.thresholds[k], 
+                                                                    self.nodes["threshold"][at_k])
+
+        # Trees splitting on at most two columns only hold a main effect or a single interaction,
+        # they are evaluated in closed form on the grid of their cells and the kernels skip them.
+        # Only `taylor_reduce` traverses them, its squares do not split over the trees
+        self.tree_columns = packed_tree_columns(self.nodes, self.offsets)
+        self.closed_form = np.array([len(columns) <= 2 for columns in self.tree_columns], dtype=bool)
+        general = np.where(~self.closed_form)[0]
+        self.general_nodes = np.concatenate([np.arange(self.offsets[t], self.offsets[t+1]) for t in general] +
+                                            [np.zeros(0, dtype=np.int64)])
+        self.general_offsets = np.append(0, np.cumsum(np.diff(self.offsets)[general])).astype(np.int64)
+        self.closed_form_grids = closed_form_grids(self.nodes, self.offsets, np.where(self.closed_form)[0], 
+                                                   self.tree_columns)
+        # Trees reduced to a leaf have no grid, they only shift f
+        self.closed_form_constant = sum(self.nodes["value"][self.offsets[t]] 
+                                        for t, columns in enumerate(self.tree_columns) if len(columns) == 0)
+
+        # Trees whose cells are shared by many rows are memoized by the kernels,
+        # memo_stats counts the (x, z, tree) triples and the recursions run by the last call
+        self.memo_stats = np.zeros(2, dtype=np.int64)
+
+        self.lib = load_treeshap_library()
+
+
+    def tree_arrays(self, dtype=0, closed_form=True):
+        """
+        Arrays describing the ensemble in the order expected by the kernels, the trees
+        evaluated in closed form are left out when `closed_form` is False
+        """
+        nodes = self.encoded_nodes if dtype in CODE_DTYPES.values() else self.nodes
+        if closed_form:
+            return nodes, self.offsets
+        return nodes[self.general_nodes], self.general_offsets
+
+
+    def column_values(self, X, k):
+        """ Values of the column k of X, the codes of encoded instances are mapped back to thresholds """
+        if X.dtype not in CODE_DTYPES:
+            return X[:, k]
+        thresholds = self.thresholds.get(k, np.zeros(0))
+        values = np.full(np.iinfo(X.dtype).max + 1, np.nan)
+        values[:len(thresholds)] = thresholds
+        values[len(thresholds)] = np.inf
+        return values[X[:, k]]
+
+
+    def grid_cells(self, X, columns, thresholds):
+        """ Cells of the rows of X along each column of a grid of `closed_form_grids`, the last one holds NaNs """
+        cells = []
+        for k, cuts in zip(columns, thresholds, strict=True):
+            values = self.column_values(X, k)
+            cell = np.searchsorted(cuts, values)
+            cell[np.isnan(values)] = len(cuts) + 1
+            cells.append(cell)
+        return cells
+
+
+    def closed_form_terms(self, foreground, background, weights=None):
+        """
+        Terms of the trees splitting on at most two columns a and b, with b = a for the trees
+        splitting on a single column. For each group of trees on the same columns, yields (a, b),
+        f(x), E_z[f(x_a, z_b)] and E_z[f(z_a, x_b)] for the foreground instances x, and E_z[f(z)]
+        over the weighted background. The expectations only need the distribution of the background
+        over the cells of the grid.
+        """
+        w = np.ones(background.shape[0]) if weights is None else np.asarray(weights, dtype=np.float64)
+        w = w / w.sum()
+        for columns, thresholds, F in self.closed_form_grids:
+            cells_x = self.grid_cells(foreground, columns, thresholds)
+            cells_z = self.grid_cells(background, columns, thresholds)
+            if len(columns) == 1:
+                f_z = F.dot(np.bincount(cells_z[0], w, len(F)))
+                f_x = F[cells_x[0]]
+                yield (columns[0], columns[0]), f_x, f_x, np.full(len(f_x), f_z), f_z
+            else:
+                n_a, n_b = F.shape
+                P = np.bincount(cells_z[0] * n_b + cells_z[1], w, n_a * n_b).reshape((n_a, n_b))
+                yield (columns, F[cells_x[0], cells_x[1]], F.dot(P.sum(0))[cells_x[0]], 
+                       P.sum(1).dot(F)[cells_x[1]], np.sum(F * P))
+
+
+    def closed_form_pair_terms(self, foreground, background):
+        """
+        Same as `closed_form_terms` for each pair of a foreground instance x and a background
+        instance z, the terms f(x), f(x_a, z_b), f(z_a, x_b) and f(z) broadcast to shape (Nx, Nz).
+        """
+        for columns, thresholds, F in self.closed_form_grids:
+            cells_x = [cell.reshape((-1, 1)) for cell in self.grid_cells(foreground, columns, thresholds)]
+            cells_z = [cell.reshape((1, -1)) for cell in self.grid_cells(background, columns, thresholds)]
+            if len(columns) == 1:
+                f_x, f_z = F[cells_x[0]], F[cells_z[0]]
+                yield (columns[0], columns[0]), f_x, f_x, f_z, f_z
+            else:
+                yield (columns, F[cells_x[0], cells_x[1]], F[cells_x[0], cells_z[1]], 
+                       F[cells_z[0], cells_x[1]], F[cells_z[0], cells_z[1]])
+
+
+    def memo_hit_rate(self):
+        """ Fraction of the (x, z, tree) triples of the last call answered by the memo tables """
+        n_triples, n_traversals = self.memo_stats
+        return 1 - n_traversals / n_triples if n_triples > 0 else 0.0
+
+
+    def report_memo_stats(self):
+        """ Print the hit rate of the last call when the explainer is verbose """
+        if self.verbose:
+            print(f"Memo hit rate {self.memo_hit_rate():.3f} over {self.memo_stats[0]} (x, z, tree) triples")
+
+
+    def threshold_ranks(self, X):
+        """
+        Rank of each value among the distinct thresholds of its feature, so that x <= t_k
+        iff rank <= k. Missing values follow the default child and are ranked -1.
+        """
+        X = np.asarray(X)
+        ranks = np.zeros(X.shape, dtype=np.int32)
+        for k, thresholds in self.thresholds.items():
+            ranks[:, k] = np.searchsorted(thresholds, X[:, k], side="left")
+            ranks[np.isnan(X[:, k]), k] = -1
+        return ranks
+
+
+    def encode(self, X):
+        """
+        Encode the instances as the rank of their values among the thresholds of the ensemble.
+        The kernels return identical results on the encoded instances while reading 1 or 2 bytes
+        per value, and the encoding can be reused by all the methods of this explainer.
+
+        Returns
+        -------
+        codes : numpy.array
+            Array of dtype uint8, or uint16 when a feature has more than 254 thresholds. The
+            largest code stands for missing values.
+        """
+        ranks = self.threshold_ranks(X)
+        n_codes = max([len(thresholds) for thresholds in self.thresholds.values()], default=0) + 2
+        assert n_codes <= 2**16, "Too many thresholds to encode the instances with 2 bytes"
+        dtype = np.uint8 if n_codes <= 2**8 else np.uint16
+        codes = ranks.astype(dtype)
+        codes[ranks < 0] = np.iinfo(dtype).max
+        return codes
+
+
+    def deduplicate(self, X):
+        """
+        Collapse the rows of X that take the same branch at every node of the ensemble.
+        Such rows are indistinguishable for the kernels, so any result computed on the
+        representatives expands back to X without loss.
+
+        Returns
+        -------
+        X_unique : numpy.array
+            Array of shape (U, d) with the first row of each group, in order of appearance.
+
+        weights : numpy.array
+            Integer array of shape (U,) with the number of rows in each group.
+
+        inverse : numpy.array
+            Array of shape (N,) such that X_unique[inverse] is equivalent to X.
+        """
+        X = np.asarray(X)
+        ranks = X if X.dtype in CODE_DTYPES else self.threshold_ranks(X)
+        _, first, inverse, weights = np.unique(ranks, axis=0, return_index=True, 
+                                               return_inverse=True, return_counts=True)
+        # Keep the groups in order of appearance
+        order = np.argsort(first)
+        rank_of = np.empty_like(order)
+        rank_of[order] = np.arange(len(order))
+        return X[first[order]], weights[order], rank_of[inverse.ravel()]
+
+
+    def shap(self, foreground, background=None, I_map=None, n_jobs=1, use_bitset=False, 
+             weights=None, deduplicate=False, result_dtype=np.float64):
+        """
+        Interventional Shapley values of shape (Nx, n_features), see `interventional_treeshap`.
+        The foreground is its own background when `background` is None or the same dataset.
+        """
+        symmetric = background is None or is_same_dataset(foreground, background)
+        if deduplicate:
+            foreground, counts, inverse = self.deduplicate(foreground)
+            if symmetric:
+                background, inverse_z = foreground, inverse
+            else:
+                background, counts, inverse_z = self.deduplicate(background)
+            # Each group weighs the sum of the weights of its rows
+            if weights is not None:
+                counts = np.bincount(inverse_z, weights=weights, minlength=background.shape[0])
+            weights = counts
+            phis = self.shap(foreground, background, I_map=I_map, n_jobs=n_jobs, 
+                             use_bitset=use_bitset, weights=weights, result_dtype=result_dtype)
+            return phis[inverse]
+
+        # The instances are read in place by the C++ code
+        (foreground, background), (fg_strides, bg_strides), dtype = \
+            as_kernel_input(foreground, foreground if symmetric else background)
+        if weights is not None:
+            weights = np.ascontiguousarray(weights, dtype=np.float64)
+            assert weights.shape == (background.shape[0],)
+
+        # Mapping from column to partition index
+        I_map = get_I_map(foreground.shape[1], I_map)
+        
+        # Shapes
+        n_features = np.max(I_map) + 1
+        Nx = foreground.shape[0]
+        Nz = background.shape[0]
+
+        # Where to store the output
+        results = np.zeros((Nx, n_features), dtype=result_dtype)
+
+        self.memo_stats[:] = 0
+        nodes, offsets = self.tree_arrays(dtype, closed_form=False)
+        if len(offsets) > 1:
+            self.lib.main_int_treeshap(Nx, Nz, len(offsets) - 1, foreground.shape[1], self.depth, 
+                                       foreground, fg_strides, background, bg_strides, 
+                                       None if weights is None else weights.ctypes.data, dtype,
+                                       I_map, nodes, offsets, symmetric, results, get_strides(results), 
+                                       KERNEL_DTYPES[results.dtype], self.memo_stats, self.memoize, use_bitset, n_jobs)
+
+        # Shapley values of the trees with a main effect or a single interaction
+        add_closed_form_shap(results, self.closed_form_terms(foreground, background, weights), I_map)
+        # Their (x, z, tree) triples are answered without any recursion
+        self.memo_stats[0] += Nx * Nz * np.sum(self.closed_form)
+        self.report_memo_stats()
+        return results
+
+
+    def regional_shap(self, X, labels, I_map=None, n_jobs=1, weights=None, result_dtype=np.float64):
+        """
+        Interventional Shapley values of each row of X against the rows of X in its region,
+        of shape (L, N, n_features) for L labellings, see `interventional_regional_treeshap` 
+        """
+        labels = np.asarray(labels)
+        single = labels.ndim == 1
+        labels = np.atleast_2d(labels)
+        assert labels.shape[1] == X.shape[0]
+        # Regions are numbered from zero in each labelling
+        labels = np.ascontiguousarray([np.unique(label, return_inverse=True)[1].ravel() for label in labels], 
+                                      dtype=np.int32)
+
+        # The instances are read in place by the C++ code
+        (X,), (X_strides,), dtype = as_kernel_input(X)
+        if weights is not None:
+            weights = np.ascontiguousarray(weights, dtype=np.float64)
+            assert weights.shape == (X.shape[0],)
+
+        # Shapes
+        N, d = X.shape
+        I_map = get_I_map(d, I_map)
+        n_features = np.max(I_map) + 1
+        n_labellings = labels.shape[0]
+
+        # Where to store the output
+        results = np.zeros((n_labellings, N, n_features), dtype=result_dtype)
+
+        self.memo_stats[:] = 0
+        nodes, offsets = self.tree_arrays(dtype, closed_form=False)
+        if len(offsets) > 1:
+            self.lib.main_regional_treeshap(N, len(offsets) - 1, d, self.depth, X, X_strides,
+                                            None if weights is None else weights.ctypes.data, dtype,
+                                            labels, n_labellings, I_map, nodes, offsets, 
+                                            results, get_strides(results), KERNEL_DTYPES[results.dtype], 
+                                            self.memo_stats, n_jobs)
+
+        # Shapley values of the trees with a main effect or a single interaction, region by region
+        if np.any(self.closed_form):
+            for label, regional_phis in zip(labels, results, strict=True):
+                for region in range(label.max() + 1):
+                    idx = np.where(label == region)[0]
+                    phis = np.zeros((len(idx), n_features))
+                    add_closed_form_shap(phis, self.closed_form_terms(X[idx], X[idx], 
+                                                                      None if weights is None else weights[idx]), I_map)
+                    regional_phis[idx] += phis
+        return results[0] if single else results
+
+
+    def shap_pairs(self, foreground, background, I_map=None, n_jobs=1, result_dtype=np.float64, 
+                   filename=None, memory_budget=None):
+        """
+        Shapley values of shape (Nx, Nz, n_features) of each foreground instance against each
+        single background instance, see `interventional_pair_treeshap` 
+        """
+        # The instances are read in place by the C++ code
+        (foreground, background), (fg_strides, bg_strides), dtype = as_kernel_input(foreground, background)
+
+        # Shapes
+        Nx, d = foreground.shape
+        Nz = background.shape[0]
+        I_map = get_I_map(d, I_map)
+        n_features = np.max(I_map) + 1
+        shape = (Nx, Nz, n_features)
+
+        # Where to store the output
+        if filename is None:
+            results = np.zeros(shape, dtype=result_dtype)
+            block = max(Nx, 1)
+        else:
+            results = np.lib.format.open_memmap(filename, mode="w+", dtype=result_dtype, shape=shape)
+            if memory_budget is None:
+                memory_budget = 2**28
+            # Slabs of rows are written to disk one at a time
+            itemsize = np.dtype(result_dtype).itemsize
+            block = min(max(int(memory_budget / (itemsize * Nz * n_features)), 1), max(Nx, 1))
+
+        nodes, offsets = self.tree_arrays(dtype, closed_form=False)
+        for r0 in tqdm(range(0, Nx, block), desc="Slabs", disable=filename is None):
+            rows = slice(r0, min(r0 + block, Nx))
+            slab = results[rows]
+            if len(offsets) > 1:
+                self.lib.main_pair_treeshap(slab.shape[0], Nz, len(offsets) - 1, d, self.depth, 
+                                            foreground[rows], fg_strides, background, bg_strides, dtype,
+                                            I_map, nodes, offsets, slab, get_strides(slab), 
+                                            KERNEL_DTYPES[results.dtype], n_jobs)
+            # Shapley values of the trees with a main effect or a single interaction
+            add_closed_form_shap(slab, self.closed_form_pair_terms(foreground[rows], background), I_map)
+            if filename is not None:
+                results.flush()
+        return results
+
+
+    def taylor(self, foreground, background=None, n_jobs=1, I_map=None):
+        """
+        Shapley-Taylor interactions of shape (Nx, n_features, n_features), see `interventional_taylor_treeshap`.
+        The foreground is its own background when `background` is None or the same dataset.
+        """
+        # The instances are read in place by the C++ code
+        symmetric = background is None or is_same_dataset(foreground, background)
+        (foreground, background), (fg_strides, bg_strides), dtype = \
+            as_kernel_input(foreground, foreground if symmetric else background)
+
+        # Shape properties
+        Nx = foreground.shape[0]
+        Nz = background.shape[0]
+        d = foreground.shape[1]
+        I_map = get_I_map(d, I_map)
+        n_features = np.max(I_map) + 1
+
+        # Where to store the output
+        results = np.zeros((Nx, n_features, n_features))
+
+        nodes, offsets = self.tree_arrays(dtype, closed_form=False)
+        if len(offsets) > 1:
+            self.lib.main_taylor_treeshap(Nx, Nz, len(offsets) - 1, d, self.depth, 
+                                          foreground, fg_strides, background, bg_strides, dtype,
+                                          I_map, nodes, offsets, symmetric, results, get_strides(results), 
+                                          n_jobs)
+
+        # Interactions of the trees with a main effect or a single interaction
+        add_closed_form_taylor(results, self.closed_form_terms(foreground, background), I_map)
+        return results
+
+
+    def taylor_reduce(self, foreground, background, n_jobs=1, I_map=None):
+        """
+        (Phis**2).mean(0) and Phis.sum((1, 2)), see `interventional_taylor_treeshap_reduce`.
+        All the trees go through the kernel, including those evaluated elsewhere in closed form.
+        """
+        # The instances are read in place by the C++ code
+        (foreground, background), (fg_strides, bg_strides), dtype = as_kernel_input(foreground, background)
+
+        # Shape properties
+        Nx = foreground.shape[0]
+        Nz = background.shape[0]
+        d = foreground.shape[1]
+        I_map = get_I_map(d, I_map)
+        n_features = np.max(I_map) + 1
+
+        # Where to store the output
+        results = np.zeros((n_features, n_features))
+        totals = np.zeros(Nx)
+
+        self.lib.main_taylor_treeshap_reduce(Nx, Nz, self.Nt, d, self.depth, 
+                                             foreground, fg_strides, background, bg_strides, dtype,
+                                             I_map, *self.tree_arrays(dtype), results, get_strides(results), 
+                                             totals, n_jobs)
+        return results, totals
+
+
+    def fused(self, foreground, background=None, outputs=tuple(FUSED_OUTPUTS), I_map=None, n_jobs=1):
+        """
+        Dictionary of the requested `outputs` computed in a single traversal, see 
+        `interventional_fused_treeshap`. The foreground is its own background when `background` is None.
+        """
+        # The instances are read in place by the C++ code
+        (foreground, background), (fg_strides, bg_strides), dtype = \
+            as_kernel_input(foreground, foreground if background is None else background)
+        assert set(outputs) <= set(FUSED_OUTPUTS), f"outputs must be among {list(FUSED_OUTPUTS)}"
+
+        # Shapes
+        Nx, d = foreground.shape
+        Nz = background.shape[0]
+        I_map = get_I_map(d, I_map)
+        n_features = np.max(I_map) + 1
+        shapes = {"shap" : (Nx, n_features), "taylor" : (Nx, n_features, n_features),
+                  "additive" : (Nx, Nz, n_features), "A" : (Nx, Nz)}
+
+        # Where to store the output, the arrays of the other quantities are empty
+        results = {name : np.zeros(shape if name in outputs else (0,) * len(shape)) for name, shape in shapes.items()}
+        bitmask = sum(FUSED_OUTPUTS[name] for name in set(outputs))
+
+        nodes, offsets = self.tree_arrays(dtype, closed_form=False)
+        if len(offsets) > 1:
+            self.lib.main_fused_treeshap(Nx, Nz, len(offsets) - 1, d, self.depth, 
+                                         foreground, fg_strides, background, bg_strides, dtype,
+                                         I_map, nodes, offsets, bitmask,
+                                         *[arg for name in FUSED_OUTPUTS for arg in (results[name], get_strides(results[name]))],
+                                         n_jobs)
+        results["A"] += self.ensemble.base_offset[-1]
+
+        # Trees with a main effect or a single interaction
+        if "shap" in outputs:
+            add_closed_form_shap(results["shap"], self.closed_form_terms(foreground, background), I_map)
+        if "taylor" in outputs:
+            add_closed_form_taylor(results["taylor"], self.closed_form_terms(foreground, background), I_map)
+        if "additive" in outputs:
+            add_closed_form_additive(results["additive"], self.closed_form_pair_terms(foreground, background), 
+                                     I_map, get_feature_columns(n_features))
+        if "A" in outputs:
+            add_closed_form_A(results["A"], self.closed_form_pair_terms(foreground, background), I_map)
+            results["A"] += self.closed_form_constant
+        return {name : results[name] for name in outputs}
+
+
+    def additive(self, X, n_jobs=1, out=None, use_bitset=False, deduplicate=False, result_dtype=np.float64,
+                 background=None, features=None, rest=False, I_map=None):
+        """
+        Additive terms H[..., 1:] of shape (N, N, d), or (N, Nz, d) against a `background` 
+        of Nz instances, see `interventional_additive_treeshap` 
+        """
+        N = X.shape[0]
+        Nz = N if background is None else background.shape[0]
+        n_features = np.max(get_I_map(X.shape[1], I_map)) + 1
+        n_columns = get_feature_columns(n_features, features, rest).max() + 1
+
+        # Where to store the output
+        if out is None:
+            results = np.zeros((N, Nz, n_columns), dtype=result_dtype)
+        else:
+            assert out.shape == (N, Nz, n_columns) and out.dtype in KERNEL_DTYPES
+            results = out
+        # No additive term is requested, e.g. the partitions fitted on f(z) alone
+        if n_columns == 0:
+            return results
+        
+        # Only the pairs of distinct rows are computed
+        if deduplicate:
+            X_unique, _, inverse = self.deduplicate(X)
+            if background is None:
+                Z_unique, inverse_z = None, inverse
+            else:
+                Z_unique, _, inverse_z = self.deduplicate(background)
+            results[...] = self.additive(X_unique, n_jobs=n_jobs, use_bitset=use_bitset,
+                                         result_dtype=results.dtype, background=Z_unique,
+                                         features=features, rest=rest, I_map=I_map)[np.ix_(inverse, inverse_z)]
+            return results
+
+        # The whole tensor is a single block
+        self.memo_stats[:] = 0
+        self.additive_block(X, (0, N), (0, Nz), results, results, n_jobs, use_bitset, background, 
+                            features, rest, I_map)
+        self.report_memo_stats()
+        return results
+
+
+    def additive_block(self, X, rows, cols, out_rows, out_cols, n_jobs=1, use_bitset=False, background=None,
+                       features=None, rest=False, I_map=None):
+        """
+        Compute a block of the tensor H[..., 1:]. The pairs (i, j) with j > i, i in the range
+        `rows` and j in the range `cols` are computed. H[i, j, 1:] is added to `out_rows[i-rows[0], j-cols[0]]`
+        and H[j, i, 1:] to `out_cols[j-cols[0], i-rows[0]]`. Both outputs are the same array for blocks
+        on the diagonal.
+
+        Parameters
+        ----------
+        X : numpy.array or pandas.DataFrame
+            The dataset used both as foreground and background.
+
+        rows, cols : Tuple(int, int)
+            Start and end indices of the rows and columns of the block.
+
+        out_rows : numpy.array
+            Array of shape (rows[1]-rows[0], cols[1]-cols[0], d) of dtype float64 or float32,
+            where d is the number of columns requested by `features` and `rest`.
+
+        out_cols : numpy.array
+            Array of shape (cols[1]-cols[0], rows[1]-rows[0], d) with the same dtype as `out_rows`.
+
+        n_jobs : int, default=1
+            Number of threads used by the C++ kernel.
+
+        use_bitset : bool, default=False
+            Push all the columns of the block through each tree at once as a bitset
+            instead of traversing the trees once per pair (i, j).
+
+        background : numpy.array or pandas.DataFrame, default=None
+            When given, the columns of the block index the rows of this dataset instead of X.
+            All the pairs (i, j) of the block are then computed and `out_cols` is ignored.
+
+        features : List(int), default=None
+            Indices of the features whose terms are stored, all of them when None.
+
+        rest : bool, default=False
+            Store the sum of the terms of the other features in a last column.
+
+        I_map : List(int), default=None
+            Mapping from column to feature, see `interventional_treeshap`.
+
+        The counts of the memoized pairs of the block are added to `memo_stats`.
+        """
+        # The instances are read in place by the C++ code
+        symmetric = background is None
+        (X, Z), (X_strides, Z_strides), dtype = as_kernel_input(X, X if symmetric else background)
+
+        # Shape properties
+        N, d = X.shape
+        Nz = Z.shape[0]
+        I_map = get_I_map(d, I_map)
+        columns = get_feature_columns(np.max(I_map) + 1, features, rest)
+        n_columns = columns.max() + 1
+        assert out_rows.shape == (rows[1]-rows[0], cols[1]-cols[0], n_columns) and out_rows.dtype in KERNEL_DTYPES
+        if symmetric:
+            assert out_cols.shape == (cols[1]-cols[0], rows[1]-rows[0], n_columns) and \
+                   out_cols.dtype == out_rows.dtype
+        else:
+            out_cols = out_rows
+
+        nodes, offsets = self.tree_arrays(dtype, closed_form=False)
+        if len(offsets) > 1:
+            self.lib.main_additive_treeshap(N, Nz, len(offsets) - 1, d, self.depth, X, X_strides, Z, Z_strides, 
+                                            dtype, I_map, nodes, offsets, rows[0], rows[1], cols[0], cols[1],
+                                            symmetric, columns, out_rows, get_strides(out_rows), 
+                                            out_cols, get_strides(out_cols), KERNEL_DTYPES[out_rows.dtype],
+                                            self.memo_stats, self.memoize, use_bitset, n_jobs)
+
+        # Additive terms of the trees with a main effect or a single interaction
+        X_rows, Z_cols = X[rows[0]:rows[1]], Z[cols[0]:cols[1]]
+        if symmetric:
+            # Only the pairs j > i are added, as by the kernel
+            pairs = np.arange(cols[0], cols[1]).reshape((1, -1)) > np.arange(rows[0], rows[1]).reshape((-1, 1))
+            add_closed_form_additive(out_rows, self.closed_form_pair_terms(X_rows, Z_cols), I_map, columns, pairs)
+            add_closed_form_additive(out_cols, self.closed_form_pair_terms(Z_cols, X_rows), I_map, columns, pairs.T)
+            n_pairs = pairs.sum()
+        else:
+            add_closed_form_additive(out_rows, self.closed_form_pair_terms(X_rows, Z_cols), I_map, columns)
+            n_pairs = X_rows.shape[0] * Z_cols.shape[0]
+        # Their (x, z, tree) triples are answered without any recursion
+        self.memo_stats[0] += n_pairs * np.sum(self.closed_form)
+
+
+    def additive_reduce(self, X, n_jobs=1, I_map=None):
+        """ Row and column means of H[..., 1:], see `interventional_additive_treeshap_reduce` """
+        # The instances are read in place by the C++ code
+        (X,), (X_strides,), dtype = as_kernel_input(X)
+
+        # Shape properties
+        N, d = X.shape
+        I_map = get_I_map(d, I_map)
+        n_features = np.max(I_map) + 1
+
+        # Where to store the output
+        row_means = np.zeros((N, n_features))
+        col_means = np.zeros((N, n_features))
+
+        nodes, offsets = self.tree_arrays(dtype, closed_form=False)
+        if len(offsets) > 1:
+            self.lib.main_additive_treeshap_reduce(N, len(offsets) - 1, d, self.depth, X, X_strides, dtype,
+                                                   I_map, nodes, offsets, 
+                                                   row_means, get_strides(row_means),
+                                                   col_means, get_strides(col_means), n_jobs)
+
+        # Trees with a main effect or a single interaction, the mean over the foreground of the 
+        # terms at z is read from the terms of z seen as a foreground instance
+        for (a, b), f_x, f_xa_zb, f_za_xb, f_z in self.closed_form_terms(X, X):
+            i, j = I_map[a], I_map[b]
+            if i == j:
+                row_means[:, i] += f_x - f_z
+                col_means[:, i] += f_z - f_x
+            else:
+                row_means[:, i] += f_xa_zb - f_z
+                row_means[:, j] += f_za_xb - f_z
+                col_means[:, i] += f_za_xb - f_x
+                col_means[:, j] += f_xa_zb - f_x
+        return row_means, col_means
+
+
+    def H(self, X, task, logit=False, n_jobs=1, filename=None, memory_budget=None, use_bitset=False,
+          deduplicate=False, codes=None, result_dtype=np.float64, background=None, features=None, rest=False,
+          I_map=None):
+        """
+        The tensor H of shape (N, N, D+1), or (N, Nz, D+1) against a `background` of Nz instances,
+        where D is the number of columns requested by `features` and `rest`, see `get_ANOVA_1_tree`.
+        The model is evaluated on X while the kernels read `codes = self.encode(X)` instead of X
+        when it is given, the background is then encoded the same way.
+        """
+        f = get_black_box(self.model, task, logit)
+        n_features = np.max(get_I_map(X.shape[1], I_map)) + 1
+        N, D = X.shape[0], get_feature_columns(n_features, features, rest).max() + 1
+        f_X = f(X)
+        if codes is None:
+            codes = X
+            bg_codes = background
+        else:
+            bg_codes = None if background is None else self.encode(background)
+        symmetric = background is None
+        Nz = N if symmetric else background.shape[0]
+        f_Z = f_X if symmetric else f(background)
+        itemsize = np.dtype(result_dtype).itemsize
+        if filename is None:
+            H = np.zeros((N, Nz, D+1), dtype=result_dtype)
+            H[..., 0] += f_Z.reshape((1, -1))
+            # The additive terms are written directly in H
+            self.additive(codes, n_jobs=n_jobs, out=H[..., 1:], use_bitset=use_bitset, deduplicate=deduplicate,
+                          background=bg_codes, features=features, rest=rest, I_map=I_map)
+        else:
+            H = np.lib.format.open_memmap(filename, mode="w+", dtype=result_dtype, shape=(N, Nz, D+1))
+            if memory_budget is None:
+                memory_budget = 2**28
+            if D == 0:
+                # Only f(z_j) is stored, the kernels have nothing to compute
+                H[..., 0] = f_Z.reshape((1, -1))
+                H.flush()
+            elif deduplicate:
+                # The tensor of the distinct rows is held in RAM and expanded by slabs of rows
+                X_unique, _, inverse = self.deduplicate(codes)
+                if symmetric:
+                    Z_unique, inverse_z = None, inverse
+                else:
+                    Z_unique, _, inverse_z = self.deduplicate(bg_codes)
+                H_unique = self.additive(X_unique, n_jobs=n_jobs, use_bitset=use_bitset, 
+                                         result_dtype=result_dtype, background=Z_unique,
+                                         features=features, rest=rest, I_map=I_map)
+                block = min(max(int(memory_budget / (itemsize * Nz * max(D, 1))), 1), N)
+                for r0 in tqdm(range(0, N, block), desc="Slabs"):
+                    rows = slice(r0, min(r0 + block, N))
+                    H[rows, :, 0] = f_Z.reshape((1, -1))
+                    H[rows, :, 1:] = H_unique[np.ix_(inverse[rows], inverse_z)]
+                H.flush()
+            else:
+                # Two tiles of shape (B, B, D) are held in RAM at once, a single one against a background
+                block = int(np.sqrt(memory_budget / ((2 if symmetric else 1) * itemsize * max(D, 1))))
+                block = min(max(block, 1), max(N, Nz))
+                self.memo_stats[:] = 0
+
+                for r0 in tqdm(range(0, N, block), desc="Tiles"):
+                    rows = (r0, min(r0 + block, N))
+                    # Only the upper triangle of tiles is computed when H[cols, rows] comes for free
+                    for c0 in range(r0 if symmetric else 0, Nz, block):
+                        cols = (c0, min(c0 + block, Nz))
+                        tile_rc = np.zeros((rows[1]-rows[0], cols[1]-cols[0], D), dtype=result_dtype)
+                        tile_cr = tile_rc if r0 == c0 or not symmetric else \
+                                  np.zeros((cols[1]-cols[0], rows[1]-rows[0], D), dtype=result_dtype)
+                        self.additive_block(codes, rows, cols, tile_rc, tile_cr, n_jobs, use_bitset, bg_codes,
+                                            features, rest, I_map)
+                        H[rows[0]:rows[1], cols[0]:cols[1], 0] = f_Z[cols[0]:cols[1]].reshape((1, -1))
+                        H[rows[0]:rows[1], cols[0]:cols[1], 1:] = tile_rc
+                        if r0 != c0 and symmetric:
+                            H[cols[0]:cols[1], rows[0]:rows[1], 0] = f_X[rows[0]:rows[1]].reshape((1, -1))
+                            H[cols[0]:cols[1], rows[0]:rows[1], 1:] = tile_cr
+                    H.flush()
+                self.report_memo_stats()
+        
+        # Sanity Checks : Diagonal elements should be equal to f(x)
+        if symmetric and (features is None or rest):
+            assert np.isclose(H[np.arange(N), np.arange(N)].sum(-1), f_X).all()
+        return H
+
+
+    def H_reduce(self, X, task, logit=False, n_jobs=1, codes=None, I_map=None):
+        """ PDP, PFI and non-additivity without storing H, see `get_ANOVA_1_tree_reduce` """
+        f_X = get_black_box(self.model, task, logit)(X)
+        pdp, E_remove_i = self.additive_reduce(X if codes is None else codes, n_jobs=n_jobs, I_map=I_map)
+        I_PFI = np.mean(E_remove_i**2, axis=0)
+        # The rows of H sum to f(x_j) + sum_k H[i, j, k+1]
+        non_additivity = np.mean((f_X - f_X.mean() - pdp.sum(1))**2)
+        return pdp, I_PFI, non_additivity
+
+
+    def A(self, X, use_stack=False, n_jobs=1, deduplicate=False, result_dtype=np.float64, background=None,
+          I_map=None):
+        """ The matrix A of shape (N, N), or (N, Nz) against a `background`, see `get_Hadd__treeshap` """
+        symmetric = background is None
+        if deduplicate:
+            X_unique, _, inverse = self.deduplicate(X)
+            if symmetric:
+                Z_unique, inverse_z = None, inverse
+            else:
+                Z_unique, _, inverse_z = self.deduplicate(background)
+            return self.A(X_unique, use_stack=use_stack, n_jobs=n_jobs, result_dtype=result_dtype,
+                          background=Z_unique, I_map=I_map)[np.ix_(inverse, inverse_z)]
+
+        # The instances are read in place by the C++ code
+        (X, Z), (X_strides, Z_strides), dtype = as_kernel_input(X, X if symmetric else background)
+
+        # Shape properties
+        N, d = X.shape
+        Nz = Z.shape[0]
+        I_map = get_I_map(d, I_map)
+
+        # Where to store the output
+        results = np.zeros((N, Nz), dtype=result_dtype)
+
+        self.memo_stats[:] = 0
+        nodes, offsets = self.tree_arrays(dtype, closed_form=False)
+        if len(offsets) > 1:
+            self.lib.main_A_treeshap(N, Nz, len(offsets) - 1, d, self.depth, X, X_strides, Z, Z_strides, dtype,
+                                     I_map, nodes, offsets, symmetric, results, get_strides(results), 
+                                     KERNEL_DTYPES[results.dtype], self.memo_stats, self.memoize, use_stack, n_jobs)
+
+        # Trees with a main effect or a single interaction, their triples need no recursion
+        add_closed_form_A(results, self.closed_form_pair_terms(X, Z), I_map)
+        results += self.closed_form_constant
+        self.memo_stats[0] += (N * (N+1) // 2 if symmetric else N * Nz) * np.sum(self.closed_form)
+        self.report_memo_stats()
+        results += self.ensemble.base_offset[-1]
+        return results
+
+
+
+def interventional_treeshap(model, foreground, background, I_map=None, n_jobs=1, use_bitset=False,
+                            weights=None, deduplicate=False, result_dtype=np.float64):
     """ 
     Compute the Interventional Shapley Values with the TreeSHAP algorithm
 
@@ -101,6 +1119,8 @@ def interventional_treeshap(model, foreground, background, I_map=None):
 
     background : numpy.array or pandas.DataFrame
         The background dataset to use for integrating out missing features in the coallitional game.
+        When it is the foreground dataset itself, each unordered pair of instances is traversed once
+        since the Shapley values of x against z are the opposite of those of z against x.
 
     I_map : List(int), default=None
         A mapping from column to high-level feature. This is useful when feature are one-hot-encoded
@@ -108,246 +1128,329 @@ def interventional_treeshap(model, foreground, background, I_map=None):
         `I_map = [0, 1, 2, 2, 2]` treats the last three columns as an encoding of the same feature. 
         Therefore we would return 3 Shapley values. Setting `I_map`
         to None will yield one Shapley value per column.
+
+    n_jobs : int, default=1
+        Number of threads used by the C++ kernel. The foreground instances are shared
+        among the threads, or the trees when there are fewer foreground instances than threads,
+        and `n_jobs=-1` uses all cores. The sums are carried out in an order that does not
+        depend on the threads, so the results are identical to the serial run.
+
+    use_bitset : bool, default=False
+        Push the whole background through each tree at once as a bitset of the instances
+        going left, instead of traversing the trees once per (foreground, background) pair.
+        This is faster for large backgrounds and equal up to rounding errors.
+
+    weights : numpy.array, default=None
+        Array of shape (Nz,) with the multiplicity of each background instance. The Shapley
+        values are then averaged over the background with these weights.
+
+    deduplicate : bool, default=False
+        Collapse the foreground and background rows that take the same branches in all trees,
+        see `TreeANOVA.deduplicate`. The background becomes weighted by the size of each group,
+        or by the sum of the `weights` of its rows, and the Shapley values are returned in the
+        original order of the foreground.
+
+    result_dtype : numpy.dtype, default=np.float64
+        Element type of the returned Shapley values, either float64 or float32. The sums over
+        trees and background instances are carried out in double precision in both cases.
     """
+    explainer = TreeANOVA(model, background)
+    phis = explainer.shap(foreground, background, I_map=I_map, n_jobs=n_jobs, use_bitset=use_bitset,
+                          weights=weights, deduplicate=deduplicate, result_dtype=result_dtype)
+    return phis, explainer.ensemble
 
-    # Extract tree structure with the SHAP API
-    ensemble = Tree(model, data=background).model
-    
-    # All numpy arrays must be C_CONTIGUOUS
-    assert ensemble.thresholds.flags['C_CONTIGUOUS']
-    assert ensemble.features.flags['C_CONTIGUOUS']
-    assert ensemble.children_left.flags['C_CONTIGUOUS']
-    assert ensemble.children_right.flags['C_CONTIGUOUS']
-
-    # All arrays must be C-Contiguous and DataFrames are not.
-    if type(foreground) == pd.DataFrame:
-        foreground = np.ascontiguousarray(foreground)
-    if type(background) == pd.DataFrame:
-        background = np.ascontiguousarray(background)
-
-    # Mapping from column to partition index
-    if I_map is None:
-        I_map = np.arange(foreground.shape[1]).astype(np.int32)
-    else:
-        I_map = I_map.astype(np.int32)
-    
-    # Shapes
-    Nt = ensemble.features.shape[0]
-    n_features = np.max(I_map) + 1
-    depth = ensemble.features.shape[1]
-    Nx = foreground.shape[0]
-    Nz = background.shape[0]
 
-    # Values at each leaf
-    values = np.ascontiguousarray(ensemble.values[..., -1])
 
-    # Where to store the output
-    results = np.zeros((Nx, n_features))
+def interventional_regional_treeshap(model, X, labels, I_map=None, n_jobs=1, weights=None, 
+                                     result_dtype=np.float64):
+    """ 
+    Compute the Interventional Shapley Values of each instance of X with the instances of X
+    in the same region as background, for one or several partitions of X at once
 
-    ####### Wrap C / Python #######
+    Parameters
+    ----------
+    model : model_object
+        The tree based machine learning model that we want to explain.
 
-    # Find the shared library, the path depends on the platform and Python version    
-    project_root = os.path.dirname(__file__).split('src')[0]
-    libfile = glob.glob(os.path.join(project_root, 'build', '*', 'treeshap*.so'))[0]
+    X : numpy.array or pandas.DataFrame
+        The dataset of N instances, used both as foreground and background.
 
-    # Open the shared library
-    mylib = ctypes.CDLL(libfile)
+    labels : numpy.array
+        Array of shape (N,) with the region of each instance, or of shape (L, N) for L
+        partitions such as the leaves of FD-Trees of increasing depths. Only the pairs of
+        instances sharing a region in at least one partition are traversed, once for all
+        the partitions that they share.
 
-    # Tell Python the argument and result types of function main_treeshap
-    mylib.main_int_treeshap.restype = ctypes.c_int
-    mylib.main_int_treeshap.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int, 
-                                        ctypes.c_int, ctypes.c_int,
-                                        np.ctypeslib.ndpointer(dtype=np.float64),
-                                        np.ctypeslib.ndpointer(dtype=np.float64),
-                                        np.ctypeslib.ndpointer(dtype=np.int32),
-                                        np.ctypeslib.ndpointer(dtype=np.float64),
-                                        np.ctypeslib.ndpointer(dtype=np.float64),
-                                        np.ctypeslib.ndpointer(dtype=np.int32),
-                                        np.ctypeslib.ndpointer(dtype=np.int32),
-                                        np.ctypeslib.ndpointer(dtype=np.int32),
-                                        np.ctypeslib.ndpointer(dtype=np.float64)]
+    I_map : List(int), default=None
+        Mapping from column to feature, see `interventional_treeshap`.
 
-    # 3. call function mysum
-    mylib.main_int_treeshap(Nx, Nz, Nt, foreground.shape[1], depth, foreground, background, 
-                            I_map, ensemble.thresholds, values,
-                            ensemble.features, ensemble.children_left, 
-                            ensemble.children_right, results)
+    n_jobs : int, default=1
+        Number of threads used by the C++ kernel.
 
-    return results, ensemble
+    weights : numpy.array, default=None
+        Array of shape (N,) with the multiplicity of each instance as background.
 
+    result_dtype : numpy.dtype, default=np.float64
+        Element type of the returned Shapley values, either float64 or float32.
 
+    Returns
+    -------
+    phis : numpy.array
+        Array of shape (N, n_features), or (L, N, n_features) for L partitions, where 
+        `phis[l][labels[l] == r]` equals `interventional_treeshap(model, X_r, X_r)` 
+        with `X_r = X[labels[l] == r]`.
+    """
+    explainer = TreeANOVA(model, X)
+    return explainer.regional_shap(X, labels, I_map=I_map, n_jobs=n_jobs, weights=weights, 
+                                   result_dtype=result_dtype)
 
 
-def interventional_taylor_treeshap(model, foreground, background):
-    
-    # Extract tree structure with the SHAP API
-    ensemble = Tree(model, data=background).model
-    
-    # All numpy arrays must be C_CONTIGUOUS
-    assert ensemble.thresholds.flags['C_CONTIGUOUS']
-    assert ensemble.features.flags['C_CONTIGUOUS']
-    assert ensemble.children_left.flags['C_CONTIGUOUS']
-    assert ensemble.children_right.flags['C_CONTIGUOUS']
-
-    values = np.ascontiguousarray(ensemble.values[..., -1])
-    if type(foreground) == pd.DataFrame:
-        foreground = np.ascontiguousarray(foreground).astype(np.float64)
-    if type(background) == pd.DataFrame:
-        background = np.ascontiguousarray(background).astype(np.float64)
-    foreground = foreground.astype(np.float64)
-    background = background.astype(np.float64)
-
-    # Shape properties
-    Nx = foreground.shape[0]
-    Nz = background.shape[0]
-    Nt = ensemble.features.shape[0]
-    d = foreground.shape[1]
-    depth = ensemble.features.shape[1]
-
-    # Where to store the output
-    results = np.zeros((Nx, d, d))
-
-    ####### Wrap C / Python #######
 
-    # Find the shared library, the path depends on the platform and Python version    
-    project_root = os.path.dirname(__file__).split('src')[0]
-    libfile = glob.glob(os.path.join(project_root, 'build', '*', 'treeshap*.so'))[0]
+def interventional_pair_treeshap(model, foreground, background, I_map=None, n_jobs=1, result_dtype=np.float64,
+                                 filename=None, memory_budget=None):
+    """ 
+    Compute the Interventional Shapley Values of each foreground instance against each single
+    background instance, so that the Shapley values against any weighting or subset of the 
+    background are a reduction of this tensor, see `get_regional_shap`
 
-    # Open the shared library
-    mylib = ctypes.CDLL(libfile)
+    Parameters
+    ----------
+    model : model_object
+        The tree based machine learning model that we want to explain.
 
-    # Tell Python the argument and result types of function main_treeshap
-    mylib.main_taylor_treeshap.restype = ctypes.c_int
-    mylib.main_taylor_treeshap.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int, 
-                                    ctypes.c_int, ctypes.c_int,
-                                    np.ctypeslib.ndpointer(dtype=np.float64),
-                                    np.ctypeslib.ndpointer(dtype=np.float64),
-                                    np.ctypeslib.ndpointer(dtype=np.float64),
-                                    np.ctypeslib.ndpointer(dtype=np.float64),
-                                    np.ctypeslib.ndpointer(dtype=np.int32),
-                                    np.ctypeslib.ndpointer(dtype=np.int32),
-                                    np.ctypeslib.ndpointer(dtype=np.int32),
-                                    np.ctypeslib.ndpointer(dtype=np.float64)]
+    foreground : numpy.array or pandas.DataFrame
+        The Nx instances whose prediction we wish to explain.
 
-    # 3. call function mysum
-    mylib.main_taylor_treeshap(Nx, Nz, Nt, d, depth, foreground, background, 
-                                ensemble.thresholds, values,
-                                ensemble.features, ensemble.children_left, 
-                                ensemble.children_right, results)
+    background : numpy.array or pandas.DataFrame
+        The Nz instances against which they are explained.
 
-    return results, ensemble
+    I_map : List(int), default=None
+        Mapping from column to feature, see `interventional_treeshap`.
 
+    n_jobs : int, default=1
+        Number of threads used by the C++ kernel.
 
+    result_dtype : numpy.dtype, default=np.float64
+        Element type of the results, either float64 or float32. The sums over
+        trees are carried out in double precision in both cases.
 
+    filename : str, default=None
+        When given, the tensor is written to a memory-mapped .npy file by slabs of rows
+        whose size stays under `memory_budget` bytes (256MB by default).
 
+    Returns
+    -------
+    Phis : numpy.array
+        Array of shape (Nx, Nz, n_features) such that `Phis.mean(1)` equals
+        `interventional_treeshap(model, foreground, background)`.
+    """
+    explainer = TreeANOVA(model, background)
+    return explainer.shap_pairs(foreground, background, I_map=I_map, n_jobs=n_jobs, result_dtype=result_dtype,
+                                filename=filename, memory_budget=memory_budget)
 
-def interventional_additive_treeshap(model, X):
-    
-    # Extract tree structure with the SHAP API
-    ensemble = Tree(model, data=X).model
-    
-    # All numpy arrays must be C_CONTIGUOUS
-    assert ensemble.thresholds.flags['C_CONTIGUOUS']
-    assert ensemble.features.flags['C_CONTIGUOUS']
-    assert ensemble.children_left.flags['C_CONTIGUOUS']
-    assert ensemble.children_right.flags['C_CONTIGUOUS']
 
-    values = np.ascontiguousarray(ensemble.values[..., -1])
-    if type(X) == pd.DataFrame:
-        X = np.ascontiguousarray(X).astype(np.float64)
-    X = X.astype(np.float64)
 
-    # Shape properties
-    N, d = X.shape
-    Nt = ensemble.features.shape[0]
-    depth = ensemble.features.shape[1]
+def get_regional_shap(Phis, labels=None, weights=None, background_labels=None):
+    """ 
+    Shapley values against a region of the background computed from the tensor 
+    `Phis = interventional_pair_treeshap(model, foreground, background)` without traversing the trees
 
-    # Where to store the output
-    results = np.zeros((N, N, d))
+    Parameters
+    ----------
+    Phis : numpy.array
+        Array of shape (Nx, Nz, n_features), it can be memory-mapped.
 
-    ####### Wrap C / Python #######
+    labels : numpy.array, default=None
+        Array of shape (Nx,) with the region of each foreground instance, or of shape (L, Nx) for
+        L partitions. Each instance is explained against the background instances in its region.
+        The whole background is used when None.
 
-    # Find the shared library, the path depends on the platform and Python version    
-    project_root = os.path.dirname(__file__).split('src')[0]
-    libfile = glob.glob(os.path.join(project_root, 'build', '*', 'treeshap*.so'))[0]
+    weights : numpy.array, default=None
+        Array of shape (Nz,) with the weight of each background instance.
 
-    # Open the shared library
-    mylib = ctypes.CDLL(libfile)
+    background_labels : numpy.array, default=None
+        The regions of the background instances, of shape (Nz,) or (L, Nz). The `labels` are
+        used when None, in which case the foreground and background must be the same instances.
 
-    # Tell Python the argument and result types of function main_treeshap
-    mylib.main_additive_treeshap.restype = ctypes.c_int
-    mylib.main_additive_treeshap.argtypes = [ctypes.c_int, ctypes.c_int,
-                                    ctypes.c_int, ctypes.c_int,
-                                    np.ctypeslib.ndpointer(dtype=np.float64),
-                                    np.ctypeslib.ndpointer(dtype=np.float64),
-                                    np.ctypeslib.ndpointer(dtype=np.float64),
-                                    np.ctypeslib.ndpointer(dtype=np.int32),
-                                    np.ctypeslib.ndpointer(dtype=np.int32),
-                                    np.ctypeslib.ndpointer(dtype=np.int32),
-                                    np.ctypeslib.ndpointer(dtype=np.float64)]
+    Returns
+    -------
+    phis : numpy.array
+        Array of shape (Nx, n_features), or (L, Nx, n_features) for L partitions.
+    """
+    Nx, Nz, n_features = Phis.shape
+    weights = np.ones(Nz) if weights is None else np.asarray(weights, dtype=np.float64)
+    if labels is None:
+        labels, background_labels = np.zeros(Nx, dtype=int), np.zeros(Nz, dtype=int)
+    labels = np.asarray(labels)
+    single = labels.ndim == 1
+    labels = np.atleast_2d(labels)
+    background_labels = labels if background_labels is None else np.atleast_2d(background_labels)
+    assert labels.shape[1] == Nx and background_labels.shape == (labels.shape[0], Nz)
 
-    # 3. call function mysum
-    mylib.main_additive_treeshap(N, Nt, d, depth, X,
-                                ensemble.thresholds, values,
-                                ensemble.features, ensemble.children_left, 
-                                ensemble.children_right, results)
+    # The rows of Phis are reduced by slabs, the sums being in double precision
+    phis = np.zeros((labels.shape[0], Nx, n_features))
+    block = min(max(2**24 // max(Nz * n_features, 1), 1), max(Nx, 1))
+    for r0 in range(0, Nx, block):
+        rows = slice(r0, min(r0 + block, Nx))
+        Phis_rows = np.asarray(Phis[rows])
+        for k in range(labels.shape[0]):
+            mask = (labels[k, rows, None] == background_labels[k, None, :]) * weights
+            phis[k, rows] = np.einsum('ij,ijk->ik', mask, Phis_rows) / mask.sum(1, keepdims=True)
+    return phis[0] if single else phis
 
-    return results
 
 
+def interventional_taylor_treeshap(model, foreground, background, n_jobs=1, I_map=None):
+    explainer = TreeANOVA(model, background)
+    return explainer.taylor(foreground, background, n_jobs=n_jobs, I_map=I_map), explainer.ensemble
 
 
 
-def get_Hadd__treeshap(model, X, use_stack=False):
-    
-    # Extract tree structure with the SHAP API
-    ensemble = Tree(model, data=X).model
-    
-    # All numpy arrays must be C_CONTIGUOUS
-    assert ensemble.thresholds.flags['C_CONTIGUOUS']
-    assert ensemble.features.flags['C_CONTIGUOUS']
-    assert ensemble.children_left.flags['C_CONTIGUOUS']
-    assert ensemble.children_right.flags['C_CONTIGUOUS']
+def interventional_fused_treeshap(model, foreground, background=None, outputs=tuple(FUSED_OUTPUTS), 
+                                  I_map=None, n_jobs=1):
+    """ 
+    Compute several explanations of the same foreground and background with a single traversal 
+    of each tree for each pair of instances. The leaves update all the requested quantities from
+    the same coalitions, so each extra quantity costs a few operations per leaf instead of a new
+    pass over the ensemble.
 
-    values = np.ascontiguousarray(ensemble.values[..., -1])
-    if type(X) == pd.DataFrame:
-        X = np.ascontiguousarray(X).astype(np.float64)
-    X = X.astype(np.float64)
+    Parameters
+    ----------
+    model : model_object
+        The tree based machine learning model that we want to explain.
 
-    # Shape properties
-    N, d = X.shape
-    Nt = ensemble.features.shape[0]
-    depth = ensemble.features.shape[1]
+    foreground : numpy.array or pandas.DataFrame
+        The Nx instances whose prediction we wish to explain.
 
-    # Where to store the output
-    results = np.zeros((N, N))
+    background : numpy.array or pandas.DataFrame, default=None
+        The Nz instances against which they are explained, the foreground when None.
 
-    ####### Wrap C / Python #######
+    outputs : List(str), default=("shap", "taylor", "additive", "A")
+        The quantities to compute among
 
-    # Find the shared library, the path depends on the platform and Python version    
-    project_root = os.path.dirname(__file__).split('src')[0]
-    libfile = glob.glob(os.path.join(project_root, 'build', '*', 'treeshap*.so'))[0]
+        - "shap" : array of shape (Nx, d) equal to `interventional_treeshap(model, foreground, background)[0]`
+        - "taylor" : array of shape (Nx, d, d) equal to `interventional_taylor_treeshap(model, foreground, background)[0]`
+        - "additive" : array of shape (Nx, Nz, d) equal to `H[..., 1:]` with H given by `get_ANOVA_1_tree`
+        - "A" : array of shape (Nx, Nz) equal to `get_Hadd__treeshap(model, foreground, background=background)`
+
+        The branches that only lead to zero additive terms are pruned when neither "shap" nor "taylor" is requested.
+
+    I_map : List(int), default=None
+        Mapping from column to feature, see `interventional_treeshap`. d is then the number of features.
+
+    n_jobs : int, default=1
+        Number of threads used by the C++ kernel.
+
+    Returns
+    -------
+    results : dict
+        The arrays of the requested `outputs`.
+    """
+    explainer = TreeANOVA(model, foreground if background is None else background)
+    return explainer.fused(foreground, background, outputs=outputs, I_map=I_map, n_jobs=n_jobs)
+
+
+
+def interventional_taylor_treeshap_reduce(model, foreground, background, n_jobs=1, I_map=None):
+    """ 
+    Compute (Phis**2).mean(0) and Phis.sum((1, 2)) of the Shapley-Taylor interactions 
+    Phis = interventional_taylor_treeshap(model, foreground, background) without storing Phis.
+
+    Returns
+    -------
+    phi2_mean : numpy.array
+        Array of shape (d, d) with the mean squared interactions.
+
+    totals : numpy.array
+        Array of shape (Nx,) with the sum of all interactions of each foreground instance.
+    """
+    explainer = TreeANOVA(model, background)
+    return explainer.taylor_reduce(foreground, background, n_jobs=n_jobs, I_map=I_map)
+
+
+
+def interventional_additive_treeshap(model, X, n_jobs=1, out=None, use_bitset=False, deduplicate=False,
+                                     result_dtype=np.float64, background=None, features=None, rest=False,
+                                     I_map=None):
+    """ 
+    Compute the additive terms H[..., 1:] of the ANOVA-1 decomposition with the TreeSHAP algorithm
+
+    Parameters
+    ----------
+    model : model_object
+        The tree based machine learning model that we want to explain.
+
+    X : numpy.array or pandas.DataFrame
+        The dataset used both as foreground and background, or only as foreground
+        when `background` is given.
+
+    n_jobs : int, default=1
+        Number of threads used by the C++ kernel.
+
+    out : numpy.array, default=None
+        Array of shape (N, N, d), or (N, Nz, d) when `background` is given, where the results 
+        are written, it can be a strided view of a larger array such as `H[..., 1:]`. A new array
+        is allocated when None. Its dtype, float64 or float32, takes precedence over `result_dtype`.
+        Its last dimension is the number of columns requested by `features` and `rest`.
+
+    use_bitset : bool, default=False
+        Push all the background instances through each tree at once as a bitset,
+        see `interventional_treeshap`.
+
+    deduplicate : bool, default=False
+        Only compute the pairs of rows that are distinct for the ensemble,
+        see `TreeANOVA.deduplicate`, and expand them back to the order of X.
+
+    result_dtype : numpy.dtype, default=np.float64
+        Element type of the results, either float64 or float32. The sums over
+        trees are carried out in double precision in both cases.
+
+    background : numpy.array or pandas.DataFrame, default=None
+        A dataset of Nz instances against which X is explained. All the N x Nz pairs are then 
+        computed, while only the pairs with j > i are traversed when X is its own background.
+
+    features : List(int), default=None
+        Indices of the features whose additive terms are returned, in this order. All the
+        d features are returned when None.
+
+    rest : bool, default=False
+        Append a column with the sum of the additive terms of the features not in `features`.
+
+    I_map : List(int), default=None
+        Mapping from column to feature, see `interventional_treeshap`. The additive terms
+        are then those of the groups of columns and `features` indexes the groups.
+    """
+    explainer = TreeANOVA(model, X)
+    return explainer.additive(X, n_jobs=n_jobs, out=out, use_bitset=use_bitset, deduplicate=deduplicate,
+                              result_dtype=result_dtype, background=background, 
+                              features=features, rest=rest, I_map=I_map)
+
+
+
+def interventional_additive_treeshap_reduce(model, X, n_jobs=1, I_map=None):
+    """ 
+    Compute the row means H[..., 1:].mean(1) and column means H[..., 1:].mean(0) of the
+    additive terms without storing the (N, N, d) tensor H.
+
+    Returns
+    -------
+    row_means : numpy.array
+        Array of shape (N, d), these are the PDPs evaluated at each instance.
+
+    col_means : numpy.array
+        Array of shape (N, d), these are used to compute the PFI.
+    """
+    explainer = TreeANOVA(model, X)
+    return explainer.additive_reduce(X, n_jobs=n_jobs, I_map=I_map)
+
+
+
+def get_Hadd__treeshap(model, X, use_stack=False, n_jobs=1, deduplicate=False, result_dtype=np.float64,
+                       background=None, I_map=None):
+    explainer = TreeANOVA(model, X)
+    return explainer.A(X, use_stack=use_stack, n_jobs=n_jobs, deduplicate=deduplicate, 
+                       result_dtype=result_dtype, background=background, I_map=I_map)
 
-    # Open the shared library
-    mylib = ctypes.CDLL(libfile)
 
-    # Tell Python the argument and result types of function main_treeshap
-    mylib.main_A_treeshap.restype = ctypes.c_int
-    mylib.main_A_treeshap.argtypes = [ctypes.c_int, ctypes.c_int,
-                                    ctypes.c_int, ctypes.c_int,
-                                    np.ctypeslib.ndpointer(dtype=np.float64),
-                                    np.ctypeslib.ndpointer(dtype=np.float64),
-                                    np.ctypeslib.ndpointer(dtype=np.float64),
-                                    np.ctypeslib.ndpointer(dtype=np.int32),
-                                    np.ctypeslib.ndpointer(dtype=np.int32),
-                                    np.ctypeslib.ndpointer(dtype=np.int32),
-                                    np.ctypeslib.ndpointer(dtype=np.float64),
-                                    ctypes.c_bool]
-
-    # 3. call function mysum
-    mylib.main_A_treeshap(N, Nt, d, depth, X,
-                                ensemble.thresholds, values,
-                                ensemble.features, ensemble.children_left, 
-                                ensemble.children_right, results, use_stack)
-    results += ensemble.base_offset[-1]
-    return results
\ No newline at end of file
+# Name used in the tests and older scripts
+get_A_treeshap = get_Hadd__treeshap
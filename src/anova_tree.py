@@ -21,6 +21,25 @@ SYMBOLS = { True :
         }
 
 
+def weighted_var(f, w):
+    """ Variance of f where f[i] is repeated w[i] times """
+    return np.average((f - np.average(f, weights=w))**2, weights=w)
+
+
+def double_centered_errors(R, w, w_cols=None):
+    """ 
+    Squared residuals of R after removing its weighted means along 
+    the first two axes, as in the GADGET-PDP objective. The columns
+    are weighted by `w_cols`, or by `w` when R is square.
+    """
+    if w_cols is None:
+        w_cols = w
+    R_mean_0 = np.average(R, axis=0, weights=w, keepdims=True)
+    R_mean_1 = np.average(R, axis=1, weights=w_cols, keepdims=True)
+    return (R - R_mean_0 - R_mean_1 + np.average(R_mean_0, axis=1, weights=w_cols, keepdims=True))**2
+
+
+
 class Node(object):
     """ Node in a Decision Tree """
     def __init__(self, instances_idx, parent, depth, impurity):
@@ -84,8 +103,11 @@ class FDTree(BaseEstimator, ABC):
             self.recurse_print_tree_str(node=node.child_right, verbose=verbose, tree_strings=tree_strings)
 
 
-    def get_split_candidates(self, x_i, i):
+    def get_split_candidates(self, x_i, i, w_i=None):
         """ Return a list of split candiates """
+        # A row of weight w stands for w identical rows
+        if w_i is not None:
+            x_i = np.repeat(x_i, w_i)
         # Numerical features we take quantiles
         if self.features.types[i] == "num":
             if len(x_i) < 50:
@@ -123,7 +145,7 @@ class FDTree(BaseEstimator, ABC):
         return splits
     
 
-    def get_best_split(self, impurity, curr_node, instances_idx):
+    def get_best_split(self, impurity, curr_node, instances_idx, background_idx):
         """ Return the optimal split along a feature """
         best_feature_split = 0
         best_obj = impurity
@@ -132,7 +154,7 @@ class FDTree(BaseEstimator, ABC):
         best_split = None
         for feature in range(self.D):
             splits, N_left, N_right, objective_left, objective_right = \
-                                            self.get_split(instances_idx, feature)
+                                            self.get_split(instances_idx, background_idx, feature)
             # No split was conducted
             if len(splits) == 0:
                 if self.save_losses:
@@ -141,7 +163,7 @@ class FDTree(BaseEstimator, ABC):
             else:
                 
                 # Otherwise search for the best split
-                objective = (objective_right+objective_left) / len(instances_idx)
+                objective = (objective_right+objective_left) / self.w[instances_idx].sum()
                 if self.save_losses:
                     curr_node.splits.append(splits)
                     curr_node.objectives.append(objective)
@@ -158,7 +180,7 @@ class FDTree(BaseEstimator, ABC):
     
 
     @abstractmethod
-    def get_split(self, instances_idx, feature):
+    def get_split(self, instances_idx, background_idx, feature):
         """ Get the objective value at each split """
         pass
     
@@ -168,8 +190,35 @@ class FDTree(BaseEstimator, ABC):
         """ Fit the tree via the provided tensors """
         pass
 
+
+    def set_sample_weight(self, sample_weight):
+        """ 
+        Integer multiplicity of each row of X, e.g. the weights returned by `TreeANOVA.deduplicate`.
+        Fitting on weighted rows is the same as fitting on the rows repeated that many times.
+        """
+        if sample_weight is None:
+            self.w = np.ones(self.N, dtype=np.int64)
+        else:
+            self.w = np.asarray(sample_weight, dtype=np.int64)
+            assert self.w.shape == (self.N,)
+
+
+    def set_background(self, background):
+        """ 
+        The columns of H stand for the rows of X, or for the instances of a separate `background`
+        such as a fixed reference sample. Each region then averages over the background instances
+        that fall into it, which are counted once each.
+        """
+        if background is None:
+            self.Z = self.X
+            self.w_Z = self.w
+        else:
+            self.Z = np.asarray(background)
+            assert self.Z.shape[1] == self.D
+            self.w_Z = np.ones(self.Z.shape[0], dtype=np.int64)
+
     
-    def _tree_builder(self, instances_idx, parent, depth, impurity):
+    def _tree_builder(self, instances_idx, background_idx, parent, depth, impurity):
         
         # Create a node
         curr_node = Node(instances_idx, parent, depth, impurity*self.impurity_factor)
@@ -180,13 +229,13 @@ class FDTree(BaseEstimator, ABC):
             # Create a leaf
             curr_node.group = self.n_groups
             self.n_groups += 1
-            data_ratio = len(instances_idx) / self.N
+            data_ratio = self.w[instances_idx].sum() / self.w.sum()
             self.total_impurity += impurity * data_ratio * self.impurity_factor
             return curr_node
         
         # Otherwise Find best split
         best_feature_split, best_split, best_obj, best_obj_left, best_obj_right = \
-                                    self.get_best_split(impurity, curr_node, instances_idx)
+                                    self.get_best_split(impurity, curr_node, instances_idx, background_idx)
 
         # Stop the tree growth if the decrease in Loss 
         # induced by the split is minimal or no split was conducted
@@ -194,23 +243,26 @@ class FDTree(BaseEstimator, ABC):
             # Create a leaf
             curr_node.group = self.n_groups
             self.n_groups += 1
-            data_ratio = len(instances_idx) / self.N
+            data_ratio = self.w[instances_idx].sum() / self.w.sum()
             self.total_impurity += impurity * data_ratio * self.impurity_factor
             return curr_node
         
         # Select instances of the chosen feature
         x_i = self.X[instances_idx, best_feature_split]
+        z_i = self.Z[background_idx, best_feature_split]
 
         # Update the node with feature and threshold used
         curr_node.update(best_feature_split, best_split)
 
         # Go left
         curr_node.child_left = self._tree_builder(instances_idx[x_i <= best_split],
+                                                  background_idx[z_i <= best_split],
                                                   parent=curr_node, 
                                                   depth=depth+1,
                                                   impurity=best_obj_left)
         # Go right
         curr_node.child_right= self._tree_builder(instances_idx[x_i > best_split],
+                                                  background_idx[z_i > best_split],
                                                   parent=curr_node, 
                                                   depth=depth+1,
                                                   impurity=best_obj_right)
@@ -361,25 +413,38 @@ class L2CoETree(FDTree):
         super().__init__(*args, **kwargs)
 
 
-    def fit(self, X, H):
+    def fit(self, X, H, sample_weight=None, background=None, f=None):
+        """ 
+        Fit on the matrix H of shape (N, N), or (N, Nz) when the columns stand for a `background`
+        of Nz instances. The model outputs `f` on X are then required since they are no 
+        longer the diagonal of H.
+        """
         self.X = X
         self.N, self.D = X.shape
+        self.set_sample_weight(sample_weight)
+        self.set_background(background)
         self.H = H
-        self.f = self.H[np.arange(self.N), np.arange(self.N)]
-        self.impurity_factor = 100 / self.f.var() # To have an impurity 0-100%
+        assert self.H.shape == (self.N, len(self.w_Z))
+        if background is None:
+            self.f = self.H[np.arange(self.N), np.arange(self.N)]
+        else:
+            assert f is not None, "The model outputs on X must be given along with a background"
+            self.f = np.asarray(f)
+        self.impurity_factor = 100 / weighted_var(self.f, self.w) # To have an impurity 0-100%
         self.total_impurity = 0
         self.n_groups = 0
-        impurity = np.mean((self.f - self.H.mean(1))**2)
+        impurity = np.average((self.f - np.average(self.H, axis=1, weights=self.w_Z))**2, weights=self.w)
         # Start recursive tree growth
-        self.root = self._tree_builder(np.arange(self.N), parent=None, 
+        self.root = self._tree_builder(np.arange(self.N), np.arange(len(self.w_Z)), parent=None, 
                                        depth=0, impurity=impurity)
         return self
 
 
-    def get_split(self, instances_idx, feature):
+    def get_split(self, instances_idx, background_idx, feature):
         x_i = self.X[instances_idx, feature]
+        z_i = self.Z[background_idx, feature]
 
-        splits = self.get_split_candidates(x_i, feature)
+        splits = self.get_split_candidates(x_i, feature, self.w[instances_idx])
 
         # No split possible
         if len(splits) == 0:
@@ -397,11 +462,19 @@ class L2CoETree(FDTree):
         for i, split in enumerate(splits):
             left = instances_idx[x_i <= split].reshape((-1, 1))
             right = instances_idx[x_i > split].reshape((-1, 1))
-            N_left[i] = len(left)
-            N_right[i] = len(right)
-            to_keep[i] = min(N_left[i], N_right[i]) >= self.samples_leaf
-            objective_left[i] = np.sum((f[x_i <= split] - self.H[left, left.T].mean(-1))**2)
-            objective_right[i] = np.sum((f[x_i > split] - self.H[right, right.T].mean(-1))**2)
+            left_Z = background_idx[z_i <= split]
+            right_Z = background_idx[z_i > split]
+            w_left = self.w[left.ravel()]
+            w_right = self.w[right.ravel()]
+            N_left[i] = w_left.sum()
+            N_right[i] = w_right.sum()
+            to_keep[i] = min(N_left[i], N_right[i]) >= self.samples_leaf and min(len(left_Z), len(right_Z)) > 0
+            if not to_keep[i]:
+                continue
+            objective_left[i] = np.sum(w_left * (f[x_i <= split] - 
+                                        np.average(self.H[left, left_Z], axis=-1, weights=self.w_Z[left_Z]))**2)
+            objective_right[i] = np.sum(w_right * (f[x_i > split] - 
+                                        np.average(self.H[right, right_Z], axis=-1, weights=self.w_Z[right_Z]))**2)
         
         return splits[to_keep], N_left[to_keep], N_right[to_keep],\
                     objective_left[to_keep], objective_right[to_keep]
@@ -413,25 +486,32 @@ class PFITree(FDTree):
         super().__init__(*args, **kwargs)
 
 
-    def fit(self, X, H):
+    def fit(self, X, H, sample_weight=None, background=None):
+        # The objective pairs H[i, j] with H[j, i] so the columns must be the rows of X
+        if background is not None:
+            raise Exception("PFITree requires H to be computed with X as its own background")
         self.X = X
         self.N, self.D = X.shape
+        self.set_sample_weight(sample_weight)
+        self.set_background(background)
         self.H = H[..., 1:]
         self.f = H[0, :, 0]
-        self.impurity_factor = 100 / self.f.var() # To have an impurity 0-100%
+        self.impurity_factor = 100 / weighted_var(self.f, self.w) # To have an impurity 0-100%
         self.total_impurity = 0
         self.n_groups = 0
-        impurity = np.mean(np.sum((self.H.mean(0) + self.H.mean(1))**2, axis=-1))
+        impurity = np.average(np.sum((np.average(self.H, axis=0, weights=self.w) + 
+                                      np.average(self.H, axis=1, weights=self.w))**2, axis=-1), 
+                              weights=self.w)
         # Start recursive tree growth
-        self.root = self._tree_builder(np.arange(self.N), parent=None, 
+        self.root = self._tree_builder(np.arange(self.N), np.arange(self.N), parent=None, 
                                        depth=0, impurity=impurity)
         return self
 
 
-    def get_split(self, instances_idx, feature):
+    def get_split(self, instances_idx, background_idx, feature):
         x_i = self.X[instances_idx, feature]
 
-        splits = self.get_split_candidates(x_i, feature)
+        splits = self.get_split_candidates(x_i, feature, self.w[instances_idx])
 
         # No split possible
         if len(splits) == 0:
@@ -448,13 +528,19 @@ class PFITree(FDTree):
         for i, split in enumerate(splits):
             left = instances_idx[x_i <= split].reshape((-1, 1))
             right = instances_idx[x_i > split].reshape((-1, 1))
-            N_left[i] = len(left)
-            N_right[i] = len(right)
+            w_left = self.w[left.ravel()]
+            w_right = self.w[right.ravel()]
+            N_left[i] = w_left.sum()
+            N_right[i] = w_right.sum()
             to_keep[i] = min(N_left[i], N_right[i]) >= self.samples_leaf
             R_left = self.H[left, left.T]
             R_right = self.H[right, right.T]
-            objective_left[i] = np.sum((R_left.mean(0) + R_left.mean(1))**2)
-            objective_right[i] = np.sum((R_right.mean(0) + R_right.mean(1))**2)
+            objective_left[i] = np.sum(w_left.reshape((-1, 1)) * 
+                                       (np.average(R_left, axis=0, weights=w_left) + 
+                                        np.average(R_left, axis=1, weights=w_left))**2)
+            objective_right[i] = np.sum(w_right.reshape((-1, 1)) * 
+                                        (np.average(R_right, axis=0, weights=w_right) + 
+                                         np.average(R_right, axis=1, weights=w_right))**2)
         
         return splits[to_keep], N_left[to_keep], N_right[to_keep],\
                     objective_left[to_keep], objective_right[to_keep]
@@ -465,10 +551,11 @@ class GADGET_PDP(FDTree):
         super().__init__(*args, **kwargs)
     
 
-    def get_split(self, instances_idx, feature):
+    def get_split(self, instances_idx, background_idx, feature):
         x_i = self.X[instances_idx, feature]
+        z_i = self.Z[background_idx, feature]
 
-        splits = self.get_split_candidates(x_i, feature)
+        splits = self.get_split_candidates(x_i, feature, self.w[instances_idx])
 
         # No split possible
         if len(splits) == 0:
@@ -485,39 +572,46 @@ class GADGET_PDP(FDTree):
         for i, split in enumerate(splits):
             left = instances_idx[x_i <= split].reshape((-1, 1))
             right = instances_idx[x_i > split].reshape((-1, 1))
-            N_left[i] = len(left)
-            N_right[i] = len(right)
-            to_keep[i] = min(N_left[i], N_right[i]) >= self.samples_leaf
-            R_left = self.R[left, left.T]
-            R_right = self.R[right, right.T]
-            errors_left = (R_left - R_left.mean(axis=0, keepdims=True) - 
-                            R_left.mean(axis=1, keepdims=True) +
-                            R_left.mean(axis=0, keepdims=True).mean(axis=1, keepdims=True))**2
-            objective_left[i] = errors_left.sum(-1).mean(-1).sum()
-            errors_right = (R_right - R_right.mean(axis=0, keepdims=True) - 
-                            R_right.mean(axis=1, keepdims=True) +
-                            R_right.mean(axis=0, keepdims=True).mean(axis=1, keepdims=True))**2
-            objective_right[i] = errors_right.sum(-1).mean(-1).sum()
+            left_Z = background_idx[z_i <= split]
+            right_Z = background_idx[z_i > split]
+            w_left = self.w[left.ravel()]
+            w_right = self.w[right.ravel()]
+            w_left_Z = self.w_Z[left_Z]
+            w_right_Z = self.w_Z[right_Z]
+            N_left[i] = w_left.sum()
+            N_right[i] = w_right.sum()
+            to_keep[i] = min(N_left[i], N_right[i]) >= self.samples_leaf and min(len(left_Z), len(right_Z)) > 0
+            if not to_keep[i]:
+                continue
+            errors_left = double_centered_errors(self.R[left, left_Z], w_left, w_left_Z)
+            objective_left[i] = np.sum(w_left * np.average(errors_left.sum(-1), axis=-1, weights=w_left_Z))
+            errors_right = double_centered_errors(self.R[right, right_Z], w_right, w_right_Z)
+            objective_right[i] = np.sum(w_right * np.average(errors_right.sum(-1), axis=-1, weights=w_right_Z))
         
         return splits[to_keep], N_left[to_keep], N_right[to_keep],\
                     objective_left[to_keep], objective_right[to_keep]
 
 
-    def fit(self, X, H):
+    def fit(self, X, H, sample_weight=None, background=None):
+        """ 
+        Fit on the tensor H of shape (N, N, d+1), or (N, Nz, d+1) when the 
+        columns stand for a `background` of Nz instances.
+        """
         self.X = X
         self.N, self.D = X.shape
+        self.set_sample_weight(sample_weight)
+        self.set_background(background)
+        assert H.shape[:2] == (self.N, len(self.w_Z))
         self.f = H[0, :, 0]
         H = H + self.f.reshape((1, -1, 1))
-        self.R = H[..., 1:]  # (N, N, d) tensor s.t. R_ijk = h_(r_{k}(x^(j), x^(i)))
-        self.impurity_factor = 100 / self.f.var() # To have an impurity 0-100%
+        self.R = H[..., 1:]  # (N, Nz, d) tensor s.t. R_ijk = h_(r_{k}(x^(j), x^(i)))
+        self.impurity_factor = 100 / weighted_var(self.f, self.w_Z) # To have an impurity 0-100%
         self.total_impurity = 0
         self.n_groups = 0
-        impurity = np.mean(np.sum((self.R - self.R.mean(axis=0, keepdims=True) - 
-                                   self.R.mean(axis=1, keepdims=True) +
-                                   self.R.mean(axis=0, keepdims=True).mean(axis=1, keepdims=True))**2, 
-                                   axis=-1))
+        errors = double_centered_errors(self.R, self.w, self.w_Z).sum(-1)
+        impurity = np.average(np.average(errors, axis=-1, weights=self.w_Z), weights=self.w)
         # Start recursive tree growth
-        self.root = self._tree_builder(np.arange(self.N), parent=None, 
+        self.root = self._tree_builder(np.arange(self.N), np.arange(len(self.w_Z)), parent=None, 
                                        depth=0, impurity=impurity)
         return self
     
@@ -532,24 +626,26 @@ class CART(FDTree):
         super().__init__(*args, **kwargs)
 
 
-    def fit(self, X, f):
+    def fit(self, X, f, sample_weight=None):
         self.X = X
         self.N, self.D = X.shape
+        self.set_sample_weight(sample_weight)
+        self.set_background(None)
         self.f = f
-        self.impurity_factor = 100 / self.f.var() # To have an impurity 0-100%
+        self.impurity_factor = 100 / weighted_var(self.f, self.w) # To have an impurity 0-100%
         self.total_impurity = 0
         self.n_groups = 0
-        impurity = self.f.var()
+        impurity = weighted_var(self.f, self.w)
         # Start recursive tree growth
-        self.root = self._tree_builder(np.arange(self.N), parent=None, 
+        self.root = self._tree_builder(np.arange(self.N), np.arange(self.N), parent=None, 
                                        depth=0, impurity=impurity)
         return self
 
 
-    def get_split(self, instances_idx, feature):
+    def get_split(self, instances_idx, background_idx, feature):
         x_i = self.X[instances_idx, feature]
 
-        splits = self.get_split_candidates(x_i, feature)
+        splits = self.get_split_candidates(x_i, feature, self.w[instances_idx])
 
         # No split possible
         if len(splits) == 0:
@@ -566,11 +662,11 @@ class CART(FDTree):
         for i, split in enumerate(splits):
             left = instances_idx[x_i <= split]
             right = instances_idx[x_i > split]
-            N_left[i] = len(left)
-            N_right[i] = len(right)
+            N_left[i] = self.w[left].sum()
+            N_right[i] = self.w[right].sum()
             to_keep[i] = min(N_left[i], N_right[i]) >= self.samples_leaf
-            objective_left[i] = np.sum((self.f[left] - self.f[left].mean())**2)
-            objective_right[i] = np.sum((self.f[right] - self.f[right].mean())**2)
+            objective_left[i] = N_left[i] * weighted_var(self.f[left], self.w[left])
+            objective_right[i] = N_right[i] * weighted_var(self.f[right], self.w[right])
         
         return splits[to_keep], N_left[to_keep], N_right[to_keep],\
                     objective_left[to_keep], objective_right[to_keep]
@@ -582,18 +678,18 @@ class RandomTree(L2CoETree):
         super().__init__(*args, **kwargs)
     
 
-    def get_best_split(self, impurity, curr_node, instances_idx):
+    def get_best_split(self, impurity, curr_node, instances_idx, background_idx):
         splits = []
         while len(splits) == 0:
             best_feature_split = np.random.choice(range(self.D))
             splits, N_left, N_right, objective_left, objective_right = \
-                                        self.get_split(instances_idx, best_feature_split)
+                                        self.get_split(instances_idx, background_idx, best_feature_split)
         # Chose a random split
         idx = np.random.choice(range(max(1, len(splits)-1)))
         
         # Otherwise search for the best split
         best_split = splits[idx]
-        best_obj = (objective_right[idx]+objective_left[idx]) / len(instances_idx)
+        best_obj = (objective_right[idx]+objective_left[idx]) / self.w[instances_idx].sum()
         best_obj_left = objective_left[idx] / N_left[idx]
         best_obj_right = objective_right[idx] / N_right[idx]
     
@@ -0,0 +1,528 @@
+""" Extract the structure of tree ensembles without the SHAP API """
+
+import json
+
+import numpy as np
+import sklearn.ensemble as se
+from scipy.special import logit
+
+
+class TreeEnsemble:
+    """
+    Padded arrays describing a tree ensemble, with the same layout as
+    `shap.explainers.Tree(model).model` so that the C++ kernels can read them.
+
+    Attributes
+    ----------
+    children_left, children_right, children_default : numpy.array
+        Arrays of shape (n_trees, max_nodes) with the child indices, -1 for leaves and padding.
+        `children_default` is the child taken by missing values.
+
+    features : numpy.array
+        Array of shape (n_trees, max_nodes) with the split feature, negative for leaves and padding.
+
+    thresholds : numpy.array
+        Array of shape (n_trees, max_nodes), instances go left when x[feature] <= threshold.
+
+    values : numpy.array
+        Array of shape (n_trees, max_nodes, n_outputs) with the scaled node values.
+
+    base_offset : numpy.array
+        Array of shape (n_outputs,) added to the sum of the trees.
+    """
+    def __init__(self, trees, base_offset=0):
+        # Each tree is a dict of 1D arrays with the keys below
+        n_trees = len(trees)
+        max_nodes = max([len(tree["features"]) for tree in trees])
+        n_outputs = trees[0]["values"].shape[1]
+
+        # important to be -1 in unused sections!! This way we can tell which entries are valid.
+        self.children_left = -np.ones((n_trees, max_nodes), dtype=np.int32)
+        self.children_right = -np.ones((n_trees, max_nodes), dtype=np.int32)
+        self.children_default = -np.ones((n_trees, max_nodes), dtype=np.int32)
+        self.features = -np.ones((n_trees, max_nodes), dtype=np.int32)
+        self.thresholds = np.zeros((n_trees, max_nodes), dtype=np.float64)
+        self.values = np.zeros((n_trees, max_nodes, n_outputs), dtype=np.float64)
+
+        for t, tree in enumerate(trees):
+            n_nodes = len(tree["features"])
+            self.children_left[t, :n_nodes] = tree["children_left"]
+            self.children_right[t, :n_nodes] = tree["children_right"]
+            self.children_default[t, :n_nodes] = tree["children_default"]
+            self.features[t, :n_nodes] = tree["features"]
+            self.thresholds[t, :n_nodes] = tree["thresholds"]
+            self.values[t, :n_nodes] = tree["values"]
+
+        self.base_offset = (np.ones(n_outputs) * np.asarray(base_offset, dtype=np.float64).flatten())
+
+
+    def predict(self, X):
+        """ Raw output of the last model output, i.e. the sum of the trees plus the base offset """
+        X = np.asarray(X, dtype=np.float64)
+        N = X.shape[0]
+        results = np.full(N, self.base_offset[-1])
+        for t in range(self.features.shape[0]):
+            nodes = np.zeros(N, dtype=np.int64)
+            # All instances go down one level at a time
+            is_internal = self.children_left[t, nodes] >= 0
+            while is_internal.any():
+                n = nodes[is_internal]
+                x = X[is_internal, self.features[t, n]]
+                child = np.where(x <= self.thresholds[t, n], self.children_left[t, n], self.children_right[t, n])
+                nodes[is_internal] = np.where(np.isnan(x), self.children_default[t, n], child)
+                is_internal = self.children_left[t, nodes] >= 0
+            results += self.values[t, nodes, -1]
+        return results
+
+
+
+# Node record read by the C++ kernels, it matches `struct Node` in utils.hpp
+NODE_DTYPE = np.dtype([("feature", np.int32), ("child_left", np.int32), 
+                       ("child_right", np.int32), ("child_default", np.int32),
+                       ("threshold", np.float64), ("value", np.float64)], align=True)
+assert NODE_DTYPE.itemsize == 32
+
+
+def pack_tree_ensemble(ensemble):
+    """
+    Concatenate the trees of a padded ensemble (ours or SHAP's) into a single array of
+    packed nodes, so that deep trees do not force the others to the same width.
+
+    Returns
+    -------
+    nodes : numpy.array
+        Structured array of dtype `NODE_DTYPE` with the nodes of all trees.
+
+    offsets : numpy.array
+        Array of shape (n_trees+1,), the nodes of tree t are nodes[offsets[t]:offsets[t+1]].
+
+    max_depth : int
+        Depth of the deepest tree.
+    """
+    n_trees = ensemble.features.shape[0]
+    n_nodes = np.zeros(n_trees, dtype=np.int64)
+    max_depth = 0
+    for t in range(n_trees):
+        # Visit the tree level by level to find its last node and its depth
+        level = np.array([0])
+        depth = 0
+        while True:
+            n_nodes[t] = max(n_nodes[t], level.max() + 1)
+            level = level[ensemble.children_left[t, level] >= 0]
+            if len(level) == 0:
+                break
+            level = np.concatenate((ensemble.children_left[t, level], ensemble.children_right[t, level]))
+            depth += 1
+        max_depth = max(max_depth, depth)
+    
+    offsets = np.append(0, np.cumsum(n_nodes)).astype(np.int64)
+    nodes = np.zeros(offsets[-1], dtype=NODE_DTYPE)
+    for t in range(n_trees):
+        tree = slice(offsets[t], offsets[t+1])
+        nodes["feature"][tree] = ensemble.features[t, :n_nodes[t]]
+        nodes["child_left"][tree] = ensemble.children_left[t, :n_nodes[t]]
+        nodes["child_right"][tree] = ensemble.children_right[t, :n_nodes[t]]
+        nodes["child_default"][tree] = ensemble.children_default[t, :n_nodes[t]]
+        nodes["threshold"][tree] = ensemble.thresholds[t, :n_nodes[t]]
+        nodes["value"][tree] = ensemble.values[t, :n_nodes[t], -1]
+    return nodes, offsets, max_depth
+
+
+
+def simplify_subtree(tree, n, bounds, values):
+    """
+    Structure of the subtree of a packed tree rooted at node n, whose leaf values are appended
+    to values in preorder. The tree is given as the lists of its node fields in the order of
+    `NODE_DTYPE`, which are much faster to index than the records. Instances reach n with
+    lower < x[k] <= upper for bounds[k] = (lower, upper, missing), where missing tells whether
+    missing values of k can reach n. The structure is None for a leaf and
+    (feature, threshold, default_left, left, right) otherwise.
+    """
+    features, children_left, children_right, children_default, thresholds, leaf_values = tree
+    if children_left[n] < 0:
+        values.append(leaf_values[n])
+        return None
+    k, threshold = features[n], thresholds[n]
+    lower, upper, missing = bounds.get(k, (-np.inf, np.inf, True))
+    default_left = children_default[n] == children_left[n]
+
+    # The direction is already decided by the splits above on the same column
+    if upper <= threshold and (not missing or default_left):
+        return simplify_subtree(tree, children_left[n], bounds, values)
+    if lower >= threshold and (not missing or not default_left):
+        return simplify_subtree(tree, children_right[n], bounds, values)
+
+    start = len(values)
+    left = simplify_subtree(tree, children_left[n], 
+                            {**bounds, k : (lower, min(upper, threshold), missing and default_left)}, values)
+    middle = len(values)
+    right = simplify_subtree(tree, children_right[n], 
+                             {**bounds, k : (max(lower, threshold), upper, missing and not default_left)}, values)
+    # Both children compute the same function, e.g. two null subtrees
+    if left == right and values[start:middle] == values[middle:]:
+        del values[middle:]
+        return left
+    return (k, threshold, default_left, left, right)
+
+
+
+def pack_subtree(structure, leaves, records):
+    """ Append the nodes of a simplified subtree to records in preorder and return its depth """
+    index = len(records)
+    if structure is None:
+        records.append((-1, -1, -1, -1, 0.0, next(leaves)))
+        return 0
+    k, threshold, default_left, left, right = structure
+    records.append(None)
+    depth_left = pack_subtree(left, leaves, records)
+    right_index = len(records)
+    depth_right = pack_subtree(right, leaves, records)
+    records[index] = (k, index + 1, right_index, index + 1 if default_left else right_index, threshold, 0.0)
+    return 1 + max(depth_left, depth_right)
+
+
+
+def compact_packed_ensemble(nodes, offsets):
+    """
+    Lossless compaction of a packed ensemble. The splits whose direction is decided by the splits
+    above them on the same column are replaced by the child that is taken, the splits whose
+    two subtrees are identical (e.g. null) are replaced by one of them, and the trees with
+    identical structures are merged by summing their leaf values. Trees reduced to a null leaf
+    are removed. The sum of the trees is unchanged and so are the quantities computed by the
+    kernels, up to rounding errors.
+
+    Returns
+    -------
+    nodes, offsets, max_depth :
+        The compacted ensemble, see `pack_tree_ensemble`.
+    """
+    # Trees with the same structure in order of appearance
+    merged = {}
+    columns = [nodes[name].tolist() for name in NODE_DTYPE.names]
+    for t in range(len(offsets) - 1):
+        values = []
+        structure = simplify_subtree([column[offsets[t]:offsets[t+1]] for column in columns], 0, {}, values)
+        merged[structure] = merged.get(structure, 0) + np.array(values)
+    trees = [(structure, values) for structure, values in merged.items() 
+             if structure is not None or values[0] != 0]
+    # The kernels expect at least one tree
+    if len(trees) == 0:
+        trees = [(None, np.zeros(1))]
+
+    records, sizes, max_depth = [], [], 0
+    for structure, values in trees:
+        tree_records = []
+        max_depth = max(max_depth, pack_subtree(structure, iter(values), tree_records))
+        records += tree_records
+        sizes.append(len(tree_records))
+    offsets = np.append(0, np.cumsum(sizes)).astype(np.int64)
+    nodes = np.array(records, dtype=NODE_DTYPE)
+    return nodes, offsets, max_depth
+
+
+
+def packed_tree_columns(nodes, offsets):
+    """ Distinct columns split on by each tree of a packed ensemble """
+    internal = nodes["child_left"] >= 0
+    return [np.unique(nodes["feature"][offsets[t]:offsets[t+1]][internal[offsets[t]:offsets[t+1]]])
+            for t in range(len(offsets) - 1)]
+
+
+
+def predict_packed_tree(nodes, X):
+    """
+    Leaf values reached by the rows of X in a single packed tree, missing values
+    follow the default child as in the kernels
+    """
+    node = np.zeros(X.shape[0], dtype=np.int64)
+    active = np.arange(X.shape[0])
+    while len(active) > 0:
+        current = nodes[node[active]]
+        internal = current["child_left"] >= 0
+        active, current = active[internal], current[internal]
+        x = X[active, current["feature"]]
+        child = np.where(x <= current["threshold"], current["child_left"], current["child_right"])
+        node[active] = np.where(np.isnan(x), current["child_default"], child)
+    return nodes["value"][node]
+
+
+
+def closed_form_grids(nodes, offsets, trees, tree_columns):
+    """
+    Sum of the given trees of a packed ensemble on the cells of the columns they split on.
+    The trees splitting on the same columns are grouped, the union of their thresholds cuts
+    each column into cells and one more cell holds the missing values.
+
+    Returns
+    -------
+    grids : list
+        One tuple (columns, thresholds, F) per group, where thresholds[k] are the thresholds
+        of columns[k] and F is the array of the summed tree values with one axis per column.
+    """
+    groups = {}
+    for t in trees:
+        if len(tree_columns[t]) > 0:
+            groups.setdefault(tuple(tree_columns[t]), []).append(t)
+    grids = []
+    for columns, group in groups.items():
+        group_nodes = [nodes[offsets[t]:offsets[t+1]] for t in group]
+        thresholds = []
+        for k in columns:
+            thresholds.append(np.unique(np.concatenate([tree["threshold"][(tree["child_left"] >= 0) & 
+                                                                          (tree["feature"] == k)]
+                                                        for tree in group_nodes])))
+        # One point per cell, the last two stand for the values above all thresholds and missing values
+        mesh = np.meshgrid(*[np.append(t, [np.inf, np.nan]) for t in thresholds], indexing="ij")
+        points = np.zeros((mesh[0].size, max(columns) + 1))
+        points[:, list(columns)] = np.column_stack([axis.ravel() for axis in mesh])
+        F = sum(predict_packed_tree(tree, points) for tree in group_nodes).reshape(mesh[0].shape)
+        grids.append((columns, thresholds, F))
+    return grids
+
+
+
+def sklearn_tree(tree_, normalize=False, scaling=1.0):
+    """ Arrays of a `sklearn.tree._tree.Tree` """
+    children_left = tree_.children_left.astype(np.int32)
+    # Trees fitted with missing values store the direction of NaNs
+    missing_go_to_left = getattr(tree_, "missing_go_to_left", None)
+    if missing_go_to_left is None:
+        children_default = children_left
+    else:
+        children_default = np.where(missing_go_to_left, tree_.children_left, tree_.children_right)
+    values = tree_.value.reshape(tree_.value.shape[0], tree_.value.shape[1] * tree_.value.shape[2])
+    if normalize:
+        values = (values.T / values.sum(1)).T
+    return {"children_left" : children_left,
+            "children_right" : tree_.children_right.astype(np.int32),
+            "children_default" : children_default.astype(np.int32),
+            "features" : tree_.feature.astype(np.int32),
+            "thresholds" : tree_.threshold.astype(np.float64),
+            "values" : values * scaling}
+
+
+def hist_tree(predictor):
+    """ Arrays of a `TreePredictor` from HistGradientBoosting """
+    nodes = predictor.nodes
+    if nodes["is_categorical"].any():
+        raise ValueError("Categorical splits of HistGradientBoosting are not supported")
+    is_leaf = nodes["is_leaf"].astype(bool)
+    left = np.where(is_leaf, -1, nodes["left"])
+    right = np.where(is_leaf, -1, nodes["right"])
+    return {"children_left" : left.astype(np.int32),
+            "children_right" : right.astype(np.int32),
+            "children_default" : np.where(nodes["missing_go_to_left"], left, right).astype(np.int32),
+            "features" : np.where(is_leaf, -2, nodes["feature_idx"]).astype(np.int32),
+            "thresholds" : nodes["num_threshold"].astype(np.float64),
+            "values" : nodes["value"].astype(np.float64).reshape((-1, 1))}
+
+
+def gbt_base_offset(model):
+    """ Raw prediction of the `init_` estimator of GradientBoosting """
+    if model.init_ == "zero":
+        return 0
+    if isinstance(model, se.GradientBoostingRegressor):
+        # The init estimator must be constant
+        if hasattr(model.init_, "constant_"):
+            return model.init_.constant_
+    elif hasattr(model.init_, "class_prior_"):
+        # With two classes the trees only model the second class
+        log_odds = logit(model.init_.class_prior_[1])
+        if model.loss == "exponential":
+            # The raw predictions of the exponential loss are half the log-odds
+            return 0.5 * log_odds
+        if model.loss in ["log_loss", "deviance"]:
+            return log_odds
+        raise ValueError(f"Unsupported loss: {model.loss}")
+    raise ValueError(f"Unsupported init model type: {type(model.init_)}")
+
+
+
+# Ensembles whose trees are averaged
+FORESTS = (se.RandomForestRegressor, se.RandomForestClassifier,
+           se.ExtraTreesRegressor, se.ExtraTreesClassifier)
+# Ensembles whose trees are summed with a learning rate
+BOOSTING = (se.GradientBoostingRegressor, se.GradientBoostingClassifier)
+HIST_BOOSTING = (se.HistGradientBoostingRegressor, se.HistGradientBoostingClassifier)
+SUPPORTED_MODELS = FORESTS + BOOSTING + HIST_BOOSTING
+
+
+def extract_tree_ensemble(model):
+    """
+    Read the trees of a fitted RandomForest, ExtraTrees, GradientBoosting or
+    HistGradientBoosting model. The values of classifiers are the class probabilities
+    for forests and the log-odds of the positive class for boosting.
+
+    Parameters
+    ----------
+    model : model_object
+        One of the fitted scikit-learn estimators in `SUPPORTED_MODELS`.
+
+    Returns
+    -------
+    ensemble : TreeEnsemble
+    """
+    assert hasattr(model, "n_features_in_"), "Model has not been fitted"
+    if isinstance(model, FORESTS):
+        # output is average of trees
+        normalize = isinstance(model, (se.RandomForestClassifier, se.ExtraTreesClassifier))
+        scaling = 1.0 / len(model.estimators_)
+        trees = [sklearn_tree(e.tree_, normalize=normalize, scaling=scaling) for e in model.estimators_]
+        return TreeEnsemble(trees)
+
+    if isinstance(model, BOOSTING):
+        if model.estimators_.shape[1] > 1:
+            raise ValueError("GradientBoostingClassifier is only supported for binary classification")
+        trees = [sklearn_tree(e.tree_, scaling=model.learning_rate) for e in model.estimators_[:, 0]]
+        return TreeEnsemble(trees, gbt_base_offset(model))
+
+    if isinstance(model, HIST_BOOSTING):
+        if len(model._predictors[0]) > 1:
+            raise ValueError("HistGradientBoostingClassifier is only supported for binary classification")
+        # The learning rate is already applied to the leaf values
+        trees = [hist_tree(predictors[0]) for predictors in model._predictors]
+        return TreeEnsemble(trees, model._baseline_prediction)
+
+    raise ValueError(f"Unsupported model type: {type(model)}")
+
+
+
+def xgboost_tree(tree):
+    """ Arrays of a tree in the JSON model of XGBoost """
+    if any(tree.get("split_type", [])):
+        raise ValueError("Categorical splits of XGBoost are not supported")
+    left = np.array(tree["left_children"], dtype=np.int32)
+    right = np.array(tree["right_children"], dtype=np.int32)
+    is_leaf = left < 0
+    split_conditions = np.array(tree["split_conditions"], dtype=np.float32)
+    # XGBoost goes left when x < split_condition in float32, which amounts to
+    # x <= the largest float32 below the split condition
+    thresholds = np.nextafter(split_conditions, np.float32(-np.inf)).astype(np.float64)
+    default_left = np.array(tree["default_left"], dtype=bool)
+    return {"children_left" : np.where(is_leaf, -1, left).astype(np.int32),
+            "children_right" : np.where(is_leaf, -1, right).astype(np.int32),
+            "children_default" : np.where(is_leaf, -1, np.where(default_left, left, right)).astype(np.int32),
+            "features" : np.where(is_leaf, -2, tree["split_indices"]).astype(np.int32),
+            "thresholds" : np.where(is_leaf, 0, thresholds),
+            # The leaf values are stored in the split conditions and include the learning rate
+            "values" : np.where(is_leaf, split_conditions, 0).astype(np.float64).reshape((-1, 1))}
+
+
+def load_xgboost_json(model):
+    """
+    Parse the JSON model of an XGBoost booster, e.g. the file written by 
+    `booster.save_model("model.json")`, without importing xgboost.
+
+    Parameters
+    ----------
+    model : str or dict
+        Path to the JSON file, or the already parsed JSON.
+
+    Returns
+    -------
+    ensemble : TreeEnsemble
+        The trees output the raw margin.
+    """
+    if isinstance(model, str):
+        with open(model) as file:
+            model = json.load(file)
+    learner = model["learner"]
+    booster = learner["gradient_booster"]
+    if booster["name"] != "gbtree":
+        raise ValueError(f"Unsupported XGBoost booster {booster['name']}")
+    if int(learner["learner_model_param"].get("num_class", 0)) > 1:
+        raise ValueError("Multi-class XGBoost models are not supported")
+
+    # The base score is stored in the output space of the objective
+    base_score = learner["learner_model_param"]["base_score"]
+    base_score = float(base_score.strip("[]"))
+    objective = learner["objective"]["name"]
+    if objective in ["binary:logistic", "reg:logistic"]:
+        base_offset = logit(base_score)
+    elif objective in ["count:poisson", "reg:gamma", "reg:tweedie", "survival:cox"]:
+        base_offset = np.log(base_score)
+    else:
+        base_offset = base_score
+
+    trees = [xgboost_tree(tree) for tree in booster["model"]["trees"]]
+    return TreeEnsemble(trees, base_offset)
+
+
+
+# Bits of the decision_type of LightGBM nodes
+LGBM_CATEGORICAL_MASK = 1
+LGBM_DEFAULT_LEFT_MASK = 2
+LGBM_MISSING_ZERO, LGBM_MISSING_NAN = 1, 2
+
+
+def lightgbm_tree(block):
+    """ Arrays of a tree in the text model of LightGBM """
+    n_leaves = int(block["num_leaves"])
+    leaf_values = np.array(block["leaf_value"].split(), dtype=np.float64)
+    # Trees without any split
+    if n_leaves == 1:
+        return {"children_left" : np.array([-1]), "children_right" : np.array([-1]),
+                "children_default" : np.array([-1]), "features" : np.array([-2]),
+                "thresholds" : np.zeros(1), "values" : leaf_values.reshape((-1, 1))}
+    
+    n_internal = n_leaves - 1
+    parse = lambda key, dtype : np.array(block[key].split(), dtype=dtype)
+    decision_type = parse("decision_type", np.int64)
+    if (decision_type & LGBM_CATEGORICAL_MASK).any():
+        raise ValueError("Categorical splits of LightGBM are not supported")
+    thresholds = parse("threshold", np.float64)
+    # Negative children ~i are the leaves which are stored after the internal nodes
+    left = parse("left_child", np.int64)
+    right = parse("right_child", np.int64)
+    left = np.where(left < 0, n_internal + ~left, left)
+    right = np.where(right < 0, n_internal + ~right, right)
+    default_left = (decision_type & LGBM_DEFAULT_LEFT_MASK) > 0
+    missing_type = (decision_type >> 2) & 3
+    # Without missing type, NaNs are replaced by zeros
+    zero_left = 0 <= thresholds
+    default_left = np.where(missing_type == LGBM_MISSING_NAN, default_left, zero_left)
+    # Zeros treated as missing would need a different routing in the kernels
+    if ((missing_type == LGBM_MISSING_ZERO) & (((decision_type & LGBM_DEFAULT_LEFT_MASK) > 0) != zero_left)).any():
+        raise ValueError("LightGBM models trained with zero_as_missing=True are not supported")
+
+    return {"children_left" : np.append(left, -np.ones(n_leaves)).astype(np.int32),
+            "children_right" : np.append(right, -np.ones(n_leaves)).astype(np.int32),
+            "children_default" : np.append(np.where(default_left, left, right), -np.ones(n_leaves)).astype(np.int32),
+            "features" : np.append(parse("split_feature", np.int64), -2 * np.ones(n_leaves)).astype(np.int32),
+            "thresholds" : np.append(thresholds, np.zeros(n_leaves)),
+            # The leaf values include the shrinkage
+            "values" : np.append(np.zeros(n_internal), leaf_values).reshape((-1, 1))}
+
+
+def load_lightgbm_text(model):
+    """
+    Parse the text model of a LightGBM booster, e.g. the file written by 
+    `booster.save_model("model.txt")`, without importing lightgbm.
+
+    Parameters
+    ----------
+    model : str
+        Path to the text file, or its content.
+
+    Returns
+    -------
+    ensemble : TreeEnsemble
+        The trees output the raw score.
+    """
+    if "\n" not in model:
+        with open(model) as file:
+            model = file.read()
+    
+    # The header and each tree are blocks of key=value lines separated by blank lines
+    blocks = []
+    for chunk in model.split("end of trees")[0].split("\n\n"):
+        lines = [line.split("=", 1) for line in chunk.strip().split("\n") if "=" in line]
+        if lines:
+            blocks.append(dict(lines))
+    header = blocks[0]
+    if int(header.get("num_tree_per_iteration", 1)) > 1:
+        raise ValueError("Multi-class LightGBM models are not supported")
+
+    # The initial score is folded into the first tree
+    trees = [lightgbm_tree(block) for block in blocks if "Tree" in block]
+    return TreeEnsemble(trees)
@@ -0,0 +1,436 @@
+#ifndef __BITSET
+#define __BITSET
+
+#include <vector>
+#include <iostream>
+#include <utility>
+#include <cstdint>
+#include "progressbar.hpp"
+#include "utils.hpp"
+using namespace std;
+
+
+// Alternative engine where, for a fixed foreground instance x, all background instances
+// are pushed through a tree at once. The recursions of recursive_treeshap.hpp only depend
+// on z through the branches it takes, so the background instances that share the same
+// node and sets S_X, S_Z are represented by a bitset and handled together.
+// The branch taken by every z at every node is precomputed once, afterwards the cost
+// of a recursion state is O(Nz / 64) word operations instead of O(Nz) traversals.
+
+
+// Number of 64-bit words needed to store a set of n instances
+inline int n_words(int n){
+    return (n + 63) / 64;
+}
+
+
+// For each node of the ensemble, the bitset of background instances
+// sent to its left child. The bitset of node n of tree t starts
+// at index (offsets[t] + n) * n_words(N).
+template <typename T>
+vector<uint64_t> compute_go_left(const MatrixView<T> &X_b, int start, int end,
+                                 const TreeEnsemble &trees, int n_threads)
+{
+    int N = end - start;
+    int W = n_words(N);
+    vector<uint64_t> go_left(trees.offsets[trees.n_trees] * W, 0);
+    parallel_for(trees.n_trees, n_threads, [&](int thread_id, int t){
+        Tree tree = trees.tree(t);
+        for (int n(0); n < trees.offsets[t+1] - trees.offsets[t]; n++){
+            const Node &node = tree.nodes[n];
+            if (node.child_left < 0) continue;
+            uint64_t* bits = &go_left[(trees.offsets[t] + n) * W];
+            for (int j(0); j < N; j++){
+                if (tree.child(n, X_b(start + j, node.feature)) == node.child_left){
+                    bits[j / 64] |= uint64_t(1) << (j % 64);
+                }
+            }
+        }
+    });
+    return go_left;
+}
+
+
+// Split the set B into the instances that follow x and the others.
+// Returns whether each of the two sets is non-empty.
+inline pair<bool, bool> split_bitset(const uint64_t* B, const uint64_t* go_left, bool x_left,
+                                     uint64_t* B_same, uint64_t* B_diff, int W)
+{
+    uint64_t any_same(0), any_diff(0);
+    uint64_t flip = x_left ? 0 : ~uint64_t(0);
+    for (int w(0); w < W; w++){
+        uint64_t same = B[w] & (go_left[w] ^ flip);
+        uint64_t diff = B[w] & ~same;
+        B_same[w] = same;
+        B_diff[w] = diff;
+        any_same |= same;
+        any_diff |= diff;
+    }
+    return make_pair(any_same != 0, any_diff != 0);
+}
+
+
+inline int popcount(const uint64_t* B, int W){
+    int count = 0;
+    for (int w(0); w < W; w++){
+        count += __builtin_popcountll(B[w]);
+    }
+    return count;
+}
+
+
+// Total weight of the instances of B, their number when weights is null
+inline double weighted_count(const uint64_t* B, const double* weights, int W){
+    if (!weights){
+        return popcount(B, W);
+    }
+    double total = 0;
+    for (int w(0); w < W; w++){
+        uint64_t bits = B[w];
+        while (bits){
+            total += weights[64 * w + __builtin_ctzll(bits)];
+            bits &= bits - 1;
+        }
+    }
+    return total;
+}
+
+
+
+// Recursion function for treeSHAP on a set B of background instances
+// The returned pair is the sum over B of the pairs returned by `recurse`,
+// each instance being counted with its weight
+template <typename T>
+pair<double, double> recurse_bitset(int n, int depth,
+                                    const RowView<T> &x, const uint64_t* B,
+                                    int* I_map,
+                                    const Tree &tree,
+                                    const uint64_t* go_left, int W,
+                                    const double* weights,
+                                    vector<vector<double>> &W_shap,
+                                    int n_features,
+                                    vector<double> &phi,
+                                    Scratch &S,
+                                    vector<uint64_t> &pool)
+{
+    vector<int> &in_SX = S.in_SX;
+    vector<int> &in_SZ = S.in_SZ;
+    const Node &node = tree.nodes[n];
+
+    // Arriving at a Leaf, all instances of B share the same sets S_X and S_Z
+    if (node.child_left < 0)
+    {
+        double pos(0.0), neg(0.0);
+        int num_players = in_SX[n_features] + in_SZ[n_features];
+        double value = weighted_count(B, weights, W) * node.value;
+        if (in_SX[n_features] > 0)
+        {
+            pos = W_shap[in_SX[n_features]-1][num_players-1] * value;
+        }
+        if (in_SZ[n_features] > 0)
+        {
+            neg = W_shap[in_SX[n_features]][num_players-1] * value;
+        }
+        return make_pair(pos, neg);
+    }
+
+    int x_child = tree.child(n, x[node.feature]);
+    int k = I_map[node.feature];
+    bool x_left = (x_child == node.child_left);
+    int other_child = x_left ? node.child_right : node.child_left;
+
+    // Scenario 1 and 2 with k in I(S_X) : every z goes the way of x
+    if (in_SX[k]){
+        return recurse_bitset(x_child, depth+1, x, B, I_map, tree, go_left, W,
+                              weights, W_shap, n_features, phi, S, pool);
+    }
+
+    // Split B into the instances going the same way as x and the others
+    uint64_t* B_same = &pool[2 * depth * W];
+    uint64_t* B_diff = B_same + W;
+    pair<bool, bool> non_empty = split_bitset(B, go_left + n * W, x_left, B_same, B_diff, W);
+    pair<double, double> result(0.0, 0.0), pairf, pairb;
+
+    // Scenario 1 : x and z go the same way so we avoid the type B edge
+    if (non_empty.first){
+        result = recurse_bitset(x_child, depth+1, x, B_same, I_map, tree, go_left, W,
+                                weights, W_shap, n_features, phi, S, pool);
+    }
+    if (!non_empty.second){
+        return result;
+    }
+
+    // Senario 2 with k in I(S_Z) : the other instances go their own way
+    if (in_SZ[k]){
+        pairb = recurse_bitset(other_child, depth+1, x, B_diff, I_map, tree, go_left, W,
+                               weights, W_shap, n_features, phi, S, pool);
+        return make_pair(result.first + pairb.first, result.second + pairb.second);
+    }
+
+    // Scenario 3 : x and z go different ways and we have not yet seen this feature
+    // Go to x's child
+    S.push_SX(k);
+    pairf = recurse_bitset(x_child, depth+1, x, B_diff, I_map, tree, go_left, W,
+                           weights, W_shap, n_features, phi, S, pool);
+    S.pop_SX(k);
+
+    // Go to z's child
+    S.push_SZ(k);
+    pairb = recurse_bitset(other_child, depth+1, x, B_diff, I_map, tree, go_left, W,
+                           weights, W_shap, n_features, phi, S, pool);
+    S.pop_SZ(k);
+
+    // Add contribution to the feature
+    phi[k] += pairf.first - pairb.second;
+    S.touch(k);
+
+    return make_pair(result.first + pairf.first + pairb.first,
+                     result.second + pairf.second + pairb.second);
+}
+
+
+
+// Recursion function for computing Anova 1 on a set B of background instances,
+// the bit b of B stands for the column col_start + b. Leaves scatter their
+// contribution to the entries A[i][j] and A[j][i] of every j in B.
+template <typename T>
+int recurse_bitset_3(int n, int depth,
+                     const RowView<T> &x, const uint64_t* B,
+                     int* I_map,
+                     const Tree &tree,
+                     const uint64_t* go_left, int W,
+                     int n_features,
+                     int row, const TensorView<double> &A_rows,
+                     const TensorView<double> &A_cols,
+                     Scratch &S,
+                     vector<uint64_t> &pool)
+{
+    vector<int> &in_SX = S.in_SX;
+    vector<int> &in_SZ = S.in_SZ;
+    const Node &node = tree.nodes[n];
+
+    // Arriving at a Leaf
+    if (node.child_left < 0)
+    {
+        int size_SX = in_SX[n_features];
+        int size_SZ = in_SZ[n_features];
+        for (int w(0); w < W; w++){
+            uint64_t bits = B[w];
+            while (bits){
+                int col = 64 * w + __builtin_ctzll(bits);
+                bits &= bits - 1;
+                // |S_X| = 0 so EACH element of S_Z gets a contribution
+                if (size_SX == 0){
+                    for (int a(0); a < size_SZ; a++){
+                        A_rows(row, col, S.members_SZ[a]) -= node.value;
+                    }
+                }
+                // |S_X| = 1 so the SINGLE element of S_X gets a contribution
+                else if (size_SX == 1){
+                    A_rows(row, col, S.members_SX[0]) += node.value;
+                }
+                // |S_Z| = 0 so EACH element of S_X gets a contribution
+                if (size_SZ == 0){
+                    for (int a(0); a < size_SX; a++){
+                        A_cols(col, row, S.members_SX[a]) -= node.value;
+                    }
+                }
+                // |S_Z| = 1 so the SINGLE element of S_Z gets a contribution
+                else if (size_SZ == 1){
+                    A_cols(col, row, S.members_SZ[0]) += node.value;
+                }
+            }
+        }
+        return 0;
+    }
+
+    int x_child = tree.child(n, x[node.feature]);
+    int k = I_map[node.feature];
+    bool x_left = (x_child == node.child_left);
+    int other_child = x_left ? node.child_right : node.child_left;
+
+    // Scenario 1 and 2 with k in S_X : every z goes the way of x
+    if (in_SX[k]){
+        return recurse_bitset_3(x_child, depth+1, x, B, I_map, tree, go_left, W, n_features,
+                                row, A_rows, A_cols, S, pool);
+    }
+
+    // Split B into the instances going the same way as x and the others
+    uint64_t* B_same = &pool[2 * depth * W];
+    uint64_t* B_diff = B_same + W;
+    pair<bool, bool> non_empty = split_bitset(B, go_left + n * W, x_left, B_same, B_diff, W);
+
+    // Scenario 1 : x and z go the same way so we avoid the type B edge
+    if (non_empty.first){
+        recurse_bitset_3(x_child, depth+1, x, B_same, I_map, tree, go_left, W, n_features,
+                         row, A_rows, A_cols, S, pool);
+    }
+    if (!non_empty.second){
+        return 0;
+    }
+
+    // Senario 2 with k in S_Z : the other instances go their own way
+    if (in_SZ[k]){
+        return recurse_bitset_3(other_child, depth+1, x, B_diff, I_map, tree, go_left, W, n_features,
+                                row, A_rows, A_cols, S, pool);
+    }
+
+    // Scenario 3 : x and z go different ways and we have not yet seen this feature
+    // Go to x's child if it is allowed
+    if (in_SX[n_features] == 0 || in_SZ[n_features] <= 1){
+        S.push_SX(k);
+        recurse_bitset_3(x_child, depth+1, x, B_diff, I_map, tree, go_left, W, n_features,
+                         row, A_rows, A_cols, S, pool);
+        S.pop_SX(k);
+    }
+
+    // Go to z's child if it is allowed
+    if (in_SX[n_features] <= 1 || in_SZ[n_features] == 0){
+        S.push_SZ(k);
+        recurse_bitset_3(other_child, depth+1, x, B_diff, I_map, tree, go_left, W, n_features,
+                         row, A_rows, A_cols, S, pool);
+        S.pop_SZ(k);
+    }
+    return 0;
+}
+
+
+
+
+// Interventional TreeSHAP where the background goes through each tree as a bitset
+template <typename T, typename R>
+void int_treeSHAP_bitset(const MatrixView<T> &X_f, int Nx,
+                         const MatrixView<T> &X_b, int Nz,
+                         const double* weights,
+                         int n_columns, int max_depth,
+                         int* I_map,
+                         const TreeEnsemble &trees,
+                         Matrix<double> &W_shap,
+                         const MatrixView<R> &phi_f_b,
+                         int n_jobs)
+    {
+    // Setup
+    int n_features = I_map[n_columns-1] + 1;
+    int n_trees = trees.n_trees;
+    int n_threads = get_n_threads(n_jobs, Nx);
+    int W = n_words(Nz);
+
+    // Branches taken by the background instances
+    vector<uint64_t> go_left = compute_go_left(X_b, 0, Nz, trees, get_n_threads(n_jobs, n_trees));
+    vector<uint64_t> all_background(W, ~uint64_t(0));
+    if (Nz % 64) all_background[W-1] = (uint64_t(1) << (Nz % 64)) - 1;
+    double total_weight = weighted_count(all_background.data(), weights, W);
+
+    // Per-thread scratch buffers, two bitsets per level of the trees
+    vector<Scratch> scratch(n_threads, Scratch(n_features));
+    Matrix<double> acc_phi(n_threads, vector<double> (n_features, 0));
+    Matrix<uint64_t> pools(n_threads, vector<uint64_t> (2 * (max_depth+1) * W));
+
+    progressbar bar(Nx);
+    mutex bar_mutex;
+    // Iterate over all foreground instances, each one is handled by a single thread
+    parallel_for(Nx, n_threads, [&](int thread_id, int i){
+        Scratch &S = scratch[thread_id];
+        vector<double> &phi = acc_phi[thread_id];
+        RowView<T> x = X_f.row(i);
+        // Iterate over all trees, the whole background at once
+        for (int t(0); t < n_trees; t++){
+            recurse_bitset(0, 0, x, all_background.data(), I_map, trees.tree(t),
+                           &go_left[trees.offsets[t] * W], W, weights, W_shap, n_features, phi, S,
+                           pools[thread_id]);
+        }
+        // Add the contributions and rescale w.r.t the total weight of the background
+        for (int m(0); m < S.n_touched; m++){
+            int f = S.touched[m];
+            phi_f_b(i, f) += phi[f] / total_weight;
+            phi[f] = 0;
+        }
+        S.clear_touched();
+        lock_guard<mutex> lock(bar_mutex);
+        bar.update();
+    });
+}
+
+
+
+// Additive-TreeSHAP on a block, see `additive_treeSHAP`, where the columns
+// of the block go through each tree as a bitset
+template <typename T, typename R>
+void additive_treeSHAP_bitset(const MatrixView<T> &X_f,
+                              int row_start, int row_end,
+                              const MatrixView<T> &X_b,
+                              int col_start, int col_end,
+                              bool symmetric,
+                              int n_features, int* I_map, const int* feature_columns, int max_depth,
+                              const TreeEnsemble &trees,
+                              const TensorView<R> &A_rows,
+                              const TensorView<R> &A_cols,
+                              int n_jobs)
+{
+    // Setup
+    int n_trees = trees.n_trees;
+    int n_rows = row_end - row_start;
+    int n_cols = col_end - col_start;
+    int n_threads = get_n_threads(n_jobs, n_rows);
+    int W = n_words(n_cols);
+
+    // Branches taken by the instances of the columns
+    vector<uint64_t> go_left = compute_go_left(X_b, col_start, col_end, trees, get_n_threads(n_jobs, n_trees));
+
+    // Per-thread scratch buffers, two bitsets per level of the trees
+    vector<Scratch> scratch(n_threads, Scratch(n_features));
+    Matrix<uint64_t> columns(n_threads, vector<uint64_t> (W));
+    // The leaves of all trees are summed in double precision into the entries
+    // A[i][j] and A[j][i] of the current row before they are stored
+    Matrix<double> acc_rows(n_threads, vector<double> (n_cols * n_features, 0));
+    Matrix<double> acc_cols(n_threads, vector<double> (n_cols * n_features, 0));
+    int64_t acc_rows_strides[3] = {0, n_features, 1};
+    int64_t acc_cols_strides[3] = {n_features, 0, 1};
+    Matrix<uint64_t> pools(n_threads, vector<uint64_t> (2 * (max_depth+1) * W));
+
+    progressbar bar(n_rows);
+    mutex bar_mutex;
+    // Iterate over all foreground instances
+    parallel_for(n_rows, n_threads, [&](int thread_id, int row){
+        int i = row_start + row;
+        // Only the pairs (i, j) with j > i are computed in the symmetric case
+        int first = symmetric ? max(col_start, i+1) - col_start : 0;
+        if (first < n_cols){
+            vector<uint64_t> &B = columns[thread_id];
+            for (int w(0); w < W; w++){
+                B[w] = 0;
+            }
+            for (int b(first); b < n_cols; b++){
+                B[b / 64] |= uint64_t(1) << (b % 64);
+            }
+            RowView<T> x = X_f.row(i);
+            vector<double> &buffer_rows = acc_rows[thread_id];
+            vector<double> &buffer_cols = acc_cols[thread_id];
+            TensorView<double> acc_A_rows(buffer_rows.data(), acc_rows_strides);
+            TensorView<double> acc_A_cols(buffer_cols.data(), acc_cols_strides);
+            // Iterate over all trees in the ensemble, the whole block at once
+            for (int t(0); t < n_trees; t++){
+                recurse_bitset_3(0, 0, x, B.data(), I_map, trees.tree(t), &go_left[trees.offsets[t] * W], W,
+                                 n_features, 0, acc_A_rows, acc_A_cols, scratch[thread_id], pools[thread_id]);
+            }
+            // Store the entries of the row
+            for (int b(first); b < n_cols; b++){
+                for (int k(0); k < n_features; k++){
+                    int c = feature_columns[k];
+                    if (c >= 0){
+                        A_rows(row, b, c) += buffer_rows[b * n_features + k];
+                        if (symmetric){
+                            A_cols(b, row, c) += buffer_cols[b * n_features + k];
+                        }
+                    }
+                    buffer_rows[b * n_features + k] = 0;
+                    buffer_cols[b * n_features + k] = 0;
+                }
+            }
+        }
+        lock_guard<mutex> lock(bar_mutex);
+        bar.update();
+    });
+}
+
+# endif
@@ -1,153 +1,313 @@
 #include <stdexcept>
+#include <algorithm>
 #include "recursive_treeshap.hpp"
 #include "stack_treeshap.hpp"
+#include "bitset_treeshap.hpp"
 
 
 
 ////// Wrapping the C++ functions with a C interface //////
 
+// The instances are read in place from the NumPy buffers, whose
+// element type is given by one of these codes. The unsigned integer
+// types hold the rank of each value among the thresholds of its feature.
+#define DTYPE_FLOAT64 0
+#define DTYPE_FLOAT32 1
+#define DTYPE_UINT8 2
+#define DTYPE_UINT16 3
+
+// Run the statement with T set to the element type of the instances
+#define DISPATCH_DTYPE(dtype, ...) \
+    switch (dtype) { \
+        case DTYPE_FLOAT32: { typedef float T; __VA_ARGS__; break; } \
+        case DTYPE_UINT8: { typedef uint8_t T; __VA_ARGS__; break; } \
+        case DTYPE_UINT16: { typedef uint16_t T; __VA_ARGS__; break; } \
+        default: { typedef double T; __VA_ARGS__; } \
+    }
+
+// Number of players when the d columns are grouped by I_map
+inline int n_groups(int* I_map, int d){
+    return *max_element(I_map, I_map + d) + 1;
+}
+
+// Run the statement with R set to the element type of the results, the
+// sums over trees are always carried out in double precision
+#define DISPATCH_RESULT(result_dtype, ...) \
+    switch (result_dtype) { \
+        case DTYPE_FLOAT32: { typedef float R; __VA_ARGS__; break; } \
+        default: { typedef double R; __VA_ARGS__; } \
+    }
+
 
 
 extern "C"
-int main_int_treeshap(int Nx, int Nz, int Nt, int d, int depth, double* foreground, double* background,
-                      int* I_map, double* threshold_, double* value_, int* feature_, 
-                      int* left_child_, int* right_child_, double* result) {
-    // Load data instances
-    Matrix<double> X_f = createMatrix<double>(Nx, d, foreground);
-    Matrix<double> X_b = createMatrix<double>(Nz, d, background);
+int main_int_treeshap(int Nx, int Nz, int Nt, int d, int depth,
+                      void* foreground, int64_t* foreground_strides,
+                      void* background, int64_t* background_strides,
+                      double* weights, int dtype,
+                      int* I_map, void* nodes_, int64_t* offsets_, bool symmetric,
+                      void* result, int64_t* result_strides, int result_dtype, 
+                      int64_t* stats, bool memoize, bool use_bitset, int n_jobs) {
+    // Load tree structure
+    TreeEnsemble trees {Nt, (Node*) nodes_, offsets_};
+
+    // Precompute the SHAP weights
+    int n_features = n_groups(I_map, d);
+    Matrix<double> W(n_features, vector<double> (n_features));
+    compute_W(W);
+
+    // The results are written straight into the output array, the bitset
+    // kernel pushes the whole background at once and is never symmetric
+    if (use_bitset) {
+        DISPATCH_DTYPE(dtype, DISPATCH_RESULT(result_dtype,
+            int_treeSHAP_bitset(MatrixView<T>((T*) foreground, foreground_strides), Nx,
+                                MatrixView<T>((T*) background, background_strides), Nz,
+                                weights, d, depth, I_map, trees, W, 
+                                MatrixView<R>((R*) result, result_strides), n_jobs)))
+    }
+    else {
+        DISPATCH_DTYPE(dtype, DISPATCH_RESULT(result_dtype,
+            int_treeSHAP(MatrixView<T>((T*) foreground, foreground_strides), Nx,
+                         MatrixView<T>((T*) background, background_strides), Nz,
+                         symmetric, weights, d, I_map, trees, W, 
+                         MatrixView<R>((R*) result, result_strides), stats, memoize, n_jobs)))
+    }
+    std::cout << std::endl;
+    return 0;
+}
+
 
+
+extern "C"
+int main_regional_treeshap(int N, int Nt, int d, int depth,
+                           void* X, int64_t* X_strides, double* weights, int dtype,
+                           int* labels, int n_labellings,
+                           int* I_map, void* nodes_, int64_t* offsets_,
+                           void* result, int64_t* result_strides, int result_dtype, 
+                           int64_t* stats, int n_jobs) {
     // Load tree structure
-    Matrix<double> threshold = createMatrix<double>(Nt, depth, threshold_);
-    Matrix<double> value = createMatrix<double>(Nt, depth, value_);
-    Matrix<int> feature = createMatrix<int>(Nt, depth, feature_);
-    Matrix<int> left_child  = createMatrix<int>(Nt, depth, left_child_);
-    Matrix<int> right_child = createMatrix<int>(Nt, depth, right_child_);
+    TreeEnsemble trees {Nt, (Node*) nodes_, offsets_};
 
     // Precompute the SHAP weights
-    int n_features = I_map[d-1] + 1;
+    int n_features = n_groups(I_map, d);
     Matrix<double> W(n_features, vector<double> (n_features));
     compute_W(W);
-    
-    Matrix<double> phi = int_treeSHAP(X_f, X_b, I_map, 
-                                     feature, left_child, right_child, 
-                                     threshold, value, W);
+
+    // The results of all labellings are written straight into the output array
+    DISPATCH_DTYPE(dtype, DISPATCH_RESULT(result_dtype,
+        regional_treeSHAP(MatrixView<T>((T*) X, X_strides), N, weights, labels, n_labellings,
+                          n_features, I_map, trees, W, 
+                          TensorView<R>((R*) result, result_strides), stats, n_jobs)))
     std::cout << std::endl;
-    
-    // Save the results
-    for (int i(0); i < Nx; i++){
-        for (int j(0); j < n_features; j++){
-            result[i*n_features + j] = phi[i][j];
-        }
-    }
     return 0;
 }
 
 
 
+extern "C"
+int main_pair_treeshap(int Nx, int Nz, int Nt, int d, int depth,
+                       void* foreground, int64_t* foreground_strides,
+                       void* background, int64_t* background_strides, int dtype,
+                       int* I_map, void* nodes_, int64_t* offsets_,
+                       void* result, int64_t* result_strides, int result_dtype, int n_jobs) {
+    // Load tree structure
+    TreeEnsemble trees {Nt, (Node*) nodes_, offsets_};
+
+    // Precompute the SHAP weights
+    int n_features = n_groups(I_map, d);
+    Matrix<double> W(n_features, vector<double> (n_features));
+    compute_W(W);
+
+    // The Shapley values of each pair are written straight into the output array
+    DISPATCH_DTYPE(dtype, DISPATCH_RESULT(result_dtype,
+        pair_treeSHAP(MatrixView<T>((T*) foreground, foreground_strides), Nx,
+                      MatrixView<T>((T*) background, background_strides), Nz,
+                      n_features, I_map, trees, W, 
+                      TensorView<R>((R*) result, result_strides), n_jobs)))
+    std::cout << std::endl;
+    return 0;
+}
+
+
 
 extern "C"
-int main_taylor_treeshap(int Nx, int Nz, int Nt, int d, int depth, double* foreground, double* background,
-                         double* threshold_, double* value_, int* feature_, int* left_child_, int* right_child_,
-                         double* result) {
-    
-    // Load data instances
-    Matrix<double> X_f = createMatrix<double>(Nx, d, foreground);
-    Matrix<double> X_b = createMatrix<double>(Nz, d, background);
+int main_taylor_treeshap(int Nx, int Nz, int Nt, int d, int depth,
+                         void* foreground, int64_t* foreground_strides,
+                         void* background, int64_t* background_strides, int dtype,
+                         int* I_map, void* nodes_, int64_t* offsets_, bool symmetric,
+                         double* result, int64_t* result_strides, int n_jobs) {
 
     // Load tree structure
-    Matrix<double> threshold = createMatrix<double>(Nt, depth, threshold_);
-    Matrix<double> value = createMatrix<double>(Nt, depth, value_);
-    Matrix<int> feature = createMatrix<int>(Nt, depth, feature_);
-    Matrix<int> left_child  = createMatrix<int>(Nt, depth, left_child_);
-    Matrix<int> right_child = createMatrix<int>(Nt, depth, right_child_);
+    TreeEnsemble trees {Nt, (Node*) nodes_, offsets_};
 
     // Precompute the SHAP weights
-    Matrix<double> W(d, vector<double> (d));
+    int n_features = n_groups(I_map, d);
+    Matrix<double> W(n_features, vector<double> (n_features));
     compute_W(W);
 
-    Tensor<double> phi = taylor_treeSHAP(X_f, X_b, feature, left_child, right_child, 
-                                                 threshold, value, W);
+    // The results are written straight into the output array
+    TensorView<double> phi(result, result_strides);
+    DISPATCH_DTYPE(dtype,
+        taylor_treeSHAP(MatrixView<T>((T*) foreground, foreground_strides), Nx,
+                        MatrixView<T>((T*) background, background_strides), Nz,
+                        symmetric, n_features, I_map, trees, W, phi, n_jobs))
     cout << endl;
+    return 0;
+}
+
 
-    // Save the results
-    for (unsigned int i(0); i < phi.size(); i++){
-        for (int j(0); j < d; j++){
-            for (int k(0); k < d; k++){
-                result[i*d*d + j*d + k] = phi[i][j][k];
-            }
-        }
+
+
+
+extern "C"
+int main_additive_treeshap(int Nx, int Nz, int Nt, int d, int depth,
+                           void* foreground, int64_t* foreground_strides,
+                           void* background, int64_t* background_strides, int dtype,
+                           int* I_map, void* nodes_, int64_t* offsets_,
+                           int row_start, int row_end, int col_start, int col_end, bool symmetric,
+                           int* feature_columns,
+                           void* result_rows, int64_t* result_rows_strides,
+                           void* result_cols, int64_t* result_cols_strides, int result_dtype,
+                           int64_t* stats, bool memoize, bool use_bitset, int n_jobs) {
+
+    // Load tree structure
+    TreeEnsemble trees {Nt, (Node*) nodes_, offsets_};
+
+    // The results are written straight into the output arrays
+    int n_features = n_groups(I_map, d);
+    if (use_bitset) {
+        DISPATCH_DTYPE(dtype, DISPATCH_RESULT(result_dtype,
+            additive_treeSHAP_bitset(MatrixView<T>((T*) foreground, foreground_strides), row_start, row_end,
+                                     MatrixView<T>((T*) background, background_strides), col_start, col_end,
+                                     symmetric, n_features, I_map, feature_columns, depth, trees, 
+                                     TensorView<R>((R*) result_rows, result_rows_strides),
+                                     TensorView<R>((R*) result_cols, result_cols_strides), n_jobs)))
     }
+    else {
+        DISPATCH_DTYPE(dtype, DISPATCH_RESULT(result_dtype,
+            additive_treeSHAP(MatrixView<T>((T*) foreground, foreground_strides), row_start, row_end,
+                              MatrixView<T>((T*) background, background_strides), col_start, col_end,
+                              symmetric, n_features, I_map, feature_columns, trees, 
+                              TensorView<R>((R*) result_rows, result_rows_strides),
+                              TensorView<R>((R*) result_cols, result_cols_strides), stats, memoize, n_jobs)))
+    }
+    cout << endl;
     return 0;
 }
 
 
 
+extern "C"
+int main_fused_treeshap(int Nx, int Nz, int Nt, int d, int depth,
+                        void* foreground, int64_t* foreground_strides,
+                        void* background, int64_t* background_strides, int dtype,
+                        int* I_map, void* nodes_, int64_t* offsets_, int outputs,
+                        double* shap, int64_t* shap_strides,
+                        double* taylor, int64_t* taylor_strides,
+                        double* additive, int64_t* additive_strides,
+                        double* A, int64_t* A_strides, int n_jobs) {
+
+    // Load tree structure
+    TreeEnsemble trees {Nt, (Node*) nodes_, offsets_};
+
+    // Precompute the SHAP weights
+    int n_features = n_groups(I_map, d);
+    Matrix<double> W(n_features, vector<double> (n_features));
+    compute_W(W);
+
+    // All the requested outputs are written straight into their arrays
+    DISPATCH_DTYPE(dtype,
+        fused_treeSHAP(MatrixView<T>((T*) foreground, foreground_strides), Nx,
+                       MatrixView<T>((T*) background, background_strides), Nz,
+                       n_features, I_map, trees, W, outputs,
+                       MatrixView<double>(shap, shap_strides),
+                       TensorView<double>(taylor, taylor_strides),
+                       TensorView<double>(additive, additive_strides),
+                       MatrixView<double>(A, A_strides), n_jobs))
+    cout << endl;
+    return 0;
+}
+
 
 
 extern "C"
-int main_additive_treeshap(int N, int Nt, int d, int depth, double* X,
-                         double* threshold_, double* value_, int* feature_, 
-                         int* left_child_, int* right_child_,
-                         double* result) {
-    
-    // Load data instances
-    Matrix<double> X_ = createMatrix<double>(N, d, X);
+int main_taylor_treeshap_reduce(int Nx, int Nz, int Nt, int d, int depth,
+                                void* foreground, int64_t* foreground_strides,
+                                void* background, int64_t* background_strides, int dtype,
+                                int* I_map, void* nodes_, int64_t* offsets_,
+                                double* result, int64_t* result_strides, double* totals, int n_jobs) {
 
     // Load tree structure
-    Matrix<double> threshold = createMatrix<double>(Nt, depth, threshold_);
-    Matrix<double> value = createMatrix<double>(Nt, depth, value_);
-    Matrix<int> feature = createMatrix<int>(Nt, depth, feature_);
-    Matrix<int> left_child  = createMatrix<int>(Nt, depth, left_child_);
-    Matrix<int> right_child = createMatrix<int>(Nt, depth, right_child_);
+    TreeEnsemble trees {Nt, (Node*) nodes_, offsets_};
+
+    // Precompute the SHAP weights
+    int n_features = n_groups(I_map, d);
+    Matrix<double> W(n_features, vector<double> (n_features));
+    compute_W(W);
 
-    Tensor<double> A = additive_treeSHAP(X_, feature, left_child, right_child, threshold, value);
+    // Only the d x d mean of squares is stored
+    MatrixView<double> phi2_mean(result, result_strides);
+    DISPATCH_DTYPE(dtype,
+        taylor_treeSHAP_reduce(MatrixView<T>((T*) foreground, foreground_strides), Nx,
+                               MatrixView<T>((T*) background, background_strides), Nz,
+                               n_features, I_map, trees, W, phi2_mean, totals, n_jobs))
     cout << endl;
+    return 0;
+}
 
-    // Save the results
-    for (int i(0); i < N; i++){
-        for (int j(0); j < N; j++){
-            for (int k(0); k < d; k++){
-                result[i*N*d + d*j + k] = A[i][j][k];
-            }
-        }
-    }
+
+
+extern "C"
+int main_additive_treeshap_reduce(int N, int Nt, int d, int depth,
+                                  void* X, int64_t* X_strides, int dtype,
+                                  int* I_map, void* nodes_, int64_t* offsets_,
+                                  double* row_mean_, int64_t* row_mean_strides,
+                                  double* col_mean_, int64_t* col_mean_strides, int n_jobs) {
+
+    // Load tree structure
+    TreeEnsemble trees {Nt, (Node*) nodes_, offsets_};
+
+    // Only the N x d row and column means are stored
+    MatrixView<double> row_mean(row_mean_, row_mean_strides);
+    MatrixView<double> col_mean(col_mean_, col_mean_strides);
+    DISPATCH_DTYPE(dtype,
+        additive_treeSHAP_reduce(MatrixView<T>((T*) X, X_strides), N, n_groups(I_map, d), I_map, trees,
+                                 row_mean, col_mean, n_jobs))
+    cout << endl;
     return 0;
 }
 
 
 
 extern "C"
-int main_A_treeshap(int N, int Nt, int d, int depth, double* X,
-                         double* threshold_, double* value_, int* feature_, 
-                         int* left_child_, int* right_child_,
-                         double* result, bool use_stack) {
-    
-    // Load data instances
-    Matrix<double> X_ = createMatrix<double>(N, d, X);
+int main_A_treeshap(int Nx, int Nz, int Nt, int d, int depth,
+                    void* foreground, int64_t* foreground_strides,
+                    void* background, int64_t* background_strides, int dtype,
+                    int* I_map, void* nodes_, int64_t* offsets_, bool symmetric,
+                    void* result, int64_t* result_strides, int result_dtype, 
+                    int64_t* stats, bool memoize, bool use_stack, int n_jobs) {
 
     // Load tree structure
-    Matrix<double> threshold = createMatrix<double>(Nt, depth, threshold_);
-    Matrix<double> value = createMatrix<double>(Nt, depth, value_);
-    Matrix<int> feature = createMatrix<int>(Nt, depth, feature_);
-    Matrix<int> left_child  = createMatrix<int>(Nt, depth, left_child_);
-    Matrix<int> right_child = createMatrix<int>(Nt, depth, right_child_);
+    TreeEnsemble trees {Nt, (Node*) nodes_, offsets_};
 
-    Matrix<double> A;
+    // The results are written straight into the output array
+    int n_features = n_groups(I_map, d);
     if (use_stack) {
         cout << "Using Stack" << endl;
-        A = A_treeSHAP_stack(X_, feature, left_child, right_child, threshold, value);
+        DISPATCH_DTYPE(dtype, DISPATCH_RESULT(result_dtype,
+            A_treeSHAP_stack(MatrixView<T>((T*) foreground, foreground_strides), Nx,
+                             MatrixView<T>((T*) background, background_strides), Nz,
+                             symmetric, n_features, I_map, depth, trees, 
+                             MatrixView<R>((R*) result, result_strides), n_jobs)))
     }
     else {
         cout << "Using Recursion" << endl;
-        A = A_treeSHAP_recurse(X_, feature, left_child, right_child, threshold, value);
+        DISPATCH_DTYPE(dtype, DISPATCH_RESULT(result_dtype,
+            A_treeSHAP_recurse(MatrixView<T>((T*) foreground, foreground_strides), Nx,
+                               MatrixView<T>((T*) background, background_strides), Nz,
+                               symmetric, n_features, I_map, trees, 
+                               MatrixView<R>((R*) result, result_strides), stats, memoize, n_jobs)))
     }
     cout << endl;
-
-    // Save the results
-    for (int i(0); i < N; i++){
-        for (int j(0); j < N; j++){
-            result[i*N + j] = A[i][j];
-        }
-    }
     return 0;
-}
\ No newline at end of file
+}
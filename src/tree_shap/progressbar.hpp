@@ -133,6 +133,7 @@ inline void progressbar::update() {
     if (n_cycles == 0) throw std::runtime_error(
             "progressbar::update: number of cycles not set");
 
+    bool first_update = !update_is_called;
     if (!update_is_called) {
         if (do_show_bar == true) {
             output << opening_bracket_char;
@@ -149,6 +150,12 @@ inline void progressbar::update() {
     perc = progress*100./(n_cycles-1);
     if (perc < last_perc) return;
 
+    // nothing to redraw until the percentage changes
+    if (!first_update && perc == last_perc) {
+        ++progress;
+        return;
+    }
+
     // update percentage each unit
     if (perc == last_perc + 1) {
         // erase the correct  number of characters
@@ -10,92 +10,79 @@
 #include <cstdlib>
 #include <iomanip>
 #include <stdexcept>
+#include <algorithm>
 #include "progressbar.hpp"
 #include "utils.hpp"
 
 // Recursion function for treeSHAP
+template <typename T>
 pair<double, double> recurse(int n,
-                            vector<double> &x, vector<double> &z, 
+                            const RowView<T> &x, const RowView<T> &z,
                             int* I_map,
-                            vector<int> &feature,
-                            vector<int> &child_left,
-                            vector<int> &child_right,
-                            vector<double> &threshold,
-                            vector<double> &value,
+                            const Tree &tree,
                             vector<vector<double>> &W,
                             int n_features,
                             vector<double> &phi,
-                            vector<int> &in_SX,
-                            vector<int> &in_SZ)
+                            Scratch &S)
 {
-    int current_feature = feature[n];
+    vector<int> &in_SX = S.in_SX;
+    vector<int> &in_SZ = S.in_SZ;
+    int current_feature = tree.nodes[n].feature;
     int x_child(0), z_child(0);
     // num_players := |S_{XZ}|
     int num_players = 0;
 
     // Arriving at a Leaf
-    if (child_left[n] < 0)
+    if (tree.nodes[n].child_left < 0)
     {
         double pos(0.0), neg(0.0);
         num_players = in_SX[n_features] + in_SZ[n_features];
         if (in_SX[n_features] > 0)
         {
-            pos = W[in_SX[n_features]-1][num_players-1] * value[n];
+            pos = W[in_SX[n_features]-1][num_players-1] * tree.nodes[n].value;
         }
         if (in_SZ[n_features] > 0)
         {
-            neg = W[in_SX[n_features]][num_players-1] * value[n];
+            neg = W[in_SX[n_features]][num_players-1] * tree.nodes[n].value;
         }
         return make_pair(pos, neg);
     }
     
     // Find children of x and z
-    if (x[current_feature] <= threshold[n]){
-        x_child = child_left[n];
-    } else {x_child = child_right[n];}
-    if (z[current_feature] <= threshold[n]){
-        z_child = child_left[n];
-    } else {z_child = child_right[n];}
+    x_child = tree.child(n, x[current_feature]);
+    z_child = tree.child(n, z[current_feature]);
 
     // Scenario 1 : x and z go the same way so we avoid the type B edge
     if (x_child == z_child){
-        return recurse(x_child, x, z, I_map, feature, child_left, child_right,
-                            threshold, value, W, n_features, phi, in_SX, in_SZ);
+        return recurse(x_child, x, z, I_map, tree, W, n_features, phi, S);
     }
 
     // Senario 2: x and z go different ways and we have seen this feature i in I(S_X) U I(S_Z).
     // Hence we go down the correct edge to ensure that I(S_X) and I(S_Z) are kept disjoint
     if (in_SX[ I_map[current_feature] ] || in_SZ[ I_map[current_feature] ]){
         if (in_SX[ I_map[current_feature] ]){
-            return recurse(x_child, x, z, I_map, feature, child_left, child_right,
-                            threshold, value, W, n_features, phi, in_SX, in_SZ);
+            return recurse(x_child, x, z, I_map, tree, W, n_features, phi, S);
         }
         else{
-            return recurse(z_child, x, z, I_map, feature, child_left, child_right,
-                            threshold, value, W, n_features, phi, in_SX, in_SZ);
+            return recurse(z_child, x, z, I_map, tree, W, n_features, phi, S);
         }
     }
 
     // Scenario 3 : x and z go different ways and we have not yet seen this feature
     else {
         // Go to x's child
-        in_SX[ I_map[current_feature] ]++;
-        in_SX[n_features]++;
-        pair<double, double> pairf = recurse(x_child, x, z, I_map, feature, child_left, child_right,
-                                            threshold, value, W, n_features, phi, in_SX, in_SZ);
-        in_SX[ I_map[current_feature] ]--;
-        in_SX[n_features]--;
+        S.push_SX(I_map[current_feature]);
+        pair<double, double> pairf = recurse(x_child, x, z, I_map, tree, W, n_features, phi, S);
+        S.pop_SX(I_map[current_feature]);
 
         // Go to z's child
-        in_SZ[ I_map[current_feature] ]++;
-        in_SZ[n_features]++;
-        pair<double, double> pairb = recurse(z_child, x, z, I_map, feature, child_left, child_right,
-                                            threshold, value, W, n_features, phi, in_SX, in_SZ);
-        in_SZ[ I_map[current_feature] ]--;
-        in_SZ[n_features]--;
+        S.push_SZ(I_map[current_feature]);
+        pair<double, double> pairb = recurse(z_child, x, z, I_map, tree, W, n_features, phi, S);
+        S.pop_SZ(I_map[current_feature]);
 
         // Add contribution to the feature
         phi[ I_map[current_feature] ] += pairf.first - pairb.second;
+        S.touch(I_map[current_feature]);
 
         return make_pair(pairf.first + pairb.first, pairf.second + pairb.second);
     }
@@ -103,106 +90,131 @@ pair<double, double> recurse(int n,
 
 
 
-// Recursion function for Taylor-TreeSHAP
+// Shapley-Taylor interactions at a leaf reached with the sets S_X and S_Z. Only the pairs
+// formed by members of S_X U S_Z are non-zero. The matrix is symmetric so only the entry
+// (min(i, j), max(i, j)) is updated and the caller mirrors it
+inline void taylor_leaf(const vector<int> &members_SX, int size_SX,
+                        const vector<int> &members_SZ, int size_SZ,
+                        double value,
+                        vector<vector<double>> &W,
+                        int n_features,
+                        vector<double> &phi)
+{
+    int num_players = size_SX + size_SZ;
+    // Diagonal element
+    // i in S_Z and S_X is empty
+    if (size_SX == 0){
+        for (int a(0); a < size_SZ; a++){
+            int i = members_SZ[a];
+            phi[i * n_features + i] -= value;
+        }
+    }
+    // S_X = {i}
+    if (size_SX == 1){
+        int i = members_SX[0];
+        phi[i * n_features + i] += value;
+    }
+    // Non-diagonal elements
+    // i,j in S_X
+    if (size_SX >= 2){
+        double w = W[size_SX-2][num_players-1] * value;
+        for (int a(0); a < size_SX; a++){
+            for (int b(a+1); b < size_SX; b++){
+                int i = members_SX[a], j = members_SX[b];
+                phi[min(i, j) * n_features + max(i, j)] += w;
+            }
+        }
+    }
+    // i,j in S_Z
+    if (size_SZ >= 2){
+        double w = W[size_SX][num_players-1] * value;
+        for (int a(0); a < size_SZ; a++){
+            for (int b(a+1); b < size_SZ; b++){
+                int i = members_SZ[a], j = members_SZ[b];
+                phi[min(i, j) * n_features + max(i, j)] += w;
+            }
+        }
+    }
+    // i in S_X  and  j in S_Z
+    if (size_SX >= 1 && size_SZ >= 1){
+        double w = W[size_SX-1][num_players-1] * value;
+        for (int a(0); a < size_SX; a++){
+            for (int b(0); b < size_SZ; b++){
+                int i = members_SX[a], j = members_SZ[b];
+                phi[min(i, j) * n_features + max(i, j)] -= w;
+            }
+        }
+    }
+}
+
+
+
+// Recursion function for Taylor-TreeSHAP. The pair (z, x) visits the same paths with
+// S_X and S_Z swapped, so its interactions are added to `phi_swap` when it is not null
+template <typename T>
 int recurse_2(int n,
-            vector<double> &x, vector<double> &z, 
-            vector<int> &feature,
-            vector<int> &child_left,
-            vector<int> &child_right,
-            vector<double> &threshold,
-            vector<double> &value,
+            const RowView<T> &x, const RowView<T> &z,
+            int* I_map,
+            const Tree &tree,
             vector<vector<double>> &W,
             int n_features,
             vector<double> &phi,
-            vector<int> &in_SX,
-            vector<int> &in_SZ)
+            vector<double> *phi_swap,
+            Scratch &S)
 {
-    int current_feature = feature[n];
+    vector<int> &in_SX = S.in_SX;
+    vector<int> &in_SZ = S.in_SZ;
+    int current_feature = tree.nodes[n].feature;
     int x_child(0), z_child(0);
-    // num_players := |S_{AB}|
-    int num_players = 0;
 
     // Arriving at a Leaf
-    if (child_left[n] < 0)
+    if (tree.nodes[n].child_left < 0)
     {
-        num_players = in_SX[n_features] + in_SZ[n_features];
-        if (num_players == 0){
+        int size_SX = in_SX[n_features];
+        int size_SZ = in_SZ[n_features];
+        if (size_SX + size_SZ == 0){
             return 0;
         }
-        for (int i(0); i < n_features; i++){
-            for (int j(0); j < n_features; j++){
-                // Diagonal element
-                if (i == j) {
-                    // i in S_Z and S_X is empty
-                    if (in_SZ[i] && (in_SX[n_features] == 0) ){
-                        phi[i * n_features + i] -= value[n];
-                    }
-                    // S_X = {i}
-                    if (in_SX[i] && (in_SX[n_features] == 1) ){
-                        phi[i * n_features + i] += value[n];
-                    }
-                }
-                // Non-diagonal element
-                else {
-                    // i,j in S_X
-                    if (in_SX[i] && in_SX[j]){
-                        phi[i * n_features + j] += W[in_SX[n_features]-2][num_players-1] * value[n];
-                    }
-                    // i,j in S_Z
-                    else if (in_SZ[i] && in_SZ[j]){
-                        phi[i * n_features + j] += W[in_SX[n_features]][num_players-1] * value[n];
-                    }
-                    // i in S_X  and  j in S_Z   OR
-                    // j in S_X  and  i in S_Z
-                    else if ((in_SX[i] + in_SZ[j] + in_SX[j] + in_SZ[i]) == 2){
-                        phi[i * n_features + j]-= W[in_SX[n_features]-1][num_players-1] * value[n];
-                    }
-                }
-            }
+        double value = tree.nodes[n].value;
+        taylor_leaf(S.members_SX, size_SX, S.members_SZ, size_SZ, value, W, n_features, phi);
+        if (phi_swap){
+            taylor_leaf(S.members_SZ, size_SZ, S.members_SX, size_SX, value, W, n_features, *phi_swap);
         }
         return 0;
     }
 
     // Find children of x and z
-    if (x[current_feature] <= threshold[n]){
-        x_child = child_left[n];
-    } else {x_child = child_right[n];}
-    if (z[current_feature] <= threshold[n]){
-        z_child = child_left[n];
-    } else {z_child = child_right[n];}
+    x_child = tree.child(n, x[current_feature]);
+    z_child = tree.child(n, z[current_feature]);
 
     // Scenario 1 : x and z go the same way so we avoid the type B edge
     if (x_child == z_child){
-        return recurse_2(x_child, x, z, feature, child_left, child_right,
-                            threshold, value, W, n_features, phi, in_SX, in_SZ);
+        return recurse_2(x_child, x, z, I_map, tree, W, n_features, phi, phi_swap, S);
     }
 
-    // Senario 2: x and z go different ways and we have seen this feature i in S_X U S_Z.
-    // Hence we go down the correct edge to ensure that S_X and S_Z are kept disjoint
-    if (in_SX[current_feature] || in_SZ[current_feature]){
-        if (in_SX[current_feature]){
-            return recurse_2(x_child, x, z, feature, child_left, child_right,
-                            threshold, value, W, n_features, phi, in_SX, in_SZ);
+    // Senario 2: x and z go different ways and we have seen this feature i in I(S_X) U I(S_Z).
+    // Hence we go down the correct edge to ensure that I(S_X) and I(S_Z) are kept disjoint
+    if (in_SX[ I_map[current_feature] ] || in_SZ[ I_map[current_feature] ]){
+        if (in_SX[ I_map[current_feature] ]){
+            return recurse_2(x_child, x, z, I_map, tree, W, n_features, phi, phi_swap, S);
         }
         else{
-            return recurse_2(z_child, x, z, feature, child_left, child_right,
-                            threshold, value, W, n_features, phi, in_SX, in_SZ);
+            return recurse_2(z_child, x, z, I_map, tree, W, n_features, phi, phi_swap, S);
         }
     }
 
     // Scenario 3 : x and z go different ways and we have not yet seen this feature
     else {
+        S.touch(I_map[current_feature]);
         // Go to x's child
-        in_SX[current_feature]++; in_SX[n_features]++;
-        recurse_2(x_child, x, z, feature, child_left, child_right,
-                            threshold, value, W, n_features, phi, in_SX, in_SZ);
-        in_SX[current_feature]--; in_SX[n_features]--;
+        S.push_SX(I_map[current_feature]);
+        recurse_2(x_child, x, z, I_map, tree, W, n_features, phi, phi_swap, S);
+        S.pop_SX(I_map[current_feature]);
 
         // Go to z's child
-        in_SZ[current_feature]++; in_SZ[n_features]++;
-        recurse_2(z_child, x, z, feature, child_left, child_right,
-                            threshold, value, W, n_features, phi, in_SX, in_SZ);
-        in_SZ[current_feature]--; in_SZ[n_features]--;
+        S.push_SZ(I_map[current_feature]);
+        recurse_2(z_child, x, z, I_map, tree, W, n_features, phi, phi_swap, S);
+        S.pop_SZ(I_map[current_feature]);
         return 0;
     }
 }
@@ -210,111 +222,84 @@ int recurse_2(int n,
 
 
 // Recursion function for computing Anova 1
+template <typename T>
 int recurse_3(int n,
-            Matrix<double> &X,
-            int i, int j,
-            vector<int> &feature,
-            vector<int> &child_left,
-            vector<int> &child_right,
-            vector<double> &threshold,
-            vector<double> &value,
+            const RowView<T> &x, const RowView<T> &z,
+            int* I_map,
+            const Tree &tree,
             int n_features,
-            Tensor<double> &A,
-            vector<int> &in_SX,
-            vector<int> &in_SZ)
+            vector<double> &A_xz,
+            vector<double> &A_zx,
+            Scratch &S)
 {
-    int current_feature = feature[n];
+    vector<int> &in_SX = S.in_SX;
+    vector<int> &in_SZ = S.in_SZ;
+    int current_feature = tree.nodes[n].feature;
     int x_child(0), z_child(0);
     // num_players := |S_{XZ}|
 
     // Arriving at a Leaf
-    if (child_left[n] < 0)
+    if (tree.nodes[n].child_left < 0)
     {
         // |S_X| = 0 so EACH element of S_Z gets a contribution
         if (in_SX[n_features]==0){
-            int k(0), counter(0);
-            while (counter < in_SZ[n_features]){
-                if (in_SZ[k]){
-                    A[i][j][k] -= value[n];
-                    counter++;
-                }
-                k++;
+            for (int a(0); a < in_SZ[n_features]; a++){
+                A_xz[S.members_SZ[a]] -= tree.nodes[n].value;
             }
         }
         // |S_X| = 1 so the SINGLE element of S_X gets a contribution
         else if (in_SX[n_features]==1){
-            int k(0);
-            while (in_SX[k] == 0){
-                k++;
-            }
-            A[i][j][k] += value[n];
+            A_xz[S.members_SX[0]] += tree.nodes[n].value;
         }
 
         // |S_Z| = 0 so EACH element of S_X gets a contribution
         if (in_SZ[n_features]==0){
-            int k(0), counter(0);
-            while (counter < in_SX[n_features]){
-                if (in_SX[k]){
-                    A[j][i][k] -= value[n];
-                    counter++;
-                }
-                k++;
+            for (int a(0); a < in_SX[n_features]; a++){
+                A_zx[S.members_SX[a]] -= tree.nodes[n].value;
             }
         }
         // |S_Z| = 1 so the SINGLE element of S_Z gets a contribution
         else if (in_SZ[n_features]==1){
-            int k(0);
-            while (in_SZ[k] == 0){
-                k++;
-            }
-            A[j][i][k] += value[n];
+            A_zx[S.members_SZ[0]] += tree.nodes[n].value;
         }
         return 0;
     }
 
     // Find children of x and z
-    if (X[i][current_feature] <= threshold[n]){
-        x_child = child_left[n];
-    } else {x_child = child_right[n];}
-    if (X[j][current_feature] <= threshold[n]){
-        z_child = child_left[n];
-    } else {z_child = child_right[n];}
+    x_child = tree.child(n, x[current_feature]);
+    z_child = tree.child(n, z[current_feature]);
 
     // Scenario 1 : x and z go the same way so we avoid the type B edge
     if (x_child == z_child){
-        return recurse_3(x_child, X, i, j, feature, child_left, child_right,
-                            threshold, value, n_features, A, in_SX, in_SZ);
+        return recurse_3(x_child, x, z, I_map, tree, n_features, A_xz, A_zx, S);
     }
 
-    // Senario 2: x and z go different ways and we have seen this feature i in S_X U S_Z.
-    // Hence we go down the correct edge to ensure that S_X and S_Z are kept disjoint
-    if (in_SX[current_feature] || in_SZ[current_feature]){
-        if (in_SX[current_feature]){
-            return recurse_3(x_child, X, i, j, feature, child_left, child_right,
-                            threshold, value, n_features, A, in_SX, in_SZ);
+    // Senario 2: x and z go different ways and we have seen this feature i in I(S_X) U I(S_Z).
+    // Hence we go down the correct edge to ensure that I(S_X) and I(S_Z) are kept disjoint
+    if (in_SX[ I_map[current_feature] ] || in_SZ[ I_map[current_feature] ]){
+        if (in_SX[ I_map[current_feature] ]){
+            return recurse_3(x_child, x, z, I_map, tree, n_features, A_xz, A_zx, S);
         }
         else{
-            return recurse_3(z_child, X, i, j, feature, child_left, child_right,
-                            threshold, value, n_features, A, in_SX, in_SZ);
+            return recurse_3(z_child, x, z, I_map, tree, n_features, A_xz, A_zx, S);
         }
     }
 
     // Scenario 3 : x and z go different ways and we have not yet seen this feature
     else {
+        S.touch(I_map[current_feature]);
         // Go to x's child if it is allowed
         if (in_SX[n_features] == 0 || in_SZ[n_features] <= 1){
-            in_SX[current_feature]++; in_SX[n_features]++;
-            recurse_3(x_child, X, i, j, feature, child_left, child_right,
-                                threshold, value, n_features, A, in_SX, in_SZ);
-            in_SX[current_feature]--; in_SX[n_features]--;
+            S.push_SX(I_map[current_feature]);
+            recurse_3(x_child, x, z, I_map, tree, n_features, A_xz, A_zx, S);
+            S.pop_SX(I_map[current_feature]);
         }
 
         // Go to z's child if it is allowed
         if (in_SX[n_features] <= 1 || in_SZ[n_features] == 0){
-            in_SZ[current_feature]++; in_SZ[n_features]++;
-            recurse_3(z_child, X, i, j, feature, child_left, child_right,
-                                threshold, value, n_features, A, in_SX, in_SZ);
-            in_SZ[current_feature]--; in_SZ[n_features]--;
+            S.push_SZ(I_map[current_feature]);
+            recurse_3(z_child, x, z, I_map, tree, n_features, A_xz, A_zx, S);
+            S.pop_SZ(I_map[current_feature]);
         }
         return 0;
     }
@@ -324,75 +309,62 @@ int recurse_3(int n,
 
 
 // Recursion function for computing A
+template <typename T>
 int recurse_4(int n,
-            Matrix<double> &X,
-            int i, int j,
-            vector<int> &feature,
-            vector<int> &child_left,
-            vector<int> &child_right,
-            vector<double> &threshold,
-            vector<double> &value,
+            const RowView<T> &x, const RowView<T> &z,
+            int* I_map,
+            const Tree &tree,
             int n_features,
-            Matrix<double> &A,
-            vector<int> &in_SX,
-            vector<int> &in_SZ)
+            double &A_xz,
+            double &A_zx,
+            Scratch &S)
 {
-    int current_feature = feature[n];
+    vector<int> &in_SX = S.in_SX;
+    vector<int> &in_SZ = S.in_SZ;
+    int current_feature = tree.nodes[n].feature;
     int x_child(0), z_child(0);
     // num_players := |S_{XZ}|
 
     // Arriving at a Leaf
-    if (child_left[n] < 0)
+    if (tree.nodes[n].child_left < 0)
     {
-        // Diagonal element
-        if (i == j){
-            A[i][i] += value[n];
-            return 0;
-        }
         // |S_X| = 0 so EACH element of S_Z gets a contribution
         if (in_SX[n_features]==0){
-            A[i][j] += (1 - in_SZ[n_features]) * value[n];
+            A_xz += (1 - in_SZ[n_features]) * tree.nodes[n].value;
         }
         // |S_X| = 1 so the SINGLE element of S_X gets a contribution
         else if (in_SX[n_features]==1){
-            A[i][j] += value[n];
+            A_xz += tree.nodes[n].value;
         }
 
         // |S_Z| = 0 so EACH element of S_X gets a contribution
         if (in_SZ[n_features]==0){
-            A[j][i] += (1 - in_SX[n_features]) * value[n];
+            A_zx += (1 - in_SX[n_features]) * tree.nodes[n].value;
         }
         // |S_Z| = 1 so the SINGLE element of S_Z gets a contribution
         else if (in_SZ[n_features]==1){
-            A[j][i] += value[n];
+            A_zx += tree.nodes[n].value;
         }
         return 0;
     }
 
     // Find children of x and z
-    if (X[i][current_feature] <= threshold[n]){
-        x_child = child_left[n];
-    } else {x_child = child_right[n];}
-    if (X[j][current_feature] <= threshold[n]){
-        z_child = child_left[n];
-    } else {z_child = child_right[n];}
+    x_child = tree.child(n, x[current_feature]);
+    z_child = tree.child(n, z[current_feature]);
 
     // Scenario 1 : x and z go the same way so we avoid the type B edge
     if (x_child == z_child){
-        return recurse_4(x_child, X, i, j, feature, child_left, child_right,
-                            threshold, value, n_features, A, in_SX, in_SZ);
+        return recurse_4(x_child, x, z, I_map, tree, n_features, A_xz, A_zx, S);
     }
 
-    // Senario 2: x and z go different ways and we have seen this feature i in S_X U S_Z.
-    // Hence we go down the correct edge to ensure that S_X and S_Z are kept disjoint
-    if (in_SX[current_feature] || in_SZ[current_feature]){
-        if (in_SX[current_feature]){
-            return recurse_4(x_child, X, i, j, feature, child_left, child_right,
-                            threshold, value, n_features, A, in_SX, in_SZ);
+    // Senario 2: x and z go different ways and we have seen this feature i in I(S_X) U I(S_Z).
+    // Hence we go down the correct edge to ensure that I(S_X) and I(S_Z) are kept disjoint
+    if (in_SX[ I_map[current_feature] ] || in_SZ[ I_map[current_feature] ]){
+        if (in_SX[ I_map[current_feature] ]){
+            return recurse_4(x_child, x, z, I_map, tree, n_features, A_xz, A_zx, S);
         }
         else{
-            return recurse_4(z_child, X, i, j, feature, child_left, child_right,
-                            threshold, value, n_features, A, in_SX, in_SZ);
+            return recurse_4(z_child, x, z, I_map, tree, n_features, A_xz, A_zx, S);
         }
     }
 
@@ -400,18 +372,16 @@ int recurse_4(int n,
     else {
         // Go to x's child if it is allowed
         if (in_SX[n_features] == 0 || in_SZ[n_features] <= 1){
-            in_SX[current_feature]++; in_SX[n_features]++;
-            recurse_4(x_child, X, i, j, feature, child_left, child_right,
-                                threshold, value, n_features, A, in_SX, in_SZ);
-            in_SX[current_feature]--; in_SX[n_features]--;
+            S.push_SX(I_map[current_feature]);
+            recurse_4(x_child, x, z, I_map, tree, n_features, A_xz, A_zx, S);
+            S.pop_SX(I_map[current_feature]);
         }
 
         // Go to z's child if it is allowed
         if (in_SX[n_features] <= 1 || in_SZ[n_features] == 0){
-            in_SZ[current_feature]++; in_SZ[n_features]++;
-            recurse_4(z_child, X, i, j, feature, child_left, child_right,
-                                threshold, value, n_features, A, in_SX, in_SZ);
-            in_SZ[current_feature]--; in_SZ[n_features]--;
+            S.push_SZ(I_map[current_feature]);
+            recurse_4(z_child, x, z, I_map, tree, n_features, A_xz, A_zx, S);
+            S.pop_SZ(I_map[current_feature]);
         }
         return 0;
     }
@@ -419,191 +389,1288 @@ int recurse_4(int n,
 
 
 
-// Main function for Interventional TreeSHAP
-Matrix<double> int_treeSHAP(Matrix<double> &X_f, 
-                            Matrix<double> &X_b,
-                            int* I_map, 
-                            Matrix<int> &feature,
-                            Matrix<int> &left_child,
-                            Matrix<int> &right_child,
-                            Matrix<double> &threshold,
-                            Matrix<double> &value,
-                            Matrix<double> &W)
+////// Memoization on threshold cells //////
+
+// Memory of all the memo tables of a call, in bytes
+#define MEMO_BUDGET (1 << 27)
+
+
+// Distinct features (after I_map when given) of the internal nodes of a tree,
+// position[k] is the index of feature k in the returned list or -1
+inline vector<int> tree_features(const Tree &tree, int n_nodes, int* I_map, vector<int> &position)
+{
+    vector<int> features;
+    for (int n(0); n < n_nodes; n++){
+        if (tree.nodes[n].child_left < 0) continue;
+        int k = I_map ? I_map[tree.nodes[n].feature] : tree.nodes[n].feature;
+        if (position[k] < 0){
+            position[k] = features.size();
+            features.push_back(k);
+        }
+    }
+    return features;
+}
+
+
+// Compute the cells of the foreground rows [f_start, f_end) and of the background rows
+// [b_start, b_end) for every tree. A tree is memoized when it has at most half as many
+// pairs of cells as the n_pairs pairs of rows it is evaluated on. Its memo table takes
+// table_size(n_cells_f, n_cells_b, n_features_of_tree) bytes and trees are memoized
+// in order until MEMO_BUDGET is reached. The cells of the other trees are discarded.
+// No tree is memoized when `memoize` is false.
+template <typename T, typename Size>
+vector<char> find_memoized_trees(const MatrixView<T> &X_f, int f_start, int f_end,
+                                 const MatrixView<T> &X_b, int b_start, int b_end,
+                                 const TreeEnsemble &trees, int n_features, int* I_map,
+                                 int64_t n_pairs, Size table_size,
+                                 vector<TreeCells> &cells_f, vector<TreeCells> &cells_b, 
+                                 bool memoize, int n_jobs)
+{
+    int n_trees = trees.n_trees;
+    vector<char> memoized(n_trees, 0);
+    vector<int64_t> sizes(n_trees, 0);
+    cells_f.resize(n_trees);
+    cells_b.resize(n_trees);
+    if (!memoize){
+        return memoized;
+    }
+    parallel_for(n_trees, get_n_threads(n_jobs, n_trees), [&](int thread_id, int t){
+        Tree tree = trees.tree(t);
+        int n_nodes = trees.offsets[t+1] - trees.offsets[t];
+        cells_f[t] = compute_cells(X_f, f_start, f_end, tree, n_nodes);
+        cells_b[t] = compute_cells(X_b, b_start, b_end, tree, n_nodes);
+        vector<int> position(n_features, -1);
+        int64_t n_cell_pairs = (int64_t) cells_f[t].n_cells * cells_b[t].n_cells;
+        memoized[t] = 2 * n_cell_pairs <= n_pairs;
+        sizes[t] = table_size(cells_f[t].n_cells, cells_b[t].n_cells,
+                              tree_features(tree, n_nodes, I_map, position).size());
+    });
+    int64_t total_size = 0;
+    for (int t(0); t < n_trees; t++){
+        if (memoized[t] && total_size + sizes[t] <= MEMO_BUDGET){
+            total_size += sizes[t];
+        }
+        else {
+            memoized[t] = 0;
+            cells_f[t] = TreeCells();
+            cells_b[t] = TreeCells();
+        }
+    }
+    return memoized;
+}
+
+
+// stats[0] counts the (x, z, tree) triples and stats[1] the recursions that were run
+inline void record_memo_stats(const vector<char> &memoized, const vector<TreeCells> &cells_f,
+                              const vector<TreeCells> &cells_b, int64_t n_pairs, int64_t* stats)
+{
+    int n_trees = memoized.size();
+    int64_t n_traversals = 0;
+    for (int t(0); t < n_trees; t++){
+        if (memoized[t]){
+            n_traversals += (int64_t) cells_f[t].n_cells * cells_b[t].n_cells;
+        }
+        else {
+            n_traversals += n_pairs;
+        }
+    }
+    stats[0] += n_pairs * n_trees;
+    stats[1] += n_traversals;
+}
+
+
+
+////// Symmetric traversals //////
+
+// Number of rows in the blocks of the symmetric kernels. It does not depend on the
+// number of threads, so that the sums of each row are carried out in the same order for any n_jobs.
+#define SYMMETRIC_BLOCK 32
+
+
+// Run pair(thread_id, i, j, row_i, row_j) for all the pairs j > i of a dataset of N rows, where
+// row_i and row_j are arrays of `row_size` doubles receiving the contributions of the pair to the
+// rows i and j, and row(i) is the accumulator of the row i. The rows are cut in blocks that are handled
+// in order. For the block J, the tiles (I, J) with I <= J run in parallel: the rows of the block I < J
+// are only written by the tile (I, J) and are summed in place, the rows of J are summed in a buffer
+// per tile and the buffers are added to the accumulators in order of I. Each row is thus summed in
+// an order fixed by N, with one buffer of SYMMETRIC_BLOCK rows per thread.
+template <typename Row, typename Pair>
+void symmetric_pairs(int N, int64_t row_size, Row row, int n_threads, Pair pair)
+{
+    int n_blocks = (N + SYMMETRIC_BLOCK - 1) / SYMMETRIC_BLOCK;
+    Matrix<double> buffers(n_threads, vector<double> (SYMMETRIC_BLOCK * row_size, 0));
+
+    progressbar bar(n_blocks);
+    for (int J(0); J < n_blocks; J++){
+        int j_start = J * SYMMETRIC_BLOCK;
+        int j_end = min(j_start + SYMMETRIC_BLOCK, N);
+        // The tiles (I, J) are handled n_threads at a time
+        for (int batch(0); batch <= J; batch += n_threads){
+            int n_tiles = min(n_threads, J + 1 - batch);
+            parallel_for(n_tiles, n_tiles, [&](int thread_id, int k){
+                int I = batch + k;
+                double* rows_J = buffers[k].data();
+                for (int i(I * SYMMETRIC_BLOCK); i < min((I+1) * SYMMETRIC_BLOCK, N); i++){
+                    // The rows of the tile on the diagonal all belong to J
+                    double* row_i = (I == J) ? rows_J + (i - j_start) * row_size : row(i);
+                    for (int j(max(j_start, i+1)); j < j_end; j++){
+                        pair(thread_id, i, j, row_i, rows_J + (j - j_start) * row_size);
+                    }
+                }
+            });
+            for (int k(0); k < n_tiles; k++){
+                double* rows_J = buffers[k].data();
+                for (int j(j_start); j < j_end; j++){
+                    double* row_j = row(j);
+                    double* buffer_j = rows_J + (j - j_start) * row_size;
+                    for (int64_t e(0); e < row_size; e++){
+                        row_j[e] += buffer_j[e];
+                        buffer_j[e] = 0;
+                    }
+                }
+            }
+        }
+        bar.update();
+    }
+}
+
+
+
+// Main function for Interventional TreeSHAP, R is the element type of the results.
+// When `symmetric`, X_f and X_b are the same dataset and the trees that are not memoized
+// traverse each pair j > i once, since phi(x_j; x_i) = -phi(x_i; x_j), see `symmetric_pairs`.
+// Otherwise the contributions of each tree to a foreground instance are summed over the background
+// before being added, in order of the trees, to the SHAP values of the instance. When there are fewer
+// foreground instances than threads, e.g. a single instance explained online, the trees are split
+// among the threads instead of the foreground instances and their sums are kept until all trees
+// are done. The results are then the same for any n_jobs.
+template <typename T, typename R>
+void int_treeSHAP(const MatrixView<T> &X_f, int Nx,
+                  const MatrixView<T> &X_b, int Nz,
+                  bool symmetric,
+                  const double* weights,
+                  int n_columns,
+                  int* I_map, 
+                  const TreeEnsemble &trees,
+                  Matrix<double> &W,
+                  const MatrixView<R> &phi_f_b,
+                  int64_t* stats,
+                  bool memoize,
+                  int n_jobs)
     {
     // Setup
-    int n_features = I_map[X_f[0].size()-1] + 1;
-    int n_trees = feature.size();
-    int Nz = X_b.size();
-    int Nx = X_f.size();
+    int n_features = I_map[n_columns-1] + 1;
+    int n_trees = trees.n_trees;
+    bool by_tree = !symmetric && Nx < get_n_threads(n_jobs, n_trees);
+    int n_threads = get_n_threads(n_jobs, by_tree ? n_trees : Nx);
+
+    // Per-thread scratch buffers, the SHAP values of the current instance
+    // are summed over all trees in double precision before being stored
+    vector<Scratch> scratch(n_threads, Scratch(n_features));
+    Matrix<double> acc_phi(n_threads, vector<double> (n_features, 0));
+    Matrix<double> acc_row(n_threads, vector<double> (n_features, 0));
+    Matrix<double> acc_tree(n_threads, vector<double> (n_features, 0));
+    Matrix<double> acc_sum(n_threads, vector<double> (n_features, 0));
+
+    // Trees with few cells are memoized, their table holds the SHAP values of each foreground cell
+    vector<TreeCells> cells_f, cells_b;
+    auto table_size = [](int64_t n_cells_f, int64_t n_cells_b, int64_t n_tree_features){
+        return n_cells_f * n_tree_features * (int64_t) sizeof(double);
+    };
+    vector<char> memoized = find_memoized_trees(X_f, 0, Nx, X_b, 0, Nz, trees, n_features, I_map,
+                                                (int64_t) Nx * Nz, table_size, cells_f, cells_b, memoize, n_jobs);
+    record_memo_stats(memoized, cells_f, cells_b, (int64_t) Nx * Nz, stats);
+    if (symmetric){
+        // Only the pairs j > i of the other trees are traversed
+        for (int t(0); t < trees.n_trees; t++){
+            if (!memoized[t]) stats[1] -= (int64_t) Nx * Nz - (int64_t) Nx * (Nx-1) / 2;
+        }
+    }
 
-    // Initialize the SHAP values to zero
-    Matrix<double> phi_f_b(Nx, vector<double> (n_features, 0));
-    progressbar bar(Nx);
-    // Iterate over all foreground instances
-    for (int i(0); i < Nx; i++){
-        // Iterate over all trees
+    // Background instances may stand for several rows, a null pointer means unit weights
+    vector<double> w_b(Nz, 1.0);
+    if (weights){
+        w_b.assign(weights, weights + Nz);
+    }
+    double total_weight = 0;
+    for (int j(0); j < Nz; j++){
+        total_weight += w_b[j];
+    }
+
+    // Features of each tree, the memoized trees also need the weight of the background rows in each cell
+    Matrix<int> features(n_trees), positions(n_trees);
+    Matrix<double> tables(n_trees), cell_weights(n_trees);
+    for (int t(0); t < n_trees; t++){
+        positions[t].assign(n_features, -1);
+        features[t] = tree_features(trees.tree(t), trees.offsets[t+1] - trees.offsets[t], I_map, positions[t]);
+        if (!memoized[t]) continue;
+        cell_weights[t].assign(cells_b[t].n_cells, 0);
+        for (int j(0); j < Nz; j++){
+            cell_weights[t][cells_b[t].cell[j]] += w_b[j];
+        }
+        tables[t].assign(cells_f[t].n_cells * features[t].size(), 0);
+    }
+    // Sum of the SHAP values over the background, each cell is weighted by its rows
+    auto fill_table = [&](int thread_id, int t, int c){
+        Scratch &S = scratch[thread_id];
+        vector<double> &phi = acc_phi[thread_id];
+        Tree tree = trees.tree(t);
+        const TreeCells &cz = cells_b[t];
+        int m = features[t].size();
+        RowView<T> x = X_f.row(cells_f[t].representative[c]);
+        for (int c_z(0); c_z < cz.n_cells; c_z++){
+            recurse(0, x, X_b.row(cz.representative[c_z]), I_map, tree, W, n_features, phi, S);
+            for (int a(0); a < S.n_touched; a++){
+                int f = S.touched[a];
+                tables[t][c * m + positions[t][f]] += cell_weights[t][c_z] * phi[f];
+                phi[f] = 0;
+            }
+            S.clear_touched();
+        }
+    };
+    if (by_tree){
+        parallel_for(n_trees, n_threads, [&](int thread_id, int t){
+            if (!memoized[t]) return;
+            for (int c(0); c < cells_f[t].n_cells; c++){
+                fill_table(thread_id, t, c);
+            }
+        });
+    }
+    else {
         for (int t(0); t < n_trees; t++){
-            // Iterate over all background instances
-            for (int j(0); j < Nz; j++){
-                // Last index is the size of the set
-                vector<int> in_SX(n_features+1, 0);
-                vector<int> in_SZ(n_features+1, 0);
-                vector<double> phi(n_features, 0);
+            if (!memoized[t]) continue;
+            parallel_for(cells_f[t].n_cells, n_threads, [&](int thread_id, int c){
+                fill_table(thread_id, t, c);
+            });
+        }
+    }
 
-                // Start the recursion
-                recurse(0, X_f[i], X_b[j], I_map, feature[t], left_child[t], right_child[t],
-                            threshold[t], value[t], W, n_features, phi, in_SX, in_SZ);
+    // Sum of the contributions of the tree t to the foreground instance i over the background,
+    // tree_sum[a] is the value of the feature features[t][a]
+    auto sum_tree = [&](int thread_id, int t, int i, double* tree_sum){
+        int m = features[t].size();
+        if (memoized[t]){
+            // Look up the cell of the foreground instance
+            for (int a(0); a < m; a++){
+                tree_sum[a] = tables[t][cells_f[t].cell[i] * m + a];
+            }
+            return;
+        }
+        Scratch &S = scratch[thread_id];
+        vector<double> &phi = acc_phi[thread_id];
+        vector<double> &tree_row = acc_tree[thread_id];
+        Tree tree = trees.tree(t);
+        RowView<T> x = X_f.row(i);
+        // Iterate over all background instances
+        for (int j(0); j < Nz; j++){
+            // Start the recursion
+            recurse(0, x, X_b.row(j), I_map, tree, W, n_features, phi, S);
+
+            // Add the contribution of the background instance
+            for (int a(0); a < S.n_touched; a++){
+                int f = S.touched[a];
+                tree_row[f] += w_b[j] * phi[f];
+                phi[f] = 0;
+            }
+            S.clear_touched();
+        }
+        for (int a(0); a < m; a++){
+            tree_sum[a] = tree_row[features[t][a]];
+            tree_row[features[t][a]] = 0;
+        }
+    };
+
+    if (symmetric){
+        // SHAP values of each row of X, summed in place in double precision
+        vector<double> acc_rows((int64_t) Nx * n_features, 0);
+        symmetric_pairs(Nx, n_features, [&](int i){ return acc_rows.data() + (int64_t) i * n_features; }, 
+                        n_threads, [&](int thread_id, int i, int j, double* row_i, double* row_j){
+            Scratch &S = scratch[thread_id];
+            vector<double> &phi = acc_phi[thread_id];
+            RowView<T> x = X_f.row(i);
+            RowView<T> z = X_b.row(j);
+            for (int t(0); t < n_trees; t++){
+                if (memoized[t]) continue;
+                recurse(0, x, z, I_map, trees.tree(t), W, n_features, phi, S);
+                for (int a(0); a < S.n_touched; a++){
+                    int f = S.touched[a];
+                    row_i[f] += w_b[j] * phi[f];
+                    row_j[f] -= w_b[i] * phi[f];
+                    phi[f] = 0;
+                }
+                S.clear_touched();
+            }
+        });
+        // Add the memoized trees and rescale w.r.t the total weight of the background instances
+        parallel_for(Nx, n_threads, [&](int thread_id, int i){
+            double* row = acc_rows.data() + (int64_t) i * n_features;
+            for (int t(0); t < n_trees; t++){
+                if (!memoized[t]) continue;
+                int m = features[t].size();
+                for (int a(0); a < m; a++){
+                    row[features[t][a]] += tables[t][cells_f[t].cell[i] * m + a];
+                }
+            }
+            for (int f(0); f < n_features; f++){
+                phi_f_b(i, f) += row[f] / total_weight;
+            }
+        });
+    }
+    else if (by_tree){
+        // Each thread handles a fixed set of trees for all the foreground instances and
+        // keeps their sums, tree_sums[t][i * m + a] for the a-th feature of the tree t
+        Matrix<double> tree_sums(n_trees);
+        parallel_for(n_trees, n_threads, [&](int thread_id, int t){
+            int m = features[t].size();
+            tree_sums[t].assign((int64_t) Nx * m, 0);
+            for (int i(0); i < Nx; i++){
+                sum_tree(thread_id, t, i, tree_sums[t].data() + (int64_t) i * m);
+            }
+        });
+        // Add the sums of the trees in order
+        vector<double> &row = acc_row[0];
+        for (int i(0); i < Nx; i++){
+            for (int t(0); t < n_trees; t++){
+                int m = features[t].size();
+                for (int a(0); a < m; a++){
+                    row[features[t][a]] += tree_sums[t][(int64_t) i * m + a];
+                }
+            }
+            for (int f(0); f < n_features; f++){
+                // Rescale w.r.t the total weight of the background instances
+                phi_f_b(i, f) += row[f] / total_weight;
+                row[f] = 0;
+            }
+        }
+    }
+    else {
+        progressbar bar(Nx);
+        mutex bar_mutex;
+        // Iterate over all foreground instances, each one is handled by a single thread
+        parallel_for(Nx, n_threads, [&](int thread_id, int i){
+            vector<double> &row = acc_row[thread_id];
+            vector<double> &tree_sum = acc_sum[thread_id];
+            // Iterate over all trees
+            for (int t(0); t < n_trees; t++){
+                int m = features[t].size();
+                sum_tree(thread_id, t, i, tree_sum.data());
+                for (int a(0); a < m; a++){
+                    row[features[t][a]] += tree_sum[a];
+                }
+            }
+            for (int f(0); f < n_features; f++){
+                // Rescale w.r.t the total weight of the background instances
+                phi_f_b(i, f) += row[f] / total_weight;
+                row[f] = 0;
+            }
+            lock_guard<mutex> lock(bar_mutex);
+            bar.update();
+        });
+    }
+}
 
-               // Add the contribution of the tree and background instance
-                for (int f(0); f < n_features; f++){
-                    phi_f_b[i][f] += phi[f];
+
+
+// Regional Interventional TreeSHAP, each instance of X is explained against the instances
+// of X in its region, for L labellings of the rows at once. labels[l * N + j] is the region
+// of row j in labelling l. Only the pairs (x, z) sharing a region in at least one labelling
+// are traversed and the contribution of each pair is shared by all these labellings.
+template <typename T, typename R>
+void regional_treeSHAP(const MatrixView<T> &X, int N,
+                       const double* weights,
+                       const int* labels, int n_labellings,
+                       int n_features,
+                       int* I_map,
+                       const TreeEnsemble &trees,
+                       Matrix<double> &W,
+                       const TensorView<R> &phi_l_f,
+                       int64_t* stats,
+                       int n_jobs)
+    {
+    // Setup
+    int n_trees = trees.n_trees;
+    int n_threads = get_n_threads(n_jobs, N);
+
+    // Per-thread scratch buffers, the SHAP values of the current instance
+    // are summed over all trees in double precision for each labelling
+    vector<Scratch> scratch(n_threads, Scratch(n_features));
+    Matrix<double> acc_phi(n_threads, vector<double> (n_features, 0));
+    Matrix<double> acc_row(n_threads, vector<double> (n_labellings * n_features, 0));
+    Matrix<int> acc_shared(n_threads, vector<int> (n_labellings));
+    vector<int64_t> acc_pairs(n_threads, 0);
+
+    // Instances may stand for several rows, a null pointer means unit weights
+    vector<double> w(N, 1.0);
+    if (weights){
+        w.assign(weights, weights + N);
+    }
+    // Total weight of each region of each labelling
+    Matrix<double> region_weight(n_labellings);
+    for (int l(0); l < n_labellings; l++){
+        const int* label = labels + (int64_t) l * N;
+        region_weight[l].assign(*max_element(label, label + N) + 1, 0);
+        for (int j(0); j < N; j++){
+            region_weight[l][label[j]] += w[j];
+        }
+    }
+
+    progressbar bar(N);
+    mutex bar_mutex;
+    // Iterate over all instances, each one is handled by a single thread
+    parallel_for(N, n_threads, [&](int thread_id, int i){
+        Scratch &S = scratch[thread_id];
+        vector<double> &phi = acc_phi[thread_id];
+        vector<double> &row = acc_row[thread_id];
+        vector<int> &shared = acc_shared[thread_id];
+        RowView<T> x = X.row(i);
+        // Iterate over the background instances in a region of x
+        for (int j(0); j < N; j++){
+            int n_shared = 0;
+            for (int l(0); l < n_labellings; l++){
+                if (labels[(int64_t) l * N + i] == labels[(int64_t) l * N + j]){
+                    shared[n_shared++] = l;
+                }
+            }
+            if (n_shared == 0) continue;
+            acc_pairs[thread_id]++;
+
+            // Iterate over all trees
+            RowView<T> z = X.row(j);
+            for (int t(0); t < n_trees; t++){
+                // Start the recursion
+                recurse(0, x, z, I_map, trees.tree(t), W, n_features, phi, S);
+
+                // Add the contribution of the tree and background instance to every
+                // labelling where both instances are in the same region
+                for (int m(0); m < S.n_touched; m++){
+                    int f = S.touched[m];
+                    for (int s(0); s < n_shared; s++){
+                        row[shared[s] * n_features + f] += w[j] * phi[f];
+                    }
+                    phi[f] = 0;
                 }
+                S.clear_touched();
             }
         }
-        // Rescale w.r.t the number of background instances
-        for (int f(0); f < n_features; f++){
-            phi_f_b[i][f] /= Nz;
+        // Rescale w.r.t the total weight of the region of x
+        for (int l(0); l < n_labellings; l++){
+            double total_weight = region_weight[l][labels[(int64_t) l * N + i]];
+            for (int f(0); f < n_features; f++){
+                phi_l_f(l, i, f) += row[l * n_features + f] / total_weight;
+                row[l * n_features + f] = 0;
+            }
         }
+        lock_guard<mutex> lock(bar_mutex);
         bar.update();
+    });
+
+    // Every traversed pair goes through all trees
+    int64_t n_pairs = 0;
+    for (int t(0); t < n_threads; t++){
+        n_pairs += acc_pairs[t];
     }
-    return phi_f_b;
+    stats[0] += n_pairs * n_trees;
+    stats[1] += n_pairs * n_trees;
 }
 
 
 
+// Interventional TreeSHAP of each (foreground, background) pair, phi_f_b(i, j, k) is the
+// Shapley value of feature k for x_i against the single background instance z_j
+template <typename T, typename R>
+void pair_treeSHAP(const MatrixView<T> &X_f, int Nx,
+                   const MatrixView<T> &X_b, int Nz,
+                   int n_features,
+                   int* I_map,
+                   const TreeEnsemble &trees,
+                   Matrix<double> &W,
+                   const TensorView<R> &phi_f_b,
+                   int n_jobs)
+    {
+    // Setup
+    int n_trees = trees.n_trees;
+    int n_threads = get_n_threads(n_jobs, Nx);
+
+    // Per-thread scratch buffers, the SHAP values of the current pair
+    // are summed over all trees in double precision before being stored
+    vector<Scratch> scratch(n_threads, Scratch(n_features));
+    Matrix<double> acc_phi(n_threads, vector<double> (n_features, 0));
+    Matrix<double> acc_pair(n_threads, vector<double> (n_features, 0));
 
-// Main function for Taylor-TreeSHAP
-vector<Matrix<double>> taylor_treeSHAP(Matrix<double> &X_f, 
-                                        Matrix<double> &X_b, 
-                                        Matrix<int> &feature,
-                                        Matrix<int> &left_child,
-                                        Matrix<int> &right_child,
-                                        Matrix<double> &threshold,
-                                        Matrix<double> &value,
-                                        Matrix<double> &W)
+    progressbar bar(Nx);
+    mutex bar_mutex;
+    // Iterate over all foreground instances, each one is handled by a single thread
+    parallel_for(Nx, n_threads, [&](int thread_id, int i){
+        Scratch &S = scratch[thread_id];
+        vector<double> &phi = acc_phi[thread_id];
+        vector<double> &pair = acc_pair[thread_id];
+        RowView<T> x = X_f.row(i);
+        // Iterate over all background instances
+        for (int j(0); j < Nz; j++){
+            RowView<T> z = X_b.row(j);
+            // Iterate over all trees
+            for (int t(0); t < n_trees; t++){
+                // Start the recursion
+                recurse(0, x, z, I_map, trees.tree(t), W, n_features, phi, S);
+
+                // Add the contribution of the tree
+                for (int m(0); m < S.n_touched; m++){
+                    int f = S.touched[m];
+                    pair[f] += phi[f];
+                    phi[f] = 0;
+                }
+                S.clear_touched();
+            }
+            for (int f(0); f < n_features; f++){
+                phi_f_b(i, j, f) += pair[f];
+                pair[f] = 0;
+            }
+        }
+        lock_guard<mutex> lock(bar_mutex);
+        bar.update();
+    });
+}
+
+
+
+
+// Move the interactions of the pairs of touched features from the upper triangle
+// of phi to an output with add(f1, f2, value), the upper triangle is mirrored
+template <typename Add>
+inline void flush_taylor(const Scratch &S, vector<double> &phi, int n_features, Add add)
 {
-    // Setup
-    int n_features = X_f[0].size();
-    int n_trees = feature.size();
-    int size_background = X_b.size();
-    int size_foreground = X_f.size();
+    for (int m1(0); m1 < S.n_touched; m1++){
+        for (int m2(m1); m2 < S.n_touched; m2++){
+            int f1 = min(S.touched[m1], S.touched[m2]);
+            int f2 = max(S.touched[m1], S.touched[m2]);
+            double value = phi[f1 * n_features + f2];
+            add(f1, f2, value);
+            if (f1 != f2){
+                add(f2, f1, value);
+            }
+            phi[f1 * n_features + f2] = 0;
+        }
+    }
+}
+
 
-    // Initialize the taylor SHAP values to zero
-    vector<Matrix<double>> phi_f_b(size_foreground, Matrix<double> (n_features, vector<double> (n_features, 0)));
 
+// Main function for Taylor-TreeSHAP. When `symmetric`, X_f and X_b are the same dataset
+// and each pair j > i is traversed once for both (x_i, x_j) and (x_j, x_i), the rows are then
+// summed in an order that does not depend on the number of threads, see `symmetric_pairs`.
+template <typename T>
+void taylor_treeSHAP(const MatrixView<T> &X_f, int size_foreground,
+                     const MatrixView<T> &X_b, int size_background,
+                     bool symmetric,
+                     int n_features, int* I_map,
+                     const TreeEnsemble &trees,
+                     Matrix<double> &W,
+                     const TensorView<double> &phi_f_b,
+                     int n_jobs)
+{
+    // Setup
+    int n_trees = trees.n_trees;
+    int n_threads = get_n_threads(n_jobs, size_foreground);
+    int64_t n_pairs = (int64_t) n_features * n_features;
+
+    // Per-thread scratch buffers
+    vector<Scratch> scratch(n_threads, Scratch(n_features));
+    Matrix<double> acc_phi(n_threads, vector<double> (n_pairs, 0));
+    Matrix<double> acc_swap(n_threads, vector<double> (symmetric ? n_pairs : 0, 0));
+
+    if (symmetric){
+        // The rows are summed in place when the output is C-contiguous, as allocated by
+        // TreeANOVA.taylor, and in a copy otherwise
+        bool contiguous = phi_f_b.stride_2 == 1 && phi_f_b.stride_1 == n_features && phi_f_b.stride_0 == n_pairs;
+        vector<double> copy(contiguous ? 0 : (int64_t) size_foreground * n_pairs, 0);
+        double* rows = contiguous ? &phi_f_b(0, 0, 0) : copy.data();
+        symmetric_pairs(size_foreground, n_pairs, [&](int i){ return rows + (int64_t) i * n_pairs; },
+                        n_threads, [&](int thread_id, int i, int j, double* row_i, double* row_j){
+            Scratch &S = scratch[thread_id];
+            vector<double> &phi = acc_phi[thread_id];
+            RowView<T> x = X_f.row(i);
+            RowView<T> z = X_b.row(j);
+            // Iterate over all trees in the ensemble
+            for (int t(0); t < n_trees; t++){
+                // Start the recursion
+                recurse_2(0, x, z, I_map, trees.tree(t), W, n_features, phi, &acc_swap[thread_id], S);
+
+                // Only the pairs of touched features can be non-zero and the upper triangle is mirrored
+                flush_taylor(S, phi, n_features, 
+                             [&](int f1, int f2, double value){ row_i[f1 * n_features + f2] += value; });
+                flush_taylor(S, acc_swap[thread_id], n_features, 
+                             [&](int f1, int f2, double value){ row_j[f1 * n_features + f2] += value; });
+                S.clear_touched();
+            }
+        });
+        // Rescale taylor SHAP values w.r.t the number of background instances
+        for (int i(0); i < size_foreground; i++){
+            for (int f1(0); f1 < n_features; f1++){
+                for (int f2(0); f2 < n_features; f2++){
+                    double value = rows[(int64_t) i * n_pairs + f1 * n_features + f2] / size_background;
+                    phi_f_b(i, f1, f2) = contiguous ? value : phi_f_b(i, f1, f2) + value;
+                }
+            }
+        }
+        return;
+    }
+
+    // The taylor SHAP values are accumulated directly in the output buffer
     progressbar bar(size_foreground);
-    // Iterate over all foreground instances
-    for (int i(0); i < size_foreground; i++){
+    mutex bar_mutex;
+    // Iterate over all foreground instances, each one is handled by a single thread
+    parallel_for(size_foreground, n_threads, [&](int thread_id, int i){
+        Scratch &S = scratch[thread_id];
+        vector<double> &phi = acc_phi[thread_id];
+        RowView<T> x = X_f.row(i);
         // Iterate over all background instances
         for (int j(0); j < size_background; j++){
+            RowView<T> z = X_b.row(j);
             // Iterate over all trees in the ensemble
             for (int t(0); t < n_trees; t++){
-                // Last index is the size of the set
-                vector<int> in_SX(n_features+1, 0);
-                vector<int> in_SZ(n_features+1, 0);
-                vector<double> phi(n_features * n_features, 0);
-
                 // Start the recursion
-                recurse_2(0, X_f[i], X_b[j], feature[t], left_child[t], right_child[t],
-                            threshold[t], value[t], W, n_features, phi, in_SX, in_SZ);
+                recurse_2(0, x, z, I_map, trees.tree(t), W, n_features, phi, nullptr, S);
+
+                // Add the contribution of the tree and background instance,
+                // only the pairs of touched features can be non-zero and
+                // the upper triangle is mirrored
+                flush_taylor(S, phi, n_features, 
+                             [&](int f1, int f2, double value){ phi_f_b(i, f1, f2) += value; });
+                S.clear_touched();
+            }
+        }
+        // Rescale taylor SHAP values w.r.t the number of background instances
+        for (int f1(0); f1 < n_features; f1++){
+            for (int f2(0); f2 < n_features; f2++){
+                phi_f_b(i, f1, f2) /= size_background;
+            }
+        }
+        lock_guard<mutex> lock(bar_mutex);
+        bar.update();
+    });
+}
 
-                // Add the contribution of the tree and background instance
-                for (int f1(0); f1 < n_features; f1++){
-                    for (int f2(0); f2 < n_features; f2++){
-                        phi_f_b[i][f1][f2] += phi[f1 * n_features + f2];
+
+
+// Main function for Taylor-TreeSHAP
+// The pairs (i, j) are restricted to a block of rows [row_start, row_end) of X_f
+// and columns [col_start, col_end) of X_b. The entries A[i][j] are written in A_rows at
+// (i - row_start, j - col_start). When `symmetric`, X_f and X_b are the same dataset,
+// only the pairs with j > i are computed and the entries A[j][i] are written in A_cols 
+// at (j - col_start, i - row_start). Computing the whole tensor then amounts to a single
+// block with A_rows = A_cols = A. Otherwise all pairs are computed and A_cols is unused.
+// The term of feature k is stored in the column feature_columns[k] of the outputs, several features
+// sharing a column are summed and the features with a negative column are not stored.
+template <typename T, typename R>
+void additive_treeSHAP(const MatrixView<T> &X_f,
+                       int row_start, int row_end,
+                       const MatrixView<T> &X_b,
+                       int col_start, int col_end,
+                       bool symmetric,
+                       int n_features, int* I_map,
+                       const int* feature_columns,
+                       const TreeEnsemble &trees,
+                       const TensorView<R> &A_rows,
+                       const TensorView<R> &A_cols,
+                       int64_t* stats,
+                       bool memoize,
+                       int n_jobs)
+{
+    // Setup
+    int n_trees = trees.n_trees;
+    int n_rows = row_end - row_start;
+    int n_threads = get_n_threads(n_jobs, n_rows);
+
+    // Per-thread accumulators for the entries A[i][j] and A[j][i] of the current pair,
+    // and for the contribution of the current tree
+    vector<Scratch> scratch(n_threads, Scratch(n_features));
+    vector<Scratch> tree_scratch(n_threads, Scratch(n_features));
+    Matrix<double> acc_xz(n_threads, vector<double> (n_features, 0));
+    Matrix<double> acc_zx(n_threads, vector<double> (n_features, 0));
+    Matrix<double> tree_xz(n_threads, vector<double> (n_features, 0));
+    Matrix<double> tree_zx(n_threads, vector<double> (n_features, 0));
+
+    // First column paired with the row i
+    auto first_col = [&](int i){
+        return symmetric ? max(col_start, i+1) : col_start;
+    };
+
+    // Number of pairs in the block
+    int64_t n_pairs = 0;
+    for (int i(row_start); i < row_end; i++){
+        n_pairs += col_end - first_col(i) > 0 ? col_end - first_col(i) : 0;
+    }
+
+    // Trees with few cells are memoized, their table holds A[i][j] and A[j][i] for each pair of cells
+    vector<TreeCells> cells_f, cells_b;
+    auto table_size = [](int64_t n_cells_f, int64_t n_cells_b, int64_t n_tree_features){
+        return 2 * n_cells_f * n_cells_b * n_tree_features * (int64_t) sizeof(double);
+    };
+    vector<char> memoized = find_memoized_trees(X_f, row_start, row_end, X_b, col_start, col_end, trees, 
+                                                n_features, I_map, n_pairs, table_size, 
+                                                cells_f, cells_b, memoize, n_jobs);
+    record_memo_stats(memoized, cells_f, cells_b, n_pairs, stats);
+
+    // Only one pair of rows per pair of cells goes through the recursion,
+    // the tables are restricted to the features of the tree
+    Matrix<int> features(n_trees);
+    Matrix<double> tables_xz(n_trees), tables_zx(n_trees);
+    for (int t(0); t < n_trees; t++){
+        if (!memoized[t]) continue;
+        Tree tree = trees.tree(t);
+        const TreeCells &cx = cells_f[t];
+        const TreeCells &cz = cells_b[t];
+        vector<int> position(n_features, -1);
+        features[t] = tree_features(tree, trees.offsets[t+1] - trees.offsets[t], I_map, position);
+        int m = features[t].size();
+        tables_xz[t].assign((int64_t) cx.n_cells * cz.n_cells * m, 0);
+        tables_zx[t].assign((int64_t) cx.n_cells * cz.n_cells * m, 0);
+        parallel_for(cx.n_cells, n_threads, [&](int thread_id, int c){
+            Scratch &S = tree_scratch[thread_id];
+            vector<double> &T_xz = tree_xz[thread_id];
+            vector<double> &T_zx = tree_zx[thread_id];
+            RowView<T> x = X_f.row(cx.representative[c]);
+            for (int c_z(0); c_z < cz.n_cells; c_z++){
+                recurse_3(0, x, X_b.row(cz.representative[c_z]), I_map, tree, n_features, T_xz, T_zx, S);
+                int64_t entry = ((int64_t) c * cz.n_cells + c_z) * m;
+                for (int a(0); a < S.n_touched; a++){
+                    int k = S.touched[a];
+                    tables_xz[t][entry + position[k]] = T_xz[k];
+                    tables_zx[t][entry + position[k]] = T_zx[k];
+                    T_xz[k] = 0;
+                    T_zx[k] = 0;
+                }
+                S.clear_touched();
+            }
+        });
+    }
+
+    progressbar bar(n_pairs);
+    mutex bar_mutex;
+    // Iterate over all foreground instances
+    parallel_for(n_rows, n_threads, [&](int thread_id, int row){
+        int i = row_start + row;
+        Scratch &S = scratch[thread_id];
+        Scratch &S_tree = tree_scratch[thread_id];
+        vector<double> &A_xz = acc_xz[thread_id];
+        vector<double> &A_zx = acc_zx[thread_id];
+        vector<double> &T_xz = tree_xz[thread_id];
+        vector<double> &T_zx = tree_zx[thread_id];
+        RowView<T> x = X_f.row(i);
+        // Iterate over all background instances
+        for (int j(first_col(i)); j < col_end; j++){
+            RowView<T> z = X_b.row(j);
+            // Iterate over all trees in the ensemble, the contribution of each tree is computed 
+            // separately so that the results do not depend on which trees are memoized
+            for (int t(0); t < n_trees; t++){
+                if (memoized[t]){
+                    // Look up the pair of cells
+                    int m = features[t].size();
+                    int64_t entry = ((int64_t) cells_f[t].cell[row] * cells_b[t].n_cells + 
+                                     cells_b[t].cell[j - col_start]) * m;
+                    for (int a(0); a < m; a++){
+                        int k = features[t][a];
+                        A_xz[k] += tables_xz[t][entry + a];
+                        A_zx[k] += tables_zx[t][entry + a];
+                        S.touch(k);
                     }
                 }
+                else {
+                    // Start the recursion
+                    recurse_3(0, x, z, I_map, trees.tree(t), n_features, T_xz, T_zx, S_tree);
+                    for (int a(0); a < S_tree.n_touched; a++){
+                        int k = S_tree.touched[a];
+                        A_xz[k] += T_xz[k];
+                        A_zx[k] += T_zx[k];
+                        T_xz[k] = 0;
+                        T_zx[k] = 0;
+                        S.touch(k);
+                    }
+                    S_tree.clear_touched();
+                }
+            }
+            // The pair (i, j) is the only one writing to A[i][j] and A[j][i]
+            for (int m(0); m < S.n_touched; m++){
+                int k = S.touched[m];
+                int c = feature_columns[k];
+                if (c >= 0){
+                    A_rows(i - row_start, j - col_start, c) += A_xz[k];
+                    if (symmetric){
+                        A_cols(j - col_start, i - row_start, c) += A_zx[k];
+                    }
+                }
+                A_xz[k] = 0;
+                A_zx[k] = 0;
+            }
+            S.clear_touched();
+            lock_guard<mutex> lock(bar_mutex);
+            bar.update();
+        }
+    });
+}
+
+
+
+// Taylor-TreeSHAP reduced on the fly to the mean of squared interactions
+// phi2_mean[f1][f2] = mean_i Phi[i][f1][f2]^2 and the totals phi_total[i] = sum_{f1,f2} Phi[i][f1][f2]
+// so that only O(n_threads * d^2) memory is used instead of O(N * d^2).
+template <typename T>
+void taylor_treeSHAP_reduce(const MatrixView<T> &X_f, int size_foreground,
+                            const MatrixView<T> &X_b, int size_background,
+                            int n_features, int* I_map,
+                            const TreeEnsemble &trees,
+                            Matrix<double> &W,
+                            const MatrixView<double> &phi2_mean,
+                            double* phi_total,
+                            int n_jobs)
+{
+    // Setup
+    int n_trees = trees.n_trees;
+    int n_threads = get_n_threads(n_jobs, size_foreground);
+
+    // Per-thread Taylor values of the current foreground instance and sums of squares
+    vector<Scratch> scratch(n_threads, Scratch(n_features));
+    Matrix<double> acc_phi(n_threads, vector<double> (n_features * n_features, 0));
+    Matrix<double> acc_phi2(n_threads, vector<double> (n_features * n_features, 0));
+
+    progressbar bar(size_foreground);
+    mutex bar_mutex;
+    // Iterate over all foreground instances
+    parallel_for_static(size_foreground, n_threads, [&](int thread_id, int i){
+        Scratch &S = scratch[thread_id];
+        vector<double> &phi = acc_phi[thread_id];
+        vector<double> &phi2 = acc_phi2[thread_id];
+        RowView<T> x = X_f.row(i);
+        // Iterate over all background instances
+        for (int j(0); j < size_background; j++){
+            RowView<T> z = X_b.row(j);
+            // Iterate over all trees in the ensemble
+            for (int t(0); t < n_trees; t++){
+                // Start the recursion
+                recurse_2(0, x, z, I_map, trees.tree(t), W, n_features, phi, nullptr, S);
             }
         }
+        // Reduce the Taylor values of x and reset the buffer, 
+        // only the pairs of features touched by some background instance can be non-zero
+        // and only the upper triangle is stored
+        double total = 0;
+        for (int m1(0); m1 < S.n_touched; m1++){
+            for (int m2(m1); m2 < S.n_touched; m2++){
+                int f1 = min(S.touched[m1], S.touched[m2]);
+                int f2 = max(S.touched[m1], S.touched[m2]);
+                int f = f1 * n_features + f2;
+                phi[f] /= size_background;
+                phi2[f] += phi[f] * phi[f];
+                total += (f1 == f2) ? phi[f] : 2 * phi[f];
+                phi[f] = 0;
+            }
+        }
+        S.clear_touched();
+        phi_total[i] = total;
+        lock_guard<mutex> lock(bar_mutex);
         bar.update();
-    }
-    // Rescale taylor SHAP values w.r.t the number of background instances
-    for (int i(0); i < size_foreground; i++){
-        for (int f1(0); f1 < n_features; f1++){
-            for (int f2(0); f2 < n_features; f2++){
-                phi_f_b[i][f1][f2] /= size_background;
+    });
+    // Combine the per-thread sums in a fixed order and mirror the upper triangle
+    for (int f1(0); f1 < n_features; f1++){
+        for (int f2(f1); f2 < n_features; f2++){
+            double sum = 0;
+            for (int thread_id(0); thread_id < n_threads; thread_id++){
+                sum += acc_phi2[thread_id][f1 * n_features + f2];
             }
+            phi2_mean(f1, f2) = sum / size_foreground;
+            phi2_mean(f2, f1) = sum / size_foreground;
         }
     }
-    return phi_f_b;
 }
 
 
 
-// Main function for Taylor-TreeSHAP
-vector<Matrix<double>> additive_treeSHAP(Matrix<double> &X, 
-                                        Matrix<int> &feature,
-                                        Matrix<int> &left_child,
-                                        Matrix<int> &right_child,
-                                        Matrix<double> &threshold,
-                                        Matrix<double> &value)
+// Additive-TreeSHAP reduced on the fly to the row and column means of H
+// row_mean[i][k] = mean_j H[i][j][k+1] (PDP) and col_mean[j][k] = mean_i H[i][j][k+1] (PFI)
+// so that only O(n_threads * N * d) memory is used instead of O(N^2 * d).
+template <typename T>
+void additive_treeSHAP_reduce(const MatrixView<T> &X, int N,
+                              int n_features, int* I_map,
+                              const TreeEnsemble &trees,
+                              const MatrixView<double> &row_mean,
+                              const MatrixView<double> &col_mean,
+                              int n_jobs)
 {
     // Setup
-    int n_features = X[0].size();
-    int n_trees = feature.size();
-    int N = X.size();
+    int n_trees = trees.n_trees;
+    int n_threads = get_n_threads(n_jobs, N);
 
-    // Initialize the taylor SHAP values to zero
-    Tensor<double> A(N, Matrix<double> (N, vector<double> (n_features, 0)));
+    // Per-thread accumulators for the entries A[i][j] and A[j][i] of the current pair
+    vector<Scratch> scratch(n_threads, Scratch(n_features));
+    Matrix<double> acc_xz(n_threads, vector<double> (n_features, 0));
+    Matrix<double> acc_zx(n_threads, vector<double> (n_features, 0));
+    // Per-thread row and column sums
+    Matrix<double> acc_rows(n_threads, vector<double> (N * n_features, 0));
+    Matrix<double> acc_cols(n_threads, vector<double> (N * n_features, 0));
 
     progressbar bar(N*(N-1)/2);
+    mutex bar_mutex;
     // Iterate over all foreground instances
-    for (int i(0); i < N; i++){
+    parallel_for_static(N, n_threads, [&](int thread_id, int i){
+        Scratch &S = scratch[thread_id];
+        vector<double> &A_xz = acc_xz[thread_id];
+        vector<double> &A_zx = acc_zx[thread_id];
+        vector<double> &rows = acc_rows[thread_id];
+        vector<double> &cols = acc_cols[thread_id];
+        RowView<T> x = X.row(i);
         // Iterate over all background instances
         for (int j(i+1); j < N; j++){
+            RowView<T> z = X.row(j);
             // Iterate over all trees in the ensemble
             for (int t(0); t < n_trees; t++){
-                // Last index is the size of the set
-                vector<int> in_SX(n_features+1, 0);
-                vector<int> in_SZ(n_features+1, 0);
-
                 // Start the recursion
-                recurse_3(0, X, i, j, feature[t], left_child[t], right_child[t],
-                            threshold[t], value[t], n_features, A, in_SX, in_SZ);
+                recurse_3(0, x, z, I_map, trees.tree(t), n_features, A_xz, A_zx, S);
             }
+            // A[i][j] contributes to row i and column j, A[j][i] to row j and column i
+            for (int m(0); m < S.n_touched; m++){
+                int k = S.touched[m];
+                rows[i * n_features + k] += A_xz[k];
+                cols[j * n_features + k] += A_xz[k];
+                rows[j * n_features + k] += A_zx[k];
+                cols[i * n_features + k] += A_zx[k];
+                A_xz[k] = 0;
+                A_zx[k] = 0;
+            }
+            S.clear_touched();
+        }
+        lock_guard<mutex> lock(bar_mutex);
+        for (int j(i+1); j < N; j++){
             bar.update();
         }
+    });
+    // Combine the per-thread sums in a fixed order, the diagonal of H[..., 1:] is zero
+    for (int i(0); i < N; i++){
+        for (int k(0); k < n_features; k++){
+            double row_sum = 0, col_sum = 0;
+            for (int thread_id(0); thread_id < n_threads; thread_id++){
+                row_sum += acc_rows[thread_id][i * n_features + k];
+                col_sum += acc_cols[thread_id][i * n_features + k];
+            }
+            row_mean(i, k) = row_sum / N;
+            col_mean(i, k) = col_sum / N;
+        }
     }
-    return A;
 }
 
 
 
 // Main function for compute A recursively
-Matrix<double> A_treeSHAP_recurse(Matrix<double> &X, 
-                                Matrix<int> &feature,
-                                Matrix<int> &left_child,
-                                Matrix<int> &right_child,
-                                Matrix<double> &threshold,
-                                Matrix<double> &value)
+// The entries A[i][j] are computed for the foreground X_f and background X_b.
+// When `symmetric`, X_f and X_b are the same dataset and only the pairs with j >= i
+// go through the trees, the pair (i, j) also yielding A[j][i].
+template <typename T, typename R>
+void A_treeSHAP_recurse(const MatrixView<T> &X_f, int Nx,
+                        const MatrixView<T> &X_b, int Nz,
+                        bool symmetric,
+                        int n_features, int* I_map,
+                        const TreeEnsemble &trees,
+                        const MatrixView<R> &A,
+                        int64_t* stats,
+                        bool memoize,
+                        int n_jobs)
         {
     // Setup
-    int n_features = X[0].size();
-    int n_trees = feature.size();
-    int N = X.size();
-
-    // Initialize the taylor SHAP values to zero
-    Matrix <double> A(N, vector<double> (N, 0));
+    int n_trees = trees.n_trees;
+    int n_threads = get_n_threads(n_jobs, Nx);
+
+    // Per-thread scratch buffers
+    vector<Scratch> scratch(n_threads, Scratch(n_features));
+
+    // Trees with few cells are memoized, their table holds A[i][j] and A[j][i] for each pair of cells
+    int64_t n_pairs = symmetric ? (int64_t) Nx * (Nx+1) / 2 : (int64_t) Nx * Nz;
+    vector<TreeCells> cells_f, cells_b;
+    auto table_size = [](int64_t n_cells_f, int64_t n_cells_b, int64_t n_tree_features){
+        return 2 * n_cells_f * n_cells_b * (int64_t) sizeof(double);
+    };
+    vector<char> memoized = find_memoized_trees(X_f, 0, Nx, X_b, 0, Nz, trees, n_features, I_map,
+                                                n_pairs, table_size, cells_f, cells_b, memoize, n_jobs);
+    record_memo_stats(memoized, cells_f, cells_b, n_pairs, stats);
+
+    // Only one pair of rows per pair of cells goes through the recursion
+    Matrix<double> tables_xz(n_trees), tables_zx(n_trees);
+    for (int t(0); t < n_trees; t++){
+        if (!memoized[t]) continue;
+        Tree tree = trees.tree(t);
+        const TreeCells &cx = cells_f[t];
+        const TreeCells &cz = cells_b[t];
+        tables_xz[t].assign((int64_t) cx.n_cells * cz.n_cells, 0);
+        tables_zx[t].assign((int64_t) cx.n_cells * cz.n_cells, 0);
+        parallel_for(cx.n_cells, n_threads, [&](int thread_id, int c){
+            for (int c_z(0); c_z < cz.n_cells; c_z++){
+                int64_t entry = (int64_t) c * cz.n_cells + c_z;
+                recurse_4(0, X_f.row(cx.representative[c]), X_b.row(cz.representative[c_z]), I_map, tree, 
+                          n_features, tables_xz[t][entry], tables_zx[t][entry], scratch[thread_id]);
+            }
+        });
+    }
 
-    progressbar bar(N*(N+1)/2);
+    progressbar bar(n_pairs);
+    mutex bar_mutex;
     // Iterate over all foreground instances
-    for (int i(0); i < N; i++){
+    parallel_for(Nx, n_threads, [&](int thread_id, int i){
+        Scratch &S = scratch[thread_id];
+        RowView<T> x = X_f.row(i);
         // Iterate over all background instances
-        for (int j(i); j < N; j++){
-            // Iterate over all trees in the ensemble
+        for (int j(symmetric ? i : 0); j < Nz; j++){
+            // Per-thread accumulators for the entries A[i][j] and A[j][i]
+            double A_xz(0), A_zx(0);
+            // Iterate over all trees in the ensemble, the contribution of each tree is computed 
+            // separately so that the results do not depend on which trees are memoized
             for (int t(0); t < n_trees; t++){
-                // Last index is the size of the set
-                vector<int> in_SX(n_features+1, 0);
-                vector<int> in_SZ(n_features+1, 0);
-
-                // Start the recursion
-                recurse_4(0, X, i, j, feature[t], left_child[t], right_child[t],
-                            threshold[t], value[t], n_features, A, in_SX, in_SZ);
+                if (memoized[t]){
+                    // Look up the pair of cells
+                    int64_t entry = (int64_t) cells_f[t].cell[i] * cells_b[t].n_cells + cells_b[t].cell[j];
+                    A_xz += tables_xz[t][entry];
+                    A_zx += tables_zx[t][entry];
+                }
+                else {
+                    // Start the recursion
+                    double tree_xz(0), tree_zx(0);
+                    recurse_4(0, x, X_b.row(j), I_map, trees.tree(t), n_features, tree_xz, tree_zx, S);
+                    A_xz += tree_xz;
+                    A_zx += tree_zx;
+                }
             }
+            // On the diagonal both accumulators hold f(x)
+            A(i, j) += A_xz;
+            if (symmetric && i != j){
+                A(j, i) += A_zx;
+            }
+            lock_guard<mutex> lock(bar_mutex);
             bar.update();
         }
+    });
+}
+
+
+
+////// Several quantities from a single traversal //////
+
+// Bits of the outputs requested from fused_treeSHAP
+#define OUTPUT_SHAP 1
+#define OUTPUT_TAYLOR 2
+#define OUTPUT_ADDITIVE 4
+#define OUTPUT_A 8
+
+
+// Accumulators of the quantities requested for the current pair (x, z) and tree.
+// `phi` holds the Shapley values, `taylor` the upper triangle of the Shapley-Taylor
+// interactions, `additive_xz` the additive terms H[x, z, 1:] and `A_xz` the entry A[x, z].
+struct FusedPair {
+    int outputs;
+    vector<double> phi;
+    vector<double> taylor;
+    vector<double> additive_xz;
+    double A_xz;
+
+    FusedPair(int outputs_, int n_features) :
+        outputs(outputs_), phi(n_features, 0),
+        taylor(outputs_ & OUTPUT_TAYLOR ? n_features * n_features : 0, 0),
+        additive_xz(outputs_ & OUTPUT_ADDITIVE ? n_features : 0, 0), A_xz(0) {}
+};
+
+
+// Recursion function shared by all the requested outputs, the leaf handlers of recurse,
+// recurse_2, recurse_3 and recurse_4 are applied to the same (S_X, S_Z, value) state.
+// The branches that cannot reach a non-zero leaf of any requested output are pruned.
+template <typename T>
+pair<double, double> recurse_fused(int n,
+                                   const RowView<T> &x, const RowView<T> &z,
+                                   int* I_map,
+                                   const Tree &tree,
+                                   vector<vector<double>> &W,
+                                   int n_features,
+                                   FusedPair &P,
+                                   Scratch &S)
+{
+    vector<int> &in_SX = S.in_SX;
+    vector<int> &in_SZ = S.in_SZ;
+    int current_feature = tree.nodes[n].feature;
+    int x_child(0), z_child(0);
+    int size_SX = in_SX[n_features];
+    int size_SZ = in_SZ[n_features];
+
+    // Arriving at a Leaf
+    if (tree.nodes[n].child_left < 0)
+    {
+        double value = tree.nodes[n].value;
+        int num_players = size_SX + size_SZ;
+        // Shapley values, see recurse
+        double pos(0.0), neg(0.0);
+        if (P.outputs & OUTPUT_SHAP){
+            if (size_SX > 0){
+                pos = W[size_SX-1][num_players-1] * value;
+            }
+            if (size_SZ > 0){
+                neg = W[size_SX][num_players-1] * value;
+            }
+        }
+        // Shapley-Taylor interactions, see recurse_2
+        if ((P.outputs & OUTPUT_TAYLOR) && num_players > 0){
+            taylor_leaf(S.members_SX, size_SX, S.members_SZ, size_SZ, value, W, n_features, P.taylor);
+        }
+        // Additive terms, see recurse_3
+        if (P.outputs & OUTPUT_ADDITIVE){
+            if (size_SX == 0){
+                for (int a(0); a < size_SZ; a++){
+                    P.additive_xz[S.members_SZ[a]] -= value;
+                }
+            }
+            else if (size_SX == 1){
+                P.additive_xz[S.members_SX[0]] += value;
+            }
+        }
+        // Entry of A, see recurse_4, the empty coalition gives f(z)
+        if (P.outputs & OUTPUT_A){
+            if (size_SX == 0){
+                P.A_xz += (1 - size_SZ) * value;
+            }
+            else if (size_SX == 1){
+                P.A_xz += value;
+            }
+        }
+        return make_pair(pos, neg);
+    }
+
+    // Find children of x and z
+    x_child = tree.child(n, x[current_feature]);
+    z_child = tree.child(n, z[current_feature]);
+
+    // Scenario 1 : x and z go the same way so we avoid the type B edge
+    if (x_child == z_child){
+        return recurse_fused(x_child, x, z, I_map, tree, W, n_features, P, S);
+    }
+
+    // Senario 2: x and z go different ways and we have seen this feature i in I(S_X) U I(S_Z).
+    // Hence we go down the correct edge to ensure that I(S_X) and I(S_Z) are kept disjoint
+    int k = I_map[current_feature];
+    if (in_SX[k] || in_SZ[k]){
+        if (in_SX[k]){
+            return recurse_fused(x_child, x, z, I_map, tree, W, n_features, P, S);
+        }
+        else{
+            return recurse_fused(z_child, x, z, I_map, tree, W, n_features, P, S);
+        }
     }
-    return A;
+
+    // Scenario 3 : x and z go different ways and we have not yet seen this feature.
+    // The additive terms and A only see the leaves where |S_X| <= 1
+    else {
+        bool full = P.outputs & (OUTPUT_SHAP | OUTPUT_TAYLOR);
+        S.touch(k);
+        pair<double, double> pairf(0.0, 0.0), pairb(0.0, 0.0);
+        // Go to x's child
+        if (full || size_SX == 0){
+            S.push_SX(k);
+            pairf = recurse_fused(x_child, x, z, I_map, tree, W, n_features, P, S);
+            S.pop_SX(k);
+        }
+
+        // Go to z's child
+        if (full || size_SX <= 1){
+            S.push_SZ(k);
+            pairb = recurse_fused(z_child, x, z, I_map, tree, W, n_features, P, S);
+            S.pop_SZ(k);
+        }
+
+        // Add contribution to the feature
+        P.phi[k] += pairf.first - pairb.second;
+
+        return make_pair(pairf.first + pairb.first, pairf.second + pairb.second);
+    }
+}
+
+
+
+// Main function computing the requested `outputs` in a single traversal of each tree for
+// each pair, phi_f (Nx, d) and taylor_f (Nx, d, d) are averaged over the background while
+// additive_f_b (Nx, Nz, d) and A_f_b (Nx, Nz) hold every pair. The outputs that are not
+// requested are never accessed.
+template <typename T>
+void fused_treeSHAP(const MatrixView<T> &X_f, int Nx,
+                    const MatrixView<T> &X_b, int Nz,
+                    int n_features, int* I_map,
+                    const TreeEnsemble &trees,
+                    Matrix<double> &W,
+                    int outputs,
+                    const MatrixView<double> &phi_f,
+                    const TensorView<double> &taylor_f,
+                    const TensorView<double> &additive_f_b,
+                    const MatrixView<double> &A_f_b,
+                    int n_jobs)
+{
+    // Setup
+    int n_trees = trees.n_trees;
+    int n_threads = get_n_threads(n_jobs, Nx);
+
+    // Per-thread scratch buffers, the quantities of the current instance are summed
+    // over all trees and background instances before being stored
+    vector<Scratch> scratch(n_threads, Scratch(n_features));
+    vector<FusedPair> acc_pair(n_threads, FusedPair(outputs, n_features));
+    Matrix<double> acc_phi(n_threads, vector<double> (n_features, 0));
+    Matrix<double> acc_taylor(n_threads, vector<double> (outputs & OUTPUT_TAYLOR ? n_features * n_features : 0, 0));
+
+    progressbar bar(Nx);
+    mutex bar_mutex;
+    // Iterate over all foreground instances, each one is handled by a single thread
+    parallel_for(Nx, n_threads, [&](int thread_id, int i){
+        Scratch &S = scratch[thread_id];
+        FusedPair &P = acc_pair[thread_id];
+        vector<double> &phi = acc_phi[thread_id];
+        double* taylor = acc_taylor[thread_id].data();
+        RowView<T> x = X_f.row(i);
+        // Iterate over all background instances
+        for (int j(0); j < Nz; j++){
+            RowView<T> z = X_b.row(j);
+            // Iterate over all trees in the ensemble
+            for (int t(0); t < n_trees; t++){
+                // Start the recursion
+                recurse_fused(0, x, z, I_map, trees.tree(t), W, n_features, P, S);
+
+                // Add the contribution of the tree and background instance
+                for (int m(0); m < S.n_touched; m++){
+                    int f = S.touched[m];
+                    phi[f] += P.phi[f];
+                    P.phi[f] = 0;
+                    if (outputs & OUTPUT_ADDITIVE){
+                        additive_f_b(i, j, f) += P.additive_xz[f];
+                        P.additive_xz[f] = 0;
+                    }
+                }
+                if (outputs & OUTPUT_TAYLOR){
+                    flush_taylor(S, P.taylor, n_features, 
+                                 [&](int f1, int f2, double value){ taylor[f1 * n_features + f2] += value; });
+                }
+                S.clear_touched();
+            }
+            if (outputs & OUTPUT_A){
+                A_f_b(i, j) += P.A_xz;
+                P.A_xz = 0;
+            }
+        }
+        // Rescale w.r.t the number of background instances
+        for (int f1(0); f1 < n_features; f1++){
+            if (outputs & OUTPUT_SHAP){
+                phi_f(i, f1) += phi[f1] / Nz;
+            }
+            phi[f1] = 0;
+            if (outputs & OUTPUT_TAYLOR){
+                for (int f2(0); f2 < n_features; f2++){
+                    taylor_f(i, f1, f2) += taylor[f1 * n_features + f2] / Nz;
+                    taylor[f1 * n_features + f2] = 0;
+                }
+            }
+        }
+        lock_guard<mutex> lock(bar_mutex);
+        bar.update();
+    });
 }
 
+
+
 # endif
\ No newline at end of file
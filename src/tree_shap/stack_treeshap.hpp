@@ -16,46 +16,58 @@
 using namespace std;
 
 
-// Main function for compute A with a stack
-Matrix<double> A_treeSHAP_stack(Matrix<double> &X, 
-                                Matrix<int> &feature,
-                                Matrix<int> &left_child,
-                                Matrix<int> &right_child,
-                                Matrix<double> &threshold,
-                                Matrix<double> &value)
+// Main function for compute A with a stack, see `A_treeSHAP_recurse`
+template <typename T, typename R>
+void A_treeSHAP_stack(const MatrixView<T> &X_f, int Nx,
+                      const MatrixView<T> &X_b, int Nz,
+                      bool symmetric,
+                      int n_features, int* I_map, int max_depth,
+                      const TreeEnsemble &trees,
+                      const MatrixView<R> &A,
+                      int n_jobs)
     {
     // Setup
-    int n_features = X[0].size();
-    int n_trees = feature.size();
-    int N = X.size();
+    int n_trees = trees.n_trees;
+    int n_threads = get_n_threads(n_jobs, Nx);
 
-    // Initialize the taylor SHAP values to zero
-    Matrix <double> A(N, vector<double> (N, 0));
+    // Per-thread sets S_X and S_Z and traversal stacks, allocated once.
+    // Each visited node pushes at most two children and pops one, so
+    // the stack never holds more than max_depth + 1 elements
+    vector<FeatureSet> sets(n_threads, FeatureSet(n_features, max_depth));
+    Matrix<tuple<int, int, int, int>> stacks(n_threads, 
+                                             vector<tuple<int, int, int, int>> (max_depth+2));
 
-    progressbar bar(N*(N+1)/2);
-
-    // Init variables for tree-traversal
-    int parent_feature, going_depth_up;
-    int curr_tag, x_child, z_child;
-    tuple<int, int, int, int> curr_tuple;
-    FeatureSet Sets(n_features);           // Class representation of the set SX and SZ
-    // Traverse the tree via a stack who elements are
-    // tuple<int, bool, int> which represent the node index, its depth, parent_feature, and tag
-    stack<tuple<int, int, int, int>> candidates;
+    progressbar bar(symmetric ? (int64_t) Nx * (Nx+1) / 2 : (int64_t) Nx * Nz);
+    mutex bar_mutex;
 
     // Iterate over all foreground instances
-    for (int i(0); i < N; i++){
+    parallel_for(Nx, n_threads, [&](int thread_id, int i){
+        RowView<T> x = X_f.row(i);
+        // Init variables for tree-traversal, they are local to the thread
+        int parent_feature, going_depth_up;
+        int curr_tag, x_child, z_child;
+        tuple<int, int, int, int> curr_tuple;
+        FeatureSet &Sets = sets[thread_id];    // Class representation of the set SX and SZ
+        // Traverse the tree via a stack who elements are
+        // tuple<int, bool, int> which represent the node index, its depth, parent_feature, and tag
+        vector<tuple<int, int, int, int>> &candidates = stacks[thread_id];
+        int stack_size = 0;
+
         // Iterate over all background instances
-        for (int j(i); j < N; j++){
+        for (int j(symmetric ? i : 0); j < Nz; j++){
+            RowView<T> z = X_b.row(j);
+            // Per-thread accumulators for the entries A[i][j] and A[j][i]
+            double A_xz(0), A_zx(0);
             // Iterate over all trees
             for (int t(0); t < n_trees; t++){
+                Tree tree = trees.tree(t);
                 // cout << "|SX| " << Sets.size_SX() << endl;
                 // cout << "|SZ| " << Sets.size_SZ() << endl;
                 // cout << "Is path reset " << Sets.is_path_empty() << endl;
 
                 // Init Root node
                 int n = 0;
-                int curr_feature = feature[t][0];
+                int curr_feature = tree.nodes[0].feature;
                 int curr_depth = 0;
                 // cout << "starting" << endl;
                 // Explore the whole tree via a stack
@@ -70,64 +82,60 @@ Matrix<double> A_treeSHAP_stack(Matrix<double> &X,
                             cout << "Error in tree traversal" << endl;
                         }
                         // Diagonal element
-                        if (i == j){
-                            A[i][i] += value[t][n];
+                        if (symmetric && i == j){
+                            A_xz += tree.nodes[n].value;
                         }
                         else {
                             // |S_X| = 0 so EACH element of S_Z gets a contribution
                             if (Sets.size_SX()==0){
-                                A[i][j] += (1 - Sets.size_SZ()) * value[t][n];
+                                A_xz += (1 - Sets.size_SZ()) * tree.nodes[n].value;
                             }
                             // |S_X| = 1 so the SINGLE element of S_X gets a contribution
                             else if (Sets.size_SX()==1){
-                                A[i][j] += value[t][n];
+                                A_xz += tree.nodes[n].value;
                             }
 
                             // |S_Z| = 0 so EACH element of S_X gets a contribution
                             if (Sets.size_SZ()==0){
-                                A[j][i] += (1 - Sets.size_SX()) * value[t][n];
+                                A_zx += (1 - Sets.size_SX()) * tree.nodes[n].value;
                             }
                             // |S_Z| = 1 so the SINGLE element of S_Z gets a contribution
                             else if (Sets.size_SZ()==1){
-                                A[j][i] += value[t][n];
+                                A_zx += tree.nodes[n].value;
                             }
                         }
                         // The stack is empty so we are done with traversal
-                        if (candidates.empty()){
+                        if (stack_size == 0){
                             Sets.remove_features(curr_depth);
                             break;
                         }
                         // Otherwise we backtrack
-                        going_depth_up = curr_depth - get<1>(candidates.top()) + 1;
+                        going_depth_up = curr_depth - get<1>(candidates[stack_size-1]) + 1;
                         // cout << "Backtracking " << going_depth_up << " steps" << endl;
                         Sets.remove_features(going_depth_up);
                     }
                     else {
                         // Find children of x and z
-                        if (X[i][curr_feature] <= threshold[t][n]){
-                            x_child = left_child[t][n];
-                        } else {x_child = right_child[t][n];}
-                        if (X[j][curr_feature] <= threshold[t][n]){
-                            z_child = left_child[t][n];
-                        } else {z_child = right_child[t][n];}
+                        x_child = tree.child(n, x[curr_feature]);
+                        z_child = tree.child(n, z[curr_feature]);
 
                         // Scenario 1 : x and z go the same way so we avoid the type B edge
                         if (x_child == z_child){
                             // cout << "avoid type B" << endl;
                             // Add the feature to the path and keep SX and SZ intact
-                            candidates.push(make_tuple(x_child, curr_depth+1, curr_feature, 0));
+                            candidates[stack_size++] = make_tuple(x_child, curr_depth+1, I_map[curr_feature], 0);
                         }
 
                         // Senario 2: x and z go different ways and we have seen this feature i in S_X U S_Z.
                         // Hence we go down the correct edge to ensure that S_X and S_Z are kept disjoint
-                        else if (Sets.in_SX(curr_feature) || Sets.in_SZ(curr_feature)){
+                        else if (Sets.in_SX(I_map[curr_feature]) || Sets.in_SZ(I_map[curr_feature])){
                             // cout << "Keep SX and SZ disjoint" << endl;
                             // Add the feature to the path and keep SX and SZ intact
-                            if (Sets.in_SX(curr_feature)){
-                                candidates.push(make_tuple(x_child, curr_depth+1, curr_feature, 0));
+                            if (Sets.in_SX(I_map[curr_feature])){
+                                candidates[stack_size++] = make_tuple(x_child, curr_depth+1, I_map[curr_feature], 0);
                             }
                             else {
-                                candidates.push(make_tuple(z_child, curr_depth+1, curr_feature, 0));
+                                candidates[stack_size++] = make_tuple(z_child, curr_depth+1, I_map[curr_feature], 0);
                             }
                         }
 
@@ -139,20 +147,19 @@ Matrix<double> A_treeSHAP_stack(Matrix<double> &X,
                             // Go to z's child if it is allowed and update SZ
                             if (Sets.size_SX() <= 1 || Sets.size_SZ() == 0){
                                 // cout << "going down z child" << endl;
-                                candidates.push(make_tuple(z_child, curr_depth+1, curr_feature, 2));
+                                candidates[stack_size++] = make_tuple(z_child, curr_depth+1, I_map[curr_feature], 2);
                             }
 
                             // Go to x's child if it is allowed and update SX
                             if (Sets.size_SX() == 0 || Sets.size_SZ() <= 1){
                                 // cout << "going down x child" << endl;
-                                candidates.push(make_tuple(x_child, curr_depth+1, curr_feature, 1));
+                                candidates[stack_size++] = make_tuple(x_child, curr_depth+1, I_map[curr_feature], 1);
                             }
                         }
                     }
 
                     // Pop the triplet on top of the stack
-                    curr_tuple = candidates.top();
-                    candidates.pop();
+                    curr_tuple = candidates[--stack_size];
                     n = get<0>(curr_tuple);
                     curr_depth = get<1>(curr_tuple);
                     parent_feature = get<2>(curr_tuple);
@@ -165,13 +172,18 @@ Matrix<double> A_treeSHAP_stack(Matrix<double> &X,
                     Sets.add_feature(parent_feature, curr_tag);
 
                     // Set the feature of the current node
-                    curr_feature = feature[t][n];
+                    curr_feature = tree.nodes[n].feature;
                 }
             }
+            // The pair (i, j) is the only one writing to A[i][j] and A[j][i]
+            A(i, j) += A_xz;
+            if (symmetric && i != j){
+                A(j, i) += A_zx;
+            }
+        lock_guard<mutex> lock(bar_mutex);
         bar.update();
         }
-    }
-    return A;
+    });
 }
 
 # endif
\ No newline at end of file
@@ -5,6 +5,18 @@
 
 #include <vector>
 #include <stack>
+#include <map>
+#include <cstdint>
+#include <iostream>
+#include <thread>
+#include <atomic>
+#include <mutex>
+#include <condition_variable>
+#include <functional>
+#ifdef __linux__
+#include <pthread.h>
+#include <sched.h>
+#endif
 
 using namespace std;
 
@@ -15,32 +27,87 @@ template <typename T>
 using Tensor = vector<vector<vector<T>>>;
 
 
-template<typename T>
-Matrix<T> createMatrix(int n, int m, T* data){
-    Matrix<T> mat;
-    for (int i(0); i < n; i++){
-        mat.push_back(vector<T> ());
-        for (int j(0); j < m; j++){
-            mat[i].push_back((data[m * i + j]));
-        }
+// Non-owning views of the NumPy buffers handed over by Python.
+// Strides are counted in elements so that Fortran-ordered arrays,
+// column slices and pandas blocks are read and written in place.
+template <typename T>
+struct RowView {
+    const T* data;
+    int64_t stride;
+
+    inline T operator[](int k) const { return data[k * stride]; }
+};
+
+template <typename T>
+struct MatrixView {
+    T* data;
+    int64_t stride_0, stride_1;
+
+    MatrixView(T* data_, int64_t* strides) :
+        data(data_), stride_0(strides[0]), stride_1(strides[1]) {}
+
+    inline T& operator()(int i, int j) const { return data[i * stride_0 + j * stride_1]; }
+    inline RowView<T> row(int i) const { return RowView<T> {data + i * stride_0, stride_1}; }
+};
+
+template <typename T>
+struct TensorView {
+    T* data;
+    int64_t stride_0, stride_1, stride_2;
+
+    TensorView(T* data_, int64_t* strides) :
+        data(data_), stride_0(strides[0]), stride_1(strides[1]), stride_2(strides[2]) {}
+
+    inline T& operator()(int i, int j, int k) const {
+        return data[i * stride_0 + j * stride_1 + k * stride_2];
     }
-    return mat;
-}
+};
 
-template<typename T>
-Tensor<T> createTensor(int n, int m, int l, T* data){
-    Tensor<T> mat;
-    for (int i(0); i < n; i++){
-        mat.push_back(Matrix<T> ());
-        for (int j(0); j < m; j++){
-            mat[i].push_back(vector<T> ());
-            for (int k(0); k < l; k++){
-                mat[i][j].push_back((data[l * m * i + l * j + k]));
-            }
-        }
+
+// Missing values are NaN for floating point instances. Instances encoded as the rank of
+// their values among the thresholds of the ensemble use the largest code instead.
+template <typename T>
+inline bool is_missing(T x_value) { return x_value != x_value; }
+inline bool is_missing(uint8_t x_value) { return x_value == UINT8_MAX; }
+inline bool is_missing(uint16_t x_value) { return x_value == UINT16_MAX; }
+
+
+// A node packed in a single 32-byte record so that visiting it touches one cache line.
+// The children are indexed from the first node of their tree and are negative for leaves.
+struct Node {
+    int feature;
+    int child_left;
+    int child_right;
+    int child_default;
+    double threshold;
+    double value;
+};
+
+// A single tree, i.e. a pointer to its first node
+struct Tree {
+    const Node* nodes;
+
+    // Child reached by an instance, missing values follow the default direction
+    template <typename T>
+    inline int child(int n, T x_value) const {
+        const Node &node = nodes[n];
+        if (is_missing(x_value)) return node.child_default;
+        return (x_value <= node.threshold) ? node.child_left : node.child_right;
     }
-    return mat;
-}
+};
+
+// The whole ensemble stored as the concatenation of its trees (CSR-style),
+// the nodes of tree t are nodes[offsets[t]:offsets[t+1]]
+struct TreeEnsemble {
+    int n_trees;
+    const Node* nodes;
+    const int64_t* offsets;
+
+    inline Tree tree(int t) const {
+        return Tree {nodes + offsets[t]};
+    }
+};
+
 
 template<typename T>
 void printMatrix(Matrix<T> mat){
@@ -72,6 +139,182 @@ void printTensor(Tensor<T> mat){
 
 
 
+// CPUs the calling thread may run on, which taskset and cgroup cpusets restrict.
+// Empty when the platform does not tell.
+inline vector<int> allowed_cpus()
+{
+    vector<int> cpus;
+#ifdef __linux__
+    cpu_set_t mask;
+    CPU_ZERO(&mask);
+    if (sched_getaffinity(0, sizeof(cpu_set_t), &mask) == 0){
+        for (int cpu(0); cpu < CPU_SETSIZE; cpu++){
+            if (CPU_ISSET(cpu, &mask)) cpus.push_back(cpu);
+        }
+    }
+#endif
+    return cpus;
+}
+
+
+// Number of threads to use given the joblib-like n_jobs argument
+// n_jobs=-1 means all allowed cores, n_jobs=-2 all allowed cores but one, etc.
+inline int get_n_threads(int n_jobs, int n_tasks)
+{
+    int n_cores = allowed_cpus().size();
+    if (n_cores < 1) n_cores = thread::hardware_concurrency();
+    if (n_cores < 1) n_cores = 1;
+    int n_threads = (n_jobs > 0) ? n_jobs : n_cores + 1 + n_jobs;
+    if (n_threads > n_tasks) n_threads = n_tasks;
+    if (n_threads < 1) n_threads = 1;
+    return n_threads;
+}
+
+
+// Worker threads that live for the whole session so that a call does not pay for
+// spawning them, which dominates when a single instance is explained. On Linux worker k
+// is pinned to the k-th CPU the process is allowed to use, modulo their number, and the
+// calling thread always acts as worker 0.
+class ThreadPool {
+public:
+    static ThreadPool& instance(){
+        static ThreadPool pool;
+        return pool;
+    }
+
+    // Run job(thread_id) for thread_id in [0, n_threads) and wait for all of them.
+    // Calls from a worker, or while another call is running, are executed serially
+    // on the calling thread so that the pool can never deadlock.
+    void run(int n_threads, const function<void(int)> &job){
+        unique_lock<mutex> busy(run_mutex, defer_lock);
+        if (n_threads <= 1 || in_worker() || !busy.try_lock()){
+            for (int thread_id(0); thread_id < n_threads; thread_id++){
+                job(thread_id);
+            }
+            return;
+        }
+        {
+            lock_guard<mutex> lock(state_mutex);
+            while ((int) workers.size() < n_threads - 1){
+                int k = workers.size() + 1;
+                workers.push_back(thread(&ThreadPool::work, this, k));
+            }
+            current_job = &job;
+            n_active = n_threads;
+            n_remaining = n_threads - 1;
+            generation++;
+        }
+        start.notify_all();
+        job(0);
+        unique_lock<mutex> lock(state_mutex);
+        done.wait(lock, [this](){ return n_remaining == 0; });
+        current_job = nullptr;
+    }
+
+    ~ThreadPool(){
+        {
+            lock_guard<mutex> lock(state_mutex);
+            stopping = true;
+        }
+        start.notify_all();
+        for (auto &worker : workers){
+            worker.join();
+        }
+    }
+
+private:
+    vector<thread> workers;
+    mutex run_mutex, state_mutex;
+    condition_variable start, done;
+    const function<void(int)>* current_job = nullptr;
+    int n_active = 0, n_remaining = 0;
+    int64_t generation = 0;
+    bool stopping = false;
+
+    ThreadPool() {}
+
+    static bool& in_worker(){
+        static thread_local bool flag = false;
+        return flag;
+    }
+
+    void work(int k){
+        in_worker() = true;
+#ifdef __linux__
+        // Workers inherit the mask of the thread that spawned them, which is never a worker
+        vector<int> allowed = allowed_cpus();
+        if (allowed.size() > 0){
+            cpu_set_t cpus;
+            CPU_ZERO(&cpus);
+            CPU_SET(allowed[k % allowed.size()], &cpus);
+            pthread_setaffinity_np(pthread_self(), sizeof(cpu_set_t), &cpus);
+        }
+#endif
+        int64_t seen = 0;
+        while (true){
+            const function<void(int)>* job;
+            {
+                unique_lock<mutex> lock(state_mutex);
+                start.wait(lock, [this, seen](){ return stopping || generation != seen; });
+                if (stopping) return;
+                seen = generation;
+                if (k >= n_active) continue;
+                job = current_job;
+            }
+            (*job)(k);
+            {
+                lock_guard<mutex> lock(state_mutex);
+                n_remaining--;
+            }
+            done.notify_one();
+        }
+    }
+};
+
+
+// Run fn(thread_id, task) for all tasks in [0, n_tasks) with n_threads workers.
+// Tasks are handed out dynamically so that triangular loops remain balanced.
+// When n_threads=1 everything runs on the calling thread.
+template <typename Function>
+void parallel_for(int n_tasks, int n_threads, Function fn)
+{
+    if (n_threads <= 1){
+        for (int task(0); task < n_tasks; task++){
+            fn(0, task);
+        }
+        return;
+    }
+    atomic<int> next_task(0);
+    ThreadPool::instance().run(n_threads, [&next_task, &fn, n_tasks](int thread_id){
+        int task;
+        while ((task = next_task++) < n_tasks){
+            fn(thread_id, task);
+        }
+    });
+}
+
+
+// Same as parallel_for but the tasks thread_id, thread_id + n_threads, ...
+// always go to the same worker. Reductions over per-thread buffers are then
+// deterministic for a given number of threads.
+template <typename Function>
+void parallel_for_static(int n_tasks, int n_threads, Function fn)
+{
+    if (n_threads <= 1){
+        for (int task(0); task < n_tasks; task++){
+            fn(0, task);
+        }
+        return;
+    }
+    ThreadPool::instance().run(n_threads, [&fn, n_tasks, n_threads](int thread_id){
+        for (int task(thread_id); task < n_tasks; task += n_threads){
+            fn(thread_id, task);
+        }
+    });
+}
+
+
+
 void compute_W(Matrix<double> &W)
 {
     int D = W.size();
@@ -88,14 +331,112 @@ void compute_W(Matrix<double> &W)
 
 
 
+// Buffers owned by a single thread and reused for all its (x, z, tree) triples so that
+// the inner loops never allocate. The recursions restore in_SX and in_SZ before returning
+// and the accumulators of a triple are only non-zero at the features listed in `touched`,
+// hence resetting them costs O(|touched|) instead of O(d).
+struct Scratch {
+    int d;
+    // Last index is the size of the set
+    vector<int> in_SX;
+    vector<int> in_SZ;
+    // Explicit members of S_X and S_Z in the order they were added along the path,
+    // their sizes are in_SX[d] and in_SZ[d]
+    vector<int> members_SX;
+    vector<int> members_SZ;
+    // Features that entered S_X or S_Z, there can be at most d of them
+    vector<int> touched;
+    vector<char> is_touched;
+    int n_touched;
+
+    Scratch(int n_features) :
+        d(n_features), in_SX(n_features+1, 0), in_SZ(n_features+1, 0),
+        members_SX(n_features), members_SZ(n_features),
+        touched(n_features), is_touched(n_features, 0), n_touched(0) {}
+
+    // Sets are only ever modified at the end of the path, like a stack
+    inline void push_SX(int k) { members_SX[in_SX[d]] = k; in_SX[k]++; in_SX[d]++; }
+    inline void pop_SX(int k) { in_SX[k]--; in_SX[d]--; }
+    inline void push_SZ(int k) { members_SZ[in_SZ[d]] = k; in_SZ[k]++; in_SZ[d]++; }
+    inline void pop_SZ(int k) { in_SZ[k]--; in_SZ[d]--; }
+
+    inline void touch(int k) {
+        if (!is_touched[k]){
+            is_touched[k] = 1;
+            touched[n_touched++] = k;
+        }
+    }
+
+    inline void clear_touched() {
+        for (int m(0); m < n_touched; m++){
+            is_touched[touched[m]] = 0;
+        }
+        n_touched = 0;
+    }
+};
+
+
+
+// Two rows are in the same cell of a tree when they take the same branch at every
+// internal node. The recursions only see the branches taken by x and z, hence they
+// return the same values for all pairs of rows (x, z) sharing the same pair of cells.
+struct TreeCells {
+    int n_cells;
+    // Cell of each row, counted from the first row of the range
+    vector<int> cell;
+    // First row of each cell and number of rows it contains
+    vector<int> representative;
+    vector<int> count;
+};
+
+
+// Cells of the rows [start, end) of X for a tree with n_nodes nodes
+template <typename T>
+TreeCells compute_cells(const MatrixView<T> &X, int start, int end, const Tree &tree, int n_nodes)
+{
+    TreeCells cells;
+    cells.n_cells = 0;
+    cells.cell.reserve(end - start);
+    // The signature of a row is the bitset of internal nodes where it goes left
+    map<vector<uint64_t>, int> ids;
+    vector<uint64_t> signature((n_nodes + 63) / 64);
+    for (int i(start); i < end; i++){
+        RowView<T> x = X.row(i);
+        for (auto &word : signature){
+            word = 0;
+        }
+        for (int n(0); n < n_nodes; n++){
+            const Node &node = tree.nodes[n];
+            if (node.child_left >= 0 && tree.child(n, x[node.feature]) == node.child_left){
+                signature[n / 64] |= uint64_t(1) << (n % 64);
+            }
+        }
+        auto found = ids.find(signature);
+        if (found == ids.end()){
+            ids[signature] = cells.n_cells;
+            cells.cell.push_back(cells.n_cells++);
+            cells.representative.push_back(i);
+            cells.count.push_back(1);
+        }
+        else {
+            cells.cell.push_back(found->second);
+            cells.count[found->second]++;
+        }
+    }
+    return cells;
+}
+
+
+
 class FeatureSet {
     // Class that represents the sets S_X and S_Z of features from the root to leaf
     // As one traverses the decision tree, the features are added and removed 
     // to these sets following the root-leaf path. 
+    // The path is stored in fixed-capacity arrays since it is never deeper than the trees.
 
     public:
         // default constructor
-        FeatureSet(int d);
+        FeatureSet(int d, int max_depth);
 
         // default destructor
         ~FeatureSet() = default;
@@ -127,18 +468,20 @@ class FeatureSet {
         int size_SZ_;
         vector<int> in_SX_;
         vector<int> in_SZ_;
-        stack<int> feature_path_;
-        stack<int> tags_;
+        vector<int> feature_path_;
+        vector<int> tags_;
+        int path_size_;
 };
 
-inline FeatureSet::FeatureSet(int d) :
+inline FeatureSet::FeatureSet(int d, int max_depth) :
     d_(d),
     size_SX_(0),
     size_SZ_(0),
     in_SX_(vector<int> (d, 0)),
     in_SZ_(vector<int> (d, 0)),
-    feature_path_(stack<int> ()),
-    tags_(stack<int> ()) {}
+    feature_path_(vector<int> (max_depth+1)),
+    tags_(vector<int> (max_depth+1)),
+    path_size_(0) {}
 
 
 inline int FeatureSet::size_SX() {
@@ -169,8 +512,9 @@ inline int FeatureSet::in_SZ(int i) {
 // }
 
 inline void FeatureSet::add_feature(int feature, int tag) {
-    feature_path_.push(feature);
-    tags_.push(tag);
+    feature_path_[path_size_] = feature;
+    tags_[path_size_] = tag;
+    path_size_++;
     // Add feature to SX
     if (tag == 1) {
         in_SX_[feature] = 1;
@@ -186,10 +530,9 @@ inline void FeatureSet::add_feature(int feature, int tag) {
 inline void FeatureSet::remove_features(int d) {
     int last_feature, last_tag;
     for (int i(0); i < d; i++){
-        last_feature = feature_path_.top();
-        last_tag = tags_.top();
-        feature_path_.pop();
-        tags_.pop();
+        path_size_--;
+        last_feature = feature_path_[path_size_];
+        last_tag = tags_[path_size_];
         // Remove from SX
         if (last_tag == 1){
             in_SX_[last_feature] = 0;
@@ -203,7 +546,7 @@ inline void FeatureSet::remove_features(int d) {
 }
 
 inline bool FeatureSet::is_path_empty() {
-    return feature_path_.empty();
+    return path_size_ == 0;
 }
 
 #endif
\ No newline at end of file
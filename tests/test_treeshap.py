@@ -3,7 +3,10 @@
 import pytest
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from sklearn.ensemble import GradientBoostingClassifier, GradientBoostingRegressor
+from sklearn.ensemble import ExtraTreesClassifier, ExtraTreesRegressor
+from sklearn.ensemble import HistGradientBoostingClassifier, HistGradientBoostingRegressor
 import numpy as np
+import pandas as pd
 from scipy.stats import chi2
 import time
 
@@ -15,7 +18,13 @@ import sys, os
 sys.path.append(os.path.join(".."))
 from src.anova import interventional_treeshap, interventional_taylor_treeshap
 from src.anova import get_ANOVA_1, get_ANOVA_1_tree
-from src.anova import get_A_treeshap
+from src.anova import get_A_treeshap, interventional_additive_treeshap
+from src.anova import get_ANOVA_1_tree_reduce, get_PFI, interventional_taylor_treeshap_reduce
+from src.anova import TreeANOVA, get_black_box, get_regional_shap, interventional_fused_treeshap
+from src.tree_ensemble import extract_tree_ensemble, load_xgboost_json, load_lightgbm_text
+from src.tree_ensemble import pack_tree_ensemble
+from src.anova_tree import L2CoETree, PFITree, GADGET_PDP, CART
+from src.features import Features
 
 
 def compare_shap_implementations(X, model, black_box):
@@ -115,6 +124,637 @@ def compare_A_implementations(X, model, black_box, use_stack):
 
 
 
+def compare_serial_parallel(X, model, n_jobs):
+    if X.shape[0] > 100:
+        X = X[:100]
+    background = X[:50]
+
+    # Every entry point must return exactly the same values as the serial run
+    serial, _ = interventional_treeshap(model, X, background)
+    parallel, _ = interventional_treeshap(model, X, background, n_jobs=n_jobs)
+    assert np.array_equal(serial, parallel)
+
+    serial, _ = interventional_taylor_treeshap(model, X, background)
+    parallel, _ = interventional_taylor_treeshap(model, X, background, n_jobs=n_jobs)
+    assert np.array_equal(serial, parallel)
+
+    # Explaining X against itself traverses each pair once
+    serial, _ = interventional_treeshap(model, X, X)
+    parallel, _ = interventional_treeshap(model, X, X, n_jobs=n_jobs)
+    assert np.array_equal(serial, parallel)
+
+    serial, _ = interventional_taylor_treeshap(model, X[:40], X[:40])
+    parallel, _ = interventional_taylor_treeshap(model, X[:40], X[:40], n_jobs=n_jobs)
+    assert np.array_equal(serial, parallel)
+
+    # A single foreground instance splits the trees among the threads
+    serial, _ = interventional_treeshap(model, X[:1], X)
+    parallel, _ = interventional_treeshap(model, X[:1], X, n_jobs=n_jobs)
+    assert np.array_equal(serial, parallel)
+
+    serial = interventional_additive_treeshap(model, X)
+    parallel = interventional_additive_treeshap(model, X, n_jobs=n_jobs)
+    assert np.array_equal(serial, parallel)
+
+    for use_stack in [False, True]:
+        serial = get_A_treeshap(model, X, use_stack)
+        parallel = get_A_treeshap(model, X, use_stack, n_jobs=n_jobs)
+        assert np.array_equal(serial, parallel)
+
+
+
+
+def compare_memory_layouts(X, model):
+    X = X[:60]
+    reference_shap, _ = interventional_treeshap(model, X, X)
+    reference_A = interventional_additive_treeshap(model, X)
+
+    # Fortran-ordered arrays and DataFrames are read in place
+    X_fortran = np.asfortranarray(X)
+    custom_shap, _ = interventional_treeshap(model, X_fortran, X_fortran)
+    assert np.array_equal(reference_shap, custom_shap)
+    custom_A = interventional_additive_treeshap(model, pd.DataFrame(X))
+    assert np.array_equal(reference_A, custom_A)
+
+    # Strided views of a larger array
+    X_wide = np.repeat(X, 2, axis=1)
+    custom_shap, _ = interventional_treeshap(model, X_wide[:, ::2], X_wide[:, ::2])
+    assert np.array_equal(reference_shap, custom_shap)
+
+    # Float32 inputs must give the same results as their float64 cast
+    X_32 = X.astype(np.float32)
+    X_64 = X_32.astype(np.float64)
+    reference_shap, _ = interventional_treeshap(model, X_64, X_64)
+    custom_shap, _ = interventional_treeshap(model, X_32, X_32)
+    assert np.array_equal(reference_shap, custom_shap)
+
+
+
+
+def compare_tiled_H(X, model, task, tmp_path):
+    X = X[:50]
+    reference_H = get_ANOVA_1_tree(X, model, task=task)
+
+    # A small memory budget forces many rectangular tiles
+    filename = os.path.join(tmp_path, "H.npy")
+    for memory_budget in [16 * 5 * 7**2, 16 * 5 * 20**2]:
+        get_ANOVA_1_tree(X, model, task=task, filename=filename, memory_budget=memory_budget)
+        custom_H = np.load(filename, mmap_mode="r")
+        assert np.array_equal(reference_H, custom_H)
+
+
+
+def compare_reductions(X, model, task, n_jobs):
+    X = X[:50]
+    # Global summaries of H
+    H = get_ANOVA_1_tree(X, model, task=task)
+    pdp, I_PFI, non_additivity = get_ANOVA_1_tree_reduce(X, model, task=task, n_jobs=n_jobs)
+    assert np.isclose(H[..., 1:].mean(1), pdp).all()
+    assert np.isclose(get_PFI(H), I_PFI).all()
+    f = H.sum(-1)[np.arange(50), np.arange(50)]
+    assert np.isclose(np.mean((f - H.sum(-1).mean(1))**2), non_additivity)
+
+    # Global summaries of the Shapley-Taylor indices
+    Phis, _ = interventional_taylor_treeshap(model, X, X)
+    phi2_mean, totals = interventional_taylor_treeshap_reduce(model, X, X, n_jobs=n_jobs)
+    assert np.isclose((Phis**2).mean(0), phi2_mean).all()
+    assert np.isclose(Phis.sum(-1).sum(-1), totals).all()
+
+
+
+def compare_explainer(X, model, task):
+    X = X[:40]
+    explainer = TreeANOVA(model, X)
+    # The same explainer is reused with different backgrounds
+    for background in [X, X[:10], X[20:]]:
+        phis, _ = interventional_treeshap(model, X, background)
+        assert np.array_equal(phis, explainer.shap(X, background))
+        Phis, _ = interventional_taylor_treeshap(model, X, background)
+        assert np.array_equal(Phis, explainer.taylor(X, background))
+    assert np.array_equal(get_ANOVA_1_tree(X, model, task=task), explainer.H(X, task))
+    assert np.array_equal(get_A_treeshap(model, X), explainer.A(X))
+
+
+
+def compare_tree_extraction(X, model, black_box):
+    X = X[:50]
+    # Same arrays as the SHAP API
+    ensemble = extract_tree_ensemble(model)
+    shap_ensemble = Tree(model, data=X).model
+    for attr in ["children_left", "children_right", "children_default", "features"]:
+        assert np.array_equal(getattr(ensemble, attr), getattr(shap_ensemble, attr))
+    assert np.isclose(ensemble.thresholds, shap_ensemble.thresholds).all()
+    # Only the leaf values are used, SHAP recomputes the internal ones with the data
+    is_leaf = ensemble.children_left < 0
+    assert np.isclose(ensemble.values[is_leaf], shap_ensemble.values[is_leaf]).all()
+    assert np.isclose(ensemble.base_offset, shap_ensemble.base_offset).all()
+
+    # Efficiency of the Shapley values
+    phis = TreeANOVA(model).shap(X, X)
+    assert np.isclose(phis.sum(1), black_box(X) - black_box(X).mean()).all()
+    A = TreeANOVA(model).A(X)
+    assert np.isclose(np.diag(A), black_box(X)).all()
+
+
+
+def to_xgboost_json(model):
+    """ Write a GradientBoostingRegressor in the JSON format of XGBoost """
+    trees = []
+    for e in model.estimators_[:, 0]:
+        tree_ = e.tree_
+        # sklearn goes left when x <= t, XGBoost when x < c in float32
+        floor = tree_.threshold.astype(np.float32)
+        floor = np.where(floor > tree_.threshold, np.nextafter(floor, np.float32(-np.inf)), floor)
+        split_conditions = np.nextafter(floor, np.float32(np.inf)).astype(np.float64)
+        is_leaf = tree_.children_left < 0
+        leaf_values = model.learning_rate * tree_.value[:, 0, 0]
+        trees.append({"left_children" : tree_.children_left.tolist(),
+                      "right_children" : tree_.children_right.tolist(),
+                      "split_indices" : np.maximum(tree_.feature, 0).tolist(),
+                      "split_conditions" : np.where(is_leaf, leaf_values, split_conditions).tolist(),
+                      "default_left" : [1] * tree_.node_count,
+                      "split_type" : [0] * tree_.node_count})
+    base_score = str(model.init_.constant_[0, 0])
+    return {"learner" : {"learner_model_param" : {"base_score" : base_score, "num_class" : "0"},
+                         "objective" : {"name" : "reg:squarederror"},
+                         "gradient_booster" : {"name" : "gbtree", "model" : {"trees" : trees}}}}
+
+
+def to_lightgbm_text(model):
+    """ Write a GradientBoostingRegressor in the text format of LightGBM """
+    def to_str(array):
+        return " ".join([repr(a) for a in array.tolist()])
+
+    lines = ["tree", "version=v3", "num_class=1", "num_tree_per_iteration=1", ""]
+    for t, e in enumerate(model.estimators_[:, 0]):
+        tree_ = e.tree_
+        is_leaf = tree_.children_left < 0
+        # Internal nodes and leaves are numbered separately
+        internal_idx = np.cumsum(~is_leaf) - 1
+        leaf_idx = np.cumsum(is_leaf) - 1
+        renumber = np.where(is_leaf, ~leaf_idx, internal_idx)
+        leaf_values = model.learning_rate * tree_.value[is_leaf, 0, 0]
+        # The init value is folded into the first tree
+        if t == 0:
+            leaf_values += model.init_.constant_[0, 0]
+        lines += [f"Tree={t}", f"num_leaves={is_leaf.sum()}", "num_cat=0",
+                  "split_feature=" + to_str(tree_.feature[~is_leaf]),
+                  "threshold=" + to_str(tree_.threshold[~is_leaf]),
+                  "decision_type=" + to_str(10 * np.ones((~is_leaf).sum(), dtype=int)),
+                  "left_child=" + to_str(renumber[tree_.children_left[~is_leaf]]),
+                  "right_child=" + to_str(renumber[tree_.children_right[~is_leaf]]),
+                  "leaf_value=" + to_str(leaf_values), "shrinkage=1", "", ""]
+    return "\n".join([*lines, "end of trees"])
+
+
+def compare_model_loaders(X, model):
+    X = X[:50].astype(np.float32).astype(np.float64)
+    reference_phis = TreeANOVA(model).shap(X, X)
+    for ensemble in [load_xgboost_json(to_xgboost_json(model)), load_lightgbm_text(to_lightgbm_text(model))]:
+        assert np.isclose(ensemble.predict(X), model.predict(X)).all()
+        assert np.isclose(TreeANOVA(ensemble).shap(X, X), reference_phis).all()
+        H = get_ANOVA_1_tree(X, ensemble, task="regression")
+        assert np.isclose(H, get_ANOVA_1_tree(X, model, task="regression")).all()
+
+
+
+def compare_bitset(X, model, task):
+    X = X[:150]
+    explainer = TreeANOVA(model, X)
+    # Backgrounds that fill one word, several words, and a partial last word
+    for background in [X[:64], X[:130]]:
+        phis = explainer.shap(X, background)
+        assert np.isclose(phis, explainer.shap(X, background, use_bitset=True)).all()
+    I_map = np.array([0, 1, 1, 2, 2], dtype=np.int32)
+    phis = explainer.shap(X, X, I_map=I_map)
+    assert np.isclose(phis, explainer.shap(X, X, I_map=I_map, use_bitset=True)).all()
+
+    # The additive terms are scattered to the background instances
+    H = explainer.additive(X)
+    assert np.isclose(H, explainer.additive(X, use_bitset=True)).all()
+    out_rows, out_cols = np.zeros((40, 70, 5)), np.zeros((70, 40, 5))
+    explainer.additive_block(X, (20, 60), (50, 120), out_rows, out_cols, use_bitset=True)
+    # Only the pairs (i, j) with j > i are computed
+    upper = (np.arange(50, 120).reshape((1, -1)) > np.arange(20, 60).reshape((-1, 1)))[..., None]
+    assert np.isclose(H[20:60, 50:120] * upper, out_rows).all()
+    assert np.isclose(H[50:120, 20:60] * upper.transpose(1, 0, 2), out_cols).all()
+    assert np.isclose(get_ANOVA_1_tree(X, model, task=task), 
+                      get_ANOVA_1_tree(X, model, task=task, use_bitset=True)).all()
+
+
+
+def compare_memoization(X, model):
+    # Binary features put many rows in the same cells of the trees
+    X = np.sign(X[:120])
+    explainer = TreeANOVA(model, X)
+
+    # The bitset and stack engines never use the memo tables
+    phis = explainer.shap(X, X[:100])
+    assert explainer.memo_stats[0] == 120 * 100 * explainer.Nt
+    assert explainer.memo_hit_rate() > 0.5
+    assert np.isclose(phis, explainer.shap(X, X[:100], use_bitset=True)).all()
+
+    H = explainer.additive(X)
+    assert explainer.memo_hit_rate() > 0.5
+    assert np.isclose(H, explainer.additive(X, use_bitset=True)).all()
+
+    A = explainer.A(X)
+    assert explainer.memo_stats[0] == 120 * 121 // 2 * explainer.Nt
+    assert explainer.memo_hit_rate() > 0.5
+    assert np.isclose(A, explainer.A(X, use_stack=True)).all()
+
+    # Without memoization every triple goes through the recursion
+    explainer = TreeANOVA(model, X, memoize=False)
+    assert np.isclose(phis, explainer.shap(X, X[:100])).all()
+    assert explainer.memo_stats[1] == 120 * 100 * np.sum(~explainer.closed_form)
+    assert np.isclose(H, explainer.additive(X)).all()
+    assert explainer.memo_hit_rate() == 0
+    assert np.isclose(A, explainer.A(X)).all()
+
+
+
+def compare_deduplication(X, model, task):
+    # Binary features put many rows in the same cells of all trees
+    X = np.sign(X[:120])
+    explainer = TreeANOVA(model, X)
+    X_unique, weights, inverse = explainer.deduplicate(X)
+    assert len(X_unique) < 120
+    assert weights.sum() == 120
+    X_expanded = X_unique[inverse]
+
+    # The rows of a group are interchangeable for the kernels
+    phis = explainer.shap(X, X)
+    assert np.isclose(phis, explainer.shap(X_expanded, X_expanded)).all()
+    assert np.isclose(phis, explainer.shap(X, X, deduplicate=True)).all()
+    assert np.isclose(phis, explainer.shap(X, X, use_bitset=True, deduplicate=True)).all()
+    assert np.isclose(phis, explainer.shap(X, X_unique, weights=weights)).all()
+    # The weights of the rows of a group add up
+    w = np.arange(1, 121, dtype=np.float64)
+    assert np.isclose(explainer.shap(X, X, weights=w), explainer.shap(X, X, weights=w, deduplicate=True)).all()
+    assert np.isclose(explainer.shap(X[:10], X, weights=w), 
+                      explainer.shap(X[:10], X, weights=w, deduplicate=True)).all()
+    assert np.isclose(explainer.additive(X), explainer.additive(X, deduplicate=True)).all()
+    assert np.isclose(explainer.A(X), explainer.A(X, deduplicate=True)).all()
+
+    # Fitting the FD-Trees on weighted rows is the same as fitting them on repeated rows
+    features = Features(X_unique, [f"x{i}" for i in range(X.shape[1])], ["num"] * X.shape[1])
+    H_unique = explainer.H(X_unique, task)
+    H_expanded = explainer.H(X_expanded, task)
+    fits = [(L2CoETree, H_unique.sum(-1), H_expanded.sum(-1)), (PFITree, H_unique, H_expanded),
+            (GADGET_PDP, H_unique, H_expanded), (CART, H_unique[0, :, 0], H_expanded[0, :, 0])]
+    for tree_class, target_unique, target_expanded in fits:
+        tree_weighted = tree_class(features, samples_leaf=5).fit(X_unique, target_unique, sample_weight=weights)
+        tree_repeated = tree_class(features, samples_leaf=5).fit(X_expanded, target_expanded)
+        assert np.isclose(tree_weighted.total_impurity, tree_repeated.total_impurity)
+        assert tree_weighted.n_groups == tree_repeated.n_groups
+        if tree_weighted.n_groups > 1:
+            assert np.array_equal(tree_weighted.predict(X)[0], tree_repeated.predict(X)[0])
+
+
+
+def compare_encoding(X, model):
+    X = X[:100].copy()
+    X[::7, 1] = np.nan
+    explainer = TreeANOVA(model, X)
+    codes = explainer.encode(X)
+    assert codes.dtype == (np.uint8 if max(map(len, explainer.thresholds.values())) < 255 else np.uint16)
+
+    # The kernels take the same branches on the codes as on the raw values
+    for use_bitset in [False, True]:
+        assert np.array_equal(explainer.shap(X, X, use_bitset=use_bitset), 
+                              explainer.shap(codes, codes, use_bitset=use_bitset))
+        assert np.array_equal(explainer.additive(X, use_bitset=use_bitset), 
+                              explainer.additive(codes, use_bitset=use_bitset))
+    assert np.array_equal(explainer.taylor(X[:10], X), explainer.taylor(codes[:10], codes))
+    for use_stack in [False, True]:
+        assert np.array_equal(explainer.A(X, use_stack=use_stack), explainer.A(codes, use_stack=use_stack))
+    for raw, encoded in zip(explainer.additive_reduce(X), explainer.additive_reduce(codes), strict=True):
+        assert np.array_equal(raw, encoded)
+
+
+
+def compare_float32(X, model, task, tmp_path):
+    X = X[:100]
+    explainer = TreeANOVA(model, X)
+
+    # Only the storage is in single precision, the sums over trees are not
+    def close(results_32, results_64):
+        assert results_32.dtype == np.float32
+        return np.isclose(results_32, results_64, rtol=1e-5, atol=1e-6 * np.abs(results_64).max()).all()
+
+    for use_bitset in [False, True]:
+        assert close(explainer.shap(X, X, use_bitset=use_bitset, result_dtype=np.float32), 
+                     explainer.shap(X, X, use_bitset=use_bitset))
+        assert close(explainer.additive(X, use_bitset=use_bitset, result_dtype=np.float32), 
+                     explainer.additive(X, use_bitset=use_bitset))
+    for use_stack in [False, True]:
+        assert close(explainer.A(X, use_stack=use_stack, result_dtype=np.float32), 
+                     explainer.A(X, use_stack=use_stack))
+    H = explainer.H(X, task)
+    assert close(explainer.H(X, task, result_dtype=np.float32), H)
+    H_tiled = explainer.H(X, task, filename=tmp_path / "H.npy", memory_budget=2**16, result_dtype=np.float32)
+    assert close(np.asarray(H_tiled), H)
+
+
+
+def compare_rectangular(X, model, task):
+    X = X[:150]
+    explainer = TreeANOVA(model, X)
+    foreground, background = X[:100], X[100:]
+
+    # The pairs against a separate background are a block of the square tensors
+    H = explainer.H(X, task)
+    H_rect = explainer.H(foreground, task, background=background)
+    assert H_rect.shape == (100, 50, X.shape[1]+1)
+    assert np.isclose(H_rect, H[:100, 100:]).all()
+    for use_bitset in [False, True]:
+        assert np.isclose(explainer.additive(foreground, use_bitset=use_bitset, background=background), 
+                          H[:100, 100:, 1:]).all()
+    assert np.isclose(explainer.additive(foreground, deduplicate=True, background=background), 
+                      H[:100, 100:, 1:]).all()
+    A = explainer.A(X)
+    for use_stack in [False, True]:
+        assert np.isclose(explainer.A(foreground, use_stack=use_stack, background=background), A[:100, 100:]).all()
+        assert np.isclose(explainer.A(background, use_stack=use_stack, background=foreground), A[100:, :100]).all()
+
+    # The FD-Trees fitted against X as an explicit background are the usual ones
+    features = Features(X, [f"x{i}" for i in range(X.shape[1])], ["num"] * X.shape[1])
+    fits = [(L2CoETree, H.sum(-1), {"f" : H.sum(-1).diagonal()}), (GADGET_PDP, H, {})]
+    for tree_class, target, kwargs in fits:
+        tree = tree_class(features, samples_leaf=5).fit(X, target)
+        tree_rect = tree_class(features, samples_leaf=5).fit(X, target, background=X, **kwargs)
+        assert np.isclose(tree.total_impurity, tree_rect.total_impurity)
+        assert tree.n_groups == tree_rect.n_groups
+
+    # Only the background instances in a region are averaged over
+    f = get_black_box(model, task)(foreground)
+    fits = [(L2CoETree, H_rect.sum(-1), {"f" : f}), (GADGET_PDP, H_rect, {})]
+    for tree_class, target, kwargs in fits:
+        tree = tree_class(features, samples_leaf=5).fit(foreground, target, background=background, **kwargs)
+        assert np.isfinite(tree.total_impurity)
+        assert tree.n_groups >= 1
+
+
+
+def compare_feature_subset(X, model, task, tmp_path):
+    X = X[:100]
+    explainer = TreeANOVA(model, X)
+    H = explainer.H(X, task)
+
+    # Only the requested columns are stored, the other terms are summed in the last one
+    features = [3, 1]
+    for use_bitset in [False, True]:
+        H_sub = explainer.H(X, task, use_bitset=use_bitset, features=features)
+        assert np.isclose(H_sub, H[..., [0, 4, 2]]).all()
+        H_rest = explainer.H(X, task, use_bitset=use_bitset, features=features, rest=True)
+        assert np.isclose(H_rest[..., :-1], H_sub).all()
+        assert np.isclose(H_rest[..., -1], H[..., [1, 3, 5]].sum(-1)).all()
+    H_tiled = explainer.H(X, task, filename=tmp_path / "H.npy", memory_budget=2**14, features=features, rest=True)
+    assert np.isclose(np.asarray(H_tiled), H_rest).all()
+    assert np.isclose(explainer.H(X, task, deduplicate=True, features=features, rest=True), H_rest).all()
+    H_bg = explainer.H(X[:60], task, background=X[60:], features=features, rest=True)
+    assert np.isclose(H_bg, H_rest[:60, 60:]).all()
+
+    # Without any feature only the model outputs on the background are left
+    assert np.isclose(explainer.H(X, task, features=[]), H[..., [0]]).all()
+    explainer.memo_stats[:] = 0
+    H_f = explainer.H(X, task, filename=tmp_path / "H_f.npy", memory_budget=2**14, features=[])
+    assert np.isclose(np.asarray(H_f), H[..., [0]]).all()
+    # The kernels are not run
+    assert explainer.memo_stats[0] == 0
+
+
+
+def compare_I_map(X, model, task, black_box):
+    X = X[:100]
+    explainer = TreeANOVA(model, X)
+    I_map = np.array([0, 1, 2, 2, 3])
+
+    # Singleton groups leave the results unchanged
+    assert np.isclose(explainer.H(X, task, I_map=np.arange(5)), explainer.H(X, task)).all()
+    assert np.isclose(explainer.A(X, I_map=np.arange(5)), explainer.A(X)).all()
+
+    # The additive term of a group moves all its columns to the foreground at once
+    H = explainer.H(X, task, I_map=I_map)
+    assert H.shape == (100, 100, 5)
+    for group in range(4):
+        columns = I_map == group
+        for i in range(0, 100, 20):
+            X_hybrid = X.copy()
+            X_hybrid[:, columns] = X[i, columns]
+            assert np.isclose(H[i, :, group+1], black_box(X_hybrid) - black_box(X)).all()
+    assert np.isclose(explainer.H(X, task, I_map=I_map, use_bitset=True), H).all()
+    pdp, _ = explainer.additive_reduce(X, I_map=I_map)
+    assert np.isclose(pdp, H[..., 1:].mean(1)).all()
+    assert np.isclose(explainer.A(X, I_map=I_map, use_stack=True), explainer.A(X, I_map=I_map)).all()
+
+    # The Shapley-Taylor interactions of the groups sum to their Shapley values
+    phis = explainer.shap(X[:20], X, I_map=I_map)
+    taylor = explainer.taylor(X[:20], X, I_map=I_map)
+    assert taylor.shape == (20, 4, 4)
+    assert np.isclose(taylor.sum(-1), phis).all()
+
+
+
+def compare_regional(X, model):
+    X = X[:200]
+    explainer = TreeANOVA(model, X)
+
+    # Nested partitions as given by FD-Trees of increasing depths
+    labels = np.stack([X[:, 0] > 0, 2 * (X[:, 0] > 0) + (X[:, 1] > 0)]).astype(int)
+    phis = explainer.regional_shap(X, labels)
+    assert phis.shape == (2, 200, 5)
+
+    # Only the pairs in the coarsest regions are traversed
+    n_pairs = np.sum(np.bincount(labels[0])**2)
+    assert explainer.memo_stats[1] == n_pairs * np.sum(~explainer.closed_form)
+
+    for label, regional_phis in zip(labels, phis, strict=True):
+        for region in np.unique(label):
+            idx = label == region
+            assert np.isclose(regional_phis[idx], explainer.shap(X[idx], X[idx])).all()
+    assert np.isclose(explainer.regional_shap(X, labels[1]), phis[1]).all()
+
+
+
+def compare_pairs(X, model, tmp_path):
+    X = X[:150]
+    explainer = TreeANOVA(model, X)
+    labels = np.stack([X[:, 0] > 0, 2 * (X[:, 0] > 0) + (X[:, 1] > 0)]).astype(int)
+
+    # Global, weighted and regional Shapley values are reductions of the tensor of pairs
+    Phis = explainer.shap_pairs(X, X)
+    assert Phis.shape == (150, 150, 5)
+    assert np.isclose(get_regional_shap(Phis), explainer.shap(X, X)).all()
+    weights = np.arange(150) % 3 + 1
+    assert np.isclose(get_regional_shap(Phis, weights=weights), explainer.shap(X, X, weights=weights)).all()
+    assert np.isclose(get_regional_shap(Phis, labels), explainer.regional_shap(X, labels)).all()
+
+    # The tensor can be stored on disk in single precision
+    explainer.shap_pairs(X, X, result_dtype=np.float32, filename=tmp_path / "Phis.npy", memory_budget=2**14)
+    Phis_disk = np.load(tmp_path / "Phis.npy", mmap_mode="r")
+    assert Phis_disk.dtype == np.float32
+    assert np.isclose(Phis_disk, Phis, atol=1e-6).all()
+    assert np.isclose(get_regional_shap(Phis_disk, labels), get_regional_shap(Phis, labels), atol=1e-6).all()
+
+
+
+def compare_symmetric(X, model):
+    X = X[:100]
+    explainer = TreeANOVA(model, X)
+
+    # Explaining X against itself only traverses the pairs j > i of the trees that are not memoized
+    reference = explainer.shap(X, X.copy())
+    n_traversals = explainer.memo_stats[1]
+    serial = explainer.shap(X, X)
+    for n_jobs in [1, 3]:
+        symmetric = explainer.shap(X, X, n_jobs=n_jobs)
+        assert np.isclose(symmetric, reference).all()
+        assert np.array_equal(symmetric, serial)
+        assert explainer.memo_stats[1] <= n_traversals
+    assert np.isclose(explainer.shap(X), reference).all()
+    weights = np.arange(100) % 3 + 1
+    assert np.isclose(explainer.shap(X, X, weights=weights), explainer.shap(X, X.copy(), weights=weights)).all()
+
+    # A single traversal gives the Shapley-Taylor interactions of both orders of the pair
+    X = X[:40]
+    reference = explainer.taylor(X, X.copy())
+    serial = explainer.taylor(X, X)
+    for n_jobs in [1, 3]:
+        symmetric = explainer.taylor(X, X, n_jobs=n_jobs)
+        assert np.isclose(symmetric, reference).all()
+        assert np.array_equal(symmetric, serial)
+
+
+
+def compare_fused(X, model):
+    X = X[:100]
+    explainer = TreeANOVA(model, X)
+    foreground, background = X[:40], X[40:]
+    reference = {"shap" : explainer.shap(foreground, background), 
+                 "taylor" : explainer.taylor(foreground, background),
+                 "additive" : explainer.additive(foreground, background=background),
+                 "A" : explainer.A(foreground, background=background)}
+
+    # All the quantities come from a single traversal
+    results = interventional_fused_treeshap(model, foreground, background, n_jobs=2)
+    assert list(results) == list(reference)
+    for name, values in reference.items():
+        assert np.isclose(results[name], values).all()
+
+    # Subsets of the outputs, the additive terms and A alone prune the traversal
+    for outputs in [("A",), ("additive", "A"), ("shap", "additive")]:
+        results = explainer.fused(foreground, background, outputs=outputs)
+        assert list(results) == list(outputs)
+        for name in outputs:
+            assert np.isclose(results[name], reference[name]).all()
+
+
+
+def compare_latency(X, model):
+    X = X[:100]
+    explainer = TreeANOVA(model, X)
+
+    # With fewer foreground instances than threads the trees are split among the threads
+    for foreground in [X[:1], X[:3]]:
+        reference = explainer.shap(foreground, X, n_jobs=1)
+        for n_jobs in [4, 8]:
+            assert np.array_equal(explainer.shap(foreground, X, n_jobs=n_jobs), reference)
+    foreground = X[:3]
+    assert np.isclose(explainer.shap(foreground, n_jobs=4), explainer.shap(foreground, foreground.copy())).all()
+
+
+
+def compare_closed_form(X, y, model_name, task, tmp_path):
+    X, y = X[:100], y[:100]
+    background = X[:50]
+    masker = Independent(background, max_samples=50)
+    for depth in [1, 2, 3]:
+        if model_name == "rf":
+            model = RandomForestRegressor if task == "regression" else RandomForestClassifier
+            model = model(n_estimators=10, max_depth=depth, random_state=42).fit(X, y)
+        else:
+            model = GradientBoostingRegressor if task == "regression" else GradientBoostingClassifier
+            model = model(n_estimators=20, max_depth=depth, random_state=42).fit(X, y)
+        if task == "regression":
+            black_box = model.predict
+        elif model_name == "rf":
+            def black_box(x, model=model):
+                return model.predict_proba(x)[:, -1]
+        else:
+            black_box = model.decision_function
+        explainer = TreeANOVA(model)
+
+        # Stumps and trees splitting on two columns are evaluated in closed form
+        assert depth > 1 or explainer.closed_form.all()
+        phis = explainer.shap(X, background)
+        assert np.isclose(phis, Exact(black_box, masker=masker)(X).values).all()
+        assert np.isclose(explainer.taylor(X[:20], background), 
+                          Exact(black_box, masker=masker)(X[:20], interactions=2).values).all()
+        gaps = black_box(X) - black_box(background).mean()
+        assert np.isclose(explainer.shap(X, background, I_map=[0, 0, 1, 2, 2]).sum(1), gaps).all()
+        codes = explainer.encode(X)
+        assert np.isclose(explainer.shap(codes, codes[:50]), phis).all()
+
+        # The additive terms, A and the quantities derived from them get the same grids
+        H = get_ANOVA_1(background, black_box)
+        logit = model_name == "gbt"
+        assert np.isclose(explainer.H(background, task, logit=logit), H).all()
+        H_tiled = explainer.H(background, task, logit=logit, filename=tmp_path / "H.npy", memory_budget=2**13)
+        assert np.isclose(np.asarray(H_tiled), H).all()
+        assert np.isclose(explainer.H(background[:30], task, logit=logit, background=background[30:]), 
+                          H[:30, 30:]).all()
+        assert np.isclose(explainer.A(background), H.sum(-1)).all()
+        assert np.isclose(explainer.A(background[:30], background=background[30:]), H[:30, 30:].sum(-1)).all()
+        row_means, col_means = explainer.additive_reduce(background)
+        assert np.isclose(row_means, H[..., 1:].mean(1)).all()
+        assert np.isclose(col_means, H[..., 1:].mean(0)).all()
+        # A single group moves whole trees
+        H_group = explainer.additive(background, I_map=np.zeros(5))
+        assert np.isclose(H_group[..., 0], black_box(background).reshape((-1, 1)) - black_box(background)).all()
+
+        # Shapley values against single instances and regions
+        assert np.isclose(explainer.shap_pairs(X[:20], background).mean(1), phis[:20]).all()
+        labels = (background[:, 0] > 0).astype(int)
+        regional_phis = explainer.regional_shap(background, labels)
+        for region in [0, 1]:
+            idx = labels == region
+            assert np.isclose(regional_phis[idx], explainer.shap(background[idx], background[idx])).all()
+        fused = explainer.fused(X[:20], background)
+        assert np.isclose(fused["shap"], phis[:20]).all()
+        assert np.isclose(fused["taylor"], explainer.taylor(X[:20], background)).all()
+        assert np.isclose(fused["additive"], explainer.additive(X[:20], background=background)).all()
+        assert np.isclose(fused["A"], explainer.A(X[:20], background=background)).all()
+
+
+
+def compare_compaction(X, y, model, model_name, task):
+    X, y = X[:100], y[:100]
+    # Boosting on binary features repeats the same trees
+    if model_name == "gbt":
+        binary = GradientBoostingRegressor if task == "regression" else GradientBoostingClassifier
+        binary = binary(n_estimators=50, max_depth=2, random_state=42).fit(np.sign(X), y)
+    # Ten stumps on five binary features split twice on the same one
+    else:
+        binary = RandomForestRegressor if task == "regression" else RandomForestClassifier
+        binary = binary(n_estimators=10, max_depth=1, random_state=42).fit(np.sign(X), y)
+    assert TreeANOVA(binary).Nt < TreeANOVA(binary, compact=False).Nt
+    # The compacted ensemble is reused by the next explainers of the same model
+    assert TreeANOVA(binary).nodes is TreeANOVA(binary).nodes
+
+    for explained in [model, binary]:
+        explainer = TreeANOVA(explained)
+        reference = TreeANOVA(explained, compact=False)
+        assert explainer.Nt <= reference.Nt
+        assert len(explainer.nodes) <= len(reference.nodes)
+        foreground, background = X[:30], X[30:]
+        assert np.isclose(explainer.shap(foreground, background), reference.shap(foreground, background)).all()
+        assert np.isclose(explainer.taylor(foreground, background), reference.taylor(foreground, background)).all()
+        assert np.isclose(explainer.additive(foreground), reference.additive(foreground)).all()
+        assert np.isclose(explainer.A(foreground), reference.A(foreground)).all()
+
+
+
 def setup_task(d, correlations, model_name, task):
     np.random.seed(42)
     # Generate input
@@ -130,19 +770,27 @@ def setup_task(d, correlations, model_name, task):
         y = X.mean(1)
         if model_name == "rf":
             model = RandomForestRegressor(n_estimators=20, max_depth=5, random_state=42).fit(X, y)
+        elif model_name == "et":
+            model = ExtraTreesRegressor(n_estimators=20, max_depth=5, random_state=42).fit(X, y)
+        elif model_name == "hgb":
+            model = HistGradientBoostingRegressor(max_iter=20, max_depth=5, random_state=42).fit(X, y)
         else:
             model = GradientBoostingRegressor(n_estimators=20, max_depth=5, random_state=42).fit(X, y)
     else:
         y = (np.linalg.norm(X, axis=1) > np.sqrt(chi2(df=d).ppf(0.5))).astype(int)
         if model_name == "rf":
             model = RandomForestClassifier(n_estimators=20, max_depth=5, random_state=42).fit(X, y)
+        elif model_name == "et":
+            model = ExtraTreesClassifier(n_estimators=20, max_depth=5, random_state=42).fit(X, y)
+        elif model_name == "hgb":
+            model = HistGradientBoostingClassifier(max_iter=20, max_depth=5, random_state=42).fit(X, y)
         else:
             model = GradientBoostingClassifier(n_estimators=20, max_depth=5, random_state=42).fit(X, y)
     
     if task == "regression":
         black_box = model.predict
     else:
-        if model_name == "rf":
+        if model_name in ["rf", "et"]:
             black_box = lambda x : model.predict_proba(x)[:, -1]
         else:
             black_box = model.decision_function
@@ -206,6 +854,370 @@ def test_A_implementation(d, correlations, task, model_name, use_stack):
 
 
 
+####### Multithreading ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+@pytest.mark.parametrize("n_jobs", [2, -1])
+def test_n_jobs(task, model_name, n_jobs):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+
+    # Run test
+    compare_serial_parallel(X, model, n_jobs)
+
+
+
+
+####### Zero-copy inputs ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_memory_layouts(task, model_name):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+
+    # Run test
+    compare_memory_layouts(X, model)
+
+
+
+####### Memory-mapped H ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_tiled_H(task, model_name, tmp_path):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+
+    # Run test
+    compare_tiled_H(X, model, task, tmp_path)
+
+
+
+####### Fused reductions ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_reductions(task, model_name, n_jobs):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+
+    # Run test
+    compare_reductions(X, model, task, n_jobs)
+
+
+
+####### Persistent explainer ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_explainer(task, model_name):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+
+    # Run test
+    compare_explainer(X, model, task)
+
+
+
+####### Native tree extraction ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt", "et", "hgb"])
+def test_tree_extraction(task, model_name):
+
+    # Setup data and model
+    X, y, model, black_box = setup_task(5, False, model_name, task)
+
+    # Run test
+    compare_tree_extraction(X, model, black_box)
+
+    # The exponential loss starts from half the log-odds
+    if model_name == "gbt" and task == "classification":
+        model = GradientBoostingClassifier(loss="exponential", n_estimators=20, max_depth=5, 
+                                           random_state=42).fit(X, y)
+        X = X[:50]
+        assert np.isclose(extract_tree_ensemble(model).predict(X), model.decision_function(X)).all()
+        A = TreeANOVA(model).A(X)
+        assert np.isclose(np.diag(A), model.decision_function(X)).all()
+
+
+
+####### XGBoost and LightGBM loaders ########
+def test_model_loaders():
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, "gbt", "regression")
+
+    # Run test
+    compare_model_loaders(X, model)
+
+
+
+####### Packed tree layout ########
+def test_packed_layout():
+    np.random.seed(0)
+    X = np.random.normal(0, 1, size=(300, 4))
+    y = X[:, 0] * X[:, 1] + np.random.normal(0, 0.5, size=(300,))
+    # Trees of very different sizes
+    model = RandomForestRegressor(n_estimators=10, random_state=0).fit(X, y)
+    shallow = RandomForestRegressor(n_estimators=4, max_depth=2, random_state=0).fit(X, y)
+    model.estimators_[1:5] = shallow.estimators_
+    
+    nodes, offsets, max_depth = pack_tree_ensemble(extract_tree_ensemble(model))
+    assert np.array_equal(np.diff(offsets), [e.tree_.node_count for e in model.estimators_])
+    assert max_depth == max([e.tree_.max_depth for e in model.estimators_])
+    for t, e in enumerate(model.estimators_):
+        tree = nodes[offsets[t]:offsets[t+1]]
+        assert np.array_equal(tree["child_left"], e.tree_.children_left)
+        assert np.array_equal(tree["threshold"], e.tree_.threshold)
+    
+    # The kernels still agree with the model
+    phis = TreeANOVA(model).shap(X[:30], X[:30])
+    assert np.isclose(phis.sum(1), model.predict(X[:30]) - model.predict(X[:30]).mean()).all()
+
+
+
+def test_missing_values():
+    # XGBoost goes left when x < 0.5 and NaNs go right
+    tree = {"left_children" : [1, -1, -1], "right_children" : [2, -1, -1], "split_indices" : [0, 0, 0],
+            "split_conditions" : [0.5, 1.0, -1.0], "default_left" : [0, 0, 0], "split_type" : [0, 0, 0]}
+    xgb = {"learner" : {"learner_model_param" : {"base_score" : "[5E-1]", "num_class" : "0"},
+                        "objective" : {"name" : "binary:logistic"},
+                        "gradient_booster" : {"name" : "gbtree", "model" : {"trees" : [tree]}}}}
+    ensemble = load_xgboost_json(xgb)
+    X = np.array([[0.4, 0], [0.5, 0], [np.nan, 0]])
+    assert np.array_equal(ensemble.predict(X), [1, -1, -1])
+
+    # LightGBM goes left when x <= 0.5 and NaNs go left
+    lgbm = ("tree\nnum_tree_per_iteration=1\n\nTree=0\nnum_leaves=2\n"
+            "split_feature=1\nthreshold=0.5\ndecision_type=10\nleft_child=-1\n"
+            "right_child=-2\nleaf_value=2 -2\n\nTree=1\nnum_leaves=1\nleaf_value=1\n"
+            "\nend of trees")
+    ensemble = load_lightgbm_text(lgbm)
+    X = np.array([[0, 0.5], [0, 0.6], [0, np.nan]])
+    assert np.array_equal(ensemble.predict(X), [3, -1, 3])
+
+    # The kernels route the missing values the same way
+    np.random.seed(0)
+    X = np.random.uniform(0, 1, size=(40, 2))
+    X[::3, 1] = np.nan
+    phis = TreeANOVA(ensemble).shap(X, X)
+    assert np.isclose(phis.sum(1), ensemble.predict(X) - ensemble.predict(X).mean()).all()
+    A = TreeANOVA(ensemble).A(X)
+    assert np.isclose(np.diag(A), ensemble.predict(X)).all()
+
+    # HistGradientBoosting learns the direction of missing values
+    X = np.random.normal(0, 1, size=(500, 3))
+    X[::4, 1] = np.nan
+    y = X[:, 0] + np.isnan(X[:, 1])
+    model = HistGradientBoostingRegressor(max_iter=20, random_state=42).fit(X, y)
+    phis = TreeANOVA(model).shap(X[:50], X[:50])
+    assert np.isclose(phis.sum(1), model.predict(X[:50]) - model.predict(X[:50]).mean()).all()
+
+
+
+####### Bitset engine ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_bitset(task, model_name):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+
+    # Run test
+    compare_bitset(X, model, task)
+
+
+
+####### Memoization on threshold cells ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["gbt", "hgb"])
+def test_memoization(task, model_name):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_memoization(X, model)
+
+
+
+####### Background deduplication ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_deduplication(task, model_name):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_deduplication(X, model, task)
+
+
+
+####### Threshold encoding ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt", "hgb"])
+def test_encoding(task, model_name):
+
+    # Setup data and model
+    X, y, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_encoding(X, model)
+
+    # Deep trees have too many thresholds to fit in 1 byte
+    model = RandomForestRegressor(n_estimators=5, max_depth=12, random_state=42).fit(X[:, :2], y)
+    compare_encoding(X[:, :2], model)
+
+
+
+####### Single precision results ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_float32(task, model_name, tmp_path):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_float32(X, model, task, tmp_path)
+
+
+
+####### Rectangular foreground x background ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_rectangular(task, model_name):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_rectangular(X, model, task)
+
+
+
+####### Subsets of features ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_feature_subset(task, model_name, tmp_path):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_feature_subset(X, model, task, tmp_path)
+
+
+
+####### Grouped features ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_I_map(task, model_name):
+
+    # Setup data and model
+    X, _, model, black_box = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_I_map(X, model, task, black_box)
+
+
+
+####### Regional explanations ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_regional(task, model_name):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_regional(X, model)
+
+
+
+####### Tensor of pairs ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_pairs(task, model_name, tmp_path):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_pairs(X, model, tmp_path)
+
+
+
+####### Foreground equal to the background ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_symmetric(task, model_name):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_symmetric(X, model)
+
+
+
+####### Fused outputs ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_fused(task, model_name):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_fused(X, model)
+
+
+
+####### Single instance ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_latency(task, model_name):
+
+    # Setup data and model
+    X, _, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_latency(X, model)
+
+
+
+####### Closed-form trees ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_closed_form(task, model_name, tmp_path):
+
+    # Setup data and model
+    X, y, _, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_closed_form(X, y, model_name, task, tmp_path)
+
+
+
+####### Ensemble compaction ########
+@pytest.mark.parametrize("task", ["regression", "classification"])
+@pytest.mark.parametrize("model_name", ["rf", "gbt"])
+def test_compaction(task, model_name):
+
+    # Setup data and model
+    X, y, model, _ = setup_task(5, False, model_name, task)
+    
+    # Run test
+    compare_compaction(X, y, model, model_name, task)
+
+
+
+
 # @pytest.mark.parametrize("d", range(4, 21, 4))
 # def test_treeshap_regression_coallition(d):
 #     # Generate data